@@ -0,0 +1,106 @@
+import sys
+import time
+import random
+import threading
+import psycopg2
+
+# Stress test for canteen balances: many threads tap the SAME card at once, like a card being used on several
+#  Ground Modules at the same time. Then it checks that no update was lost and that the balance never went negative.
+#
+# It compares canteen_utils.apply_transaction (one conditional statement) with the old way the canteen plug-in did it
+#  (read the balance, compute the new one in Python, then write it), which loses updates when taps overlap.
+#
+# Run it from the extras folder on a test database, it changes the balance of the card below!
+
+sys.path.insert(0, "../tapapi")
+from plugins.plugin_utils import canteen_utils
+
+uid = "99 99 99 99"
+username = input("Enter your database username:\n")
+password = input("Enter your database password:\n")
+threads = int(input("Enter the number of concurrent taps (leave blank for 16):\n") or 16)
+taps = int(input("Enter the number of taps per thread (leave blank for 200):\n") or 200)
+starting_balance = 100
+
+
+def connect():
+    return psycopg2.connect(user=username,
+                            password=password,
+                            host="localhost",
+                            port="5432",
+                            database="tapid")
+
+
+def reset_card(conn):
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("delete from canteen_transactions where uid = %s;", (uid,))
+            curs.execute("delete from canteen_chits where uid = %s;", (uid,))
+            curs.execute("insert into canteen_chits (uid, balance) values (%s, %s);", (uid, starting_balance))
+
+
+def tap_new(conn, action, amount):
+    """The canteen plug-in now, returns the change in balance (0 if it was refused)"""
+    entry = canteen_utils.apply_transaction(conn, uid, action=action, amount=amount)
+    if entry is None:
+        return 0
+    return amount if action == "add" else -amount
+
+
+def tap_old(conn, action, amount):
+    """How the canteen plug-in used to do it"""
+    old_bal = canteen_utils.get_balance_of_uid(conn, uid)
+    new_bal = old_bal + amount if action == "add" else old_bal - amount
+    if new_bal < 0:
+        return 0
+    canteen_utils.update_balance_of_uid(conn, uid, new_bal=new_bal, action=action, bal=amount)
+    return new_bal - old_bal
+
+
+def stress(tap):
+    conn = connect()
+    reset_card(conn)
+
+    # Every thread adds up the changes it THINKS it made, so the final balance should be starting_balance + all of them
+    applied = [0] * threads
+    start_line = threading.Barrier(threads)
+
+    def worker(index):
+        worker_conn = connect()
+        rng = random.Random(index)
+        start_line.wait()
+        for _ in range(taps):
+            # Slightly more subtracts than adds, so the balance regularly runs close to zero
+            action = "subtract" if rng.random() < 0.55 else "add"
+            applied[index] += tap(worker_conn, action, rng.randint(1, 5))
+        worker_conn.close()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("select balance from canteen_chits where uid = %s;", (uid,))
+            balance = curs.fetchone()[0]
+            curs.execute("select count(*), min(new_bal) from canteen_transactions where uid = %s;", (uid,))
+            ledger_rows, lowest = curs.fetchone()
+    conn.close()
+
+    expected = starting_balance + sum(applied)
+    print(f"  {threads * taps} taps in {elapsed:.2f}s ({threads * taps / elapsed:.0f} taps/s)")
+    print(f"  Final balance: {balance}, expected: {expected}, lost updates: {'NONE' if balance == expected else 'YES'}")
+    print(f"  Ledger rows: {ledger_rows}, lowest new_bal in the ledger: {lowest}")
+    return balance == expected and (lowest is None or lowest >= 0)
+
+
+print("apply_transaction (one statement):")
+new_ok = stress(tap_new)
+print("Read, compute, then write (the old way):")
+stress(tap_old)
+
+print("PASSED" if new_ok else "FAILED")
@@ -0,0 +1,123 @@
+import sys
+import time
+
+# Compares the Ground Module's old way of reading a JWT off a card (authenticating before every block, copied below
+#  from main.py) with CardReader (ground_module_python/card_reader.py), which authenticates once per sector.
+#
+# There's no MFRC522 on CPython, so FakeMFRC522 stands in for it: it holds a card written the same way as
+#  jwt_to_rfid_array() writes it, only lets a block be read once its sector is authenticated (like a real card), and
+#  waits the time an exchange with the card takes for each auth() and read(). Time a few exchanges on the Pico for
+#  the real numbers (main.py prints how long each card read took). Run it from extras.
+
+sys.path.insert(0, "../ground_module_python")
+from card_reader import CardReader, sector_data_blocks
+
+
+class FakeMFRC522:
+    OK = 0
+    ERR = 2
+    AUTHENT1A = 0x60
+
+    def __init__(self, jwt: str, auth_ms: float, read_ms: float):
+        # Written like jwt_to_rfid_array(): the JWT, the end of text character, then zeros
+        data = jwt.encode() + b"\x03"
+        blocks = [block for sector in range(16) for block in sector_data_blocks(sector)]
+        data += bytes(len(blocks) * 16 - len(data))
+        self.blocks = {block: list(data[i * 16:i * 16 + 16]) for i, block in enumerate(blocks)}
+
+        self.auth_seconds = auth_ms / 1000
+        self.read_seconds = read_ms / 1000
+        self.authenticated_sector = None
+        self.auths = 0
+        self.reads = 0
+
+    def auth(self, mode, addr, sect, ser):
+        time.sleep(self.auth_seconds)
+        self.auths += 1
+        self.authenticated_sector = addr // 4
+        return self.OK
+
+    def read(self, addr):
+        time.sleep(self.read_seconds)
+        self.reads += 1
+        if addr // 4 != self.authenticated_sector:
+            return self.ERR, []
+        return self.OK, list(self.blocks[addr])
+
+    def stop_crypto1(self):
+        self.authenticated_sector = None
+
+
+def writable_rfid_blocks():
+    return [z for z in range(1, 64) if (z % 4) != 3]
+
+
+def old_read_jwt(reader, uid):
+    defaultKey = [255, 255, 255, 255, 255, 255]
+
+    # Buffer for storing card information
+    jwt_buf = []
+
+    # Boolean to keep track if entire JWT was read
+    read_complete = False
+
+    # writable_rfid_blocks() are all blocks minus the trailer sectors)
+    for block_num in writable_rfid_blocks():
+        status = reader.auth(reader.AUTHENT1A, block_num, defaultKey, uid)
+        end_of_text = False
+
+        if status == reader.OK:
+            _status, read_block = reader.read(block_num)
+
+            if status == reader.OK:
+                for char in read_block:
+                    # If we reach the end of text character (3 in decimal)
+                    if char == 3:
+                        end_of_text = True
+                        read_complete = True
+                        break
+                    jwt_buf.append(chr(char))
+            else:
+                print("Error reading RFID card")
+        else:
+            break
+
+        if end_of_text:
+            break
+
+    return "".join(jwt_buf) if read_complete else None
+
+
+def new_read_jwt(card_reader, uid):
+    jwt = card_reader.read_jwt(uid)
+    return bytes(jwt).decode() if jwt is not None else None
+
+
+def fake_jwt(signature_length: int) -> str:
+    # Sizes of TapAPI's JWTs: the signature is 342 characters for RS256, 86 for ES256 and EdDSA
+    return "h" * 36 + "." + "p" * 120 + "." + "s" * signature_length
+
+
+if __name__ == "__main__":
+    auth_ms = float(input("Time an auth() takes on the Pico, in ms (ex. 4): ") or 4)
+    read_ms = float(input("Time a read() takes on the Pico, in ms (ex. 3): ") or 3)
+    uid = [0xAB, 0xCD, 0xEF, 0x12]
+
+    print("\n  token           old (ms)   new (ms)   old auths   new auths   reads   same JWT")
+    for name, signature_length in (("RS256", 342), ("ES256/EdDSA", 86)):
+        jwt = fake_jwt(signature_length)
+
+        old_reader = FakeMFRC522(jwt, auth_ms, read_ms)
+        start = time.perf_counter()
+        old_jwt = old_read_jwt(old_reader, uid)
+        old_ms = (time.perf_counter() - start) * 1000
+
+        new_reader = FakeMFRC522(jwt, auth_ms, read_ms)
+        card_reader = CardReader(new_reader)
+        start = time.perf_counter()
+        new_jwt = new_read_jwt(card_reader, uid)
+        new_ms = (time.perf_counter() - start) * 1000
+
+        same = old_jwt == new_jwt == jwt
+        print(f"  {name:<13}   {old_ms:8.1f}   {new_ms:8.1f}   {old_reader.auths:9}   {new_reader.auths:9}   "
+              f"{new_reader.reads:5}   {same}")
@@ -0,0 +1,71 @@
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for the Google Sheets API, to test the books_library plug-in's Google Sheets outbox without a Google
+#  account (see tapapi/plugins/plugin_utils/sheets_outbox.py). It only understands values.append, and keeps the rows
+#  in memory instead of in a spreadsheet.
+#
+# Point TapAPI at it by adding "sheets_endpoint": "http://localhost:8123" to the books_library entry in config.json.
+#  GET http://localhost:8123/ shows every row received so far.
+#
+# It can also fail some of the requests on purpose, to see the outbox retry them (with backoff) later.
+
+port = int(input("Enter the port (leave blank for 8123):\n") or 8123)
+fail_rate = float(input("Enter the fraction of requests to fail, from 0 to 1 (leave blank for 0):\n") or 0)
+
+rows = []
+appends = 0
+lock = threading.Lock()
+
+
+class FakeSheets(BaseHTTPRequestHandler):
+    def _send_json(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        with lock:
+            self._send_json(200, {"appends": appends, "rows": rows})
+
+    def do_POST(self):
+        global appends
+
+        # ex. /v4/spreadsheets/<spreadsheet id>/values/borrow_log%21A1%3AD1:append?valueInputOption=USER_ENTERED
+        path = self.path.split("?")[0]
+        if not (path.startswith("/v4/spreadsheets/") and path.endswith(":append")):
+            self._send_json(404, {"error": {"code": 404, "message": "Only values.append is supported"}})
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        if random.random() < fail_rate:
+            print(f"Failing an append of {len(body['values'])} rows on purpose")
+            self._send_json(503, {"error": {"code": 503, "message": "The service is currently unavailable."}})
+            return
+
+        with lock:
+            rows.extend(body["values"])
+            appends += 1
+
+        for row in body["values"]:
+            print(f"Appended {row}")
+
+        spreadsheet_id = path.split("/")[3]
+        self._send_json(200, {
+            "spreadsheetId": spreadsheet_id,
+            "updates": {"spreadsheetId": spreadsheet_id, "updatedRows": len(body["values"])}
+        })
+
+    def log_message(self, format, *args):
+        # The appended rows are printed instead of every request
+        pass
+
+
+print(f"Fake Google Sheets listening on http://localhost:{port}")
+ThreadingHTTPServer(("0.0.0.0", port), FakeSheets).serve_forever()
@@ -1,6 +1,6 @@
 import jwt
 import psycopg2
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 from cryptography.hazmat.primitives import serialization
 
 uid = "00 00 00 00"
@@ -8,6 +8,8 @@ username = input("Enter your database username:\n")
 password = input("Enter your database password:\n")
 event_name = input("Enter your plug-ins event_name:\n")
 jwt_password = input("Enter the password required to verify your JWT:\n")
+# RS256 is the original algorithm, ES256 and EdDSA make JWTs less than half as long (faster to read off a card)
+algorithm = input("Enter the key algorithm (RS256, ES256 or EdDSA, leave blank for RS256):\n") or "RS256"
 
 conn = psycopg2.connect(user=username,
                         password=password,
@@ -17,12 +19,22 @@ conn = psycopg2.connect(user=username,
 
 curs = conn.cursor()
 
-# 65537 as a public exponent is standard (e=3 is used sometimes, but a
-# curious student can do future research on the security of this RSA implementation)
-private_key = rsa.generate_private_key(
-    public_exponent=65537,
-    key_size=2048
-)
+if algorithm == "RS256":
+    # 65537 as a public exponent is standard (e=3 is used sometimes, but a
+    # curious student can do future research on the security of this RSA implementation)
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048
+    )
+    public_format = serialization.PublicFormat.PKCS1
+elif algorithm == "ES256":
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_format = serialization.PublicFormat.SubjectPublicKeyInfo
+elif algorithm == "EdDSA":
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    public_format = serialization.PublicFormat.SubjectPublicKeyInfo
+else:
+    raise ValueError("Unknown algorithm " + algorithm)
 
 print("Creating public-private key pair...")
 # What's all this PEM, PKCS8, PKCS1 stuff?
@@ -35,16 +47,18 @@ utf8_pem_private_key = private_key.private_bytes(
 
 utf8_pem_public_key = private_key.public_key().public_bytes(
     encoding=serialization.Encoding.PEM,
-    format=serialization.PublicFormat.PKCS1
+    format=public_format
 ).decode('utf-8')
 
 print("Inserting public key into database and private key in test database...")
-curs.execute('insert into public_keys (uid, public_key) values (%s, %s);', (uid, utf8_pem_public_key))
+curs.execute('insert into public_keys (uid, public_key, algorithm) values (%s, %s, %s);',
+             (uid, utf8_pem_public_key, algorithm))
 
 # The dictionary we are encoding will contain student info for the server to verify
 # It will get passed down to the run() function of an event
-encoded = jwt.encode({"name": "Jane Doe", "grade": 1, "pass": jwt_password}, bytes(utf8_pem_private_key, 'utf-8'), algorithm="RS256")
+encoded = jwt.encode({"name": "Jane Doe", "grade": 1, "pass": jwt_password}, bytes(utf8_pem_private_key, 'utf-8'), algorithm=algorithm)
 
+print(f"\nJWT is {len(encoded)} characters long ({len(encoded) // 16 + 1} MIFARE blocks)")
 print("\nPayload to send to the server:")
 print(
     {
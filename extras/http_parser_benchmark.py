@@ -0,0 +1,96 @@
+import sys
+import json
+import timeit
+import tracemalloc
+
+# Compares the Ground Module's old way of parsing TapAPI's responses (parse_http_payload() before
+#  ground_module_python/http_parser.py existed, copied below) with HTTPResponseParser, on CPython.
+#
+# The old way needed the whole UART capture (from SEND OK to CLOSED) in memory before it could start, while the parser
+#  is fed the response a chunk at a time as it comes in. Times on the Pico are much longer, but they compare the
+#  same way. No Ground Module or server needed, run it from extras.
+
+sys.path.insert(0, "../ground_module_python")
+from http_parser import HTTPResponseParser
+
+
+def old_parse_http_payload(raw_payload: str) -> dict:
+    """Parses raw HTTP payload from the ESP8266 into an organized dictionary"""
+    try:
+        raw_payload = raw_payload.replace("\r", "")
+        split = raw_payload[raw_payload.find("SEND OK") + len("SEND OK") + 1:raw_payload.find("CLOSED")].split("\n\n")
+        _split = [x.split(": ") for x in split[0].split("\n") if x.split(": ")[0] != '']
+        _response_code = _split[0][0].split(" ")[1]
+        _final = {key: value for key, value in _split[1:]}
+        _final["response_code"] = _response_code
+        _final["json"] = json.loads(split[1])
+        return _final
+    except IndexError:
+        return None
+
+
+def make_response(body_size: int) -> bytes:
+    body = json.dumps({"msg": "ok", "data": {"time_now": "Mon 12 08:08"}, "padding": "x" * body_size}).encode()
+    return (b"HTTP/1.1 200 OK\r\n"
+            b"Server: gunicorn\r\n"
+            b"Date: Sun, 18 Oct 2026 09:00:00 GMT\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+
+
+def old_way(capture: str):
+    return old_parse_http_payload(capture)
+
+
+def new_way(response: bytes, chunk_size: int):
+    parser = HTTPResponseParser()
+    view = memoryview(response)
+    for start in range(0, len(response), chunk_size):
+        if parser.feed(view[start:start + chunk_size]):
+            break
+    return parser.status, parser.json()
+
+
+def check_chunk_boundaries(response: bytes) -> bool:
+    """The response has to parse the same wherever the chunks are split (ex. in the middle of the \\r\\n\\r\\n)"""
+    expected = json.loads(response.split(b"\r\n\r\n", 1)[1])
+    for chunk_size in range(1, 80):
+        if new_way(response, chunk_size) != (200, expected):
+            print(f"  FAILED with chunks of {chunk_size} bytes")
+            return False
+    return True
+
+
+def peak_memory(fn) -> int:
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == "__main__":
+    number = int(input("Number of responses to parse per size (ex. 20000): ") or 20000)
+    # The ESP-01 sends +IPD chunks of up to 1460 bytes, smaller ones are common on a busy network
+    chunk_size = int(input("Size of each chunk fed to the parser (ex. 128): ") or 128)
+
+    ok = True
+    print("\n  body   old (us)   new (us)   old peak (B)   new peak (B)")
+    for body_size in (0, 200, 2000):
+        response = make_response(body_size)
+        # What the old function was given: the whole UART capture of the request
+        capture = f"AT+CIPSEND=200\r\r\n\r\nOK\r\n> \r\nRecv 200 bytes\r\n\r\nSEND OK\r\n\r\n+IPD,{len(response)}:" \
+                  f"{response.decode()}CLOSED\r\n"
+
+        ok = ok and check_chunk_boundaries(response)
+
+        old_seconds = timeit.timeit(lambda: old_way(capture), number=number)
+        new_seconds = timeit.timeit(lambda: new_way(response, chunk_size), number=number)
+        old_peak = peak_memory(lambda: old_way(capture))
+        new_peak = peak_memory(lambda: new_way(response, chunk_size))
+
+        print(f"  {len(response):4}   {old_seconds / number * 1e6:8.1f}   {new_seconds / number * 1e6:8.1f}   "
+              f"{old_peak:12}   {new_peak:12}")
+
+    print("\nChunk boundaries: " + ("PASSED" if ok else "FAILED"))
@@ -0,0 +1,71 @@
+import sys
+import time
+import random
+import threading
+from collections import defaultdict
+
+# Shows the two things TapAPI's KeyedExecutor promises (see tapapi/utils/keyed_executor.py):
+#  1. Taps of the same card run one at a time, in the order they came in
+#  2. Taps of different cards run in parallel, so twice the cards means (about) twice the taps per second
+#
+# The "plug-in" here just sleeps, like a plug-in waiting on the database. No database needed, run it from extras.
+
+sys.path.insert(0, "../tapapi")
+from utils.keyed_executor import KeyedExecutor
+
+
+def check_ordering(cards: int = 8, taps: int = 50, workers: int = 16) -> bool:
+    executor = KeyedExecutor(max_workers=workers)
+    lock = threading.Lock()
+    order = defaultdict(list)
+    running = defaultdict(int)
+    most_running = defaultdict(int)
+
+    def plugin(card, tap):
+        with lock:
+            running[card] += 1
+            most_running[card] = max(most_running[card], running[card])
+        time.sleep(random.uniform(0, 0.002))
+        with lock:
+            running[card] -= 1
+            order[card].append(tap)
+
+    # Submit the taps of every card mixed together, like taps arriving from many Ground Modules
+    futures = [executor.submit(card, plugin, card, tap) for tap in range(taps) for card in range(cards)]
+    for future in futures:
+        future.result()
+    executor.shutdown()
+
+    in_order = all(order[card] == list(range(taps)) for card in range(cards))
+    one_at_a_time = all(most_running[card] == 1 for card in range(cards))
+
+    print(f"Ordering: {cards} cards x {taps} taps")
+    print(f"  Every card's taps ran in order: {in_order}")
+    print(f"  Never more than one tap of the same card at once: {one_at_a_time}")
+    return in_order and one_at_a_time
+
+
+def measure_scaling(taps: int = 20, plugin_seconds: float = 0.01, workers: int = 32) -> None:
+    print(f"Scaling: {taps} taps per card, each taking {plugin_seconds * 1000:.0f}ms, {workers} threads")
+    print("  cards   taps/s   speedup")
+
+    baseline = None
+    for cards in (1, 2, 4, 8, 16, 32):
+        executor = KeyedExecutor(max_workers=workers)
+        started = time.perf_counter()
+
+        futures = [executor.submit(card, time.sleep, plugin_seconds) for _ in range(taps) for card in range(cards)]
+        for future in futures:
+            future.result()
+
+        rate = cards * taps / (time.perf_counter() - started)
+        executor.shutdown()
+
+        baseline = baseline or rate
+        print(f"  {cards:5}   {rate:6.0f}   {rate / baseline:5.1f}x")
+
+
+if __name__ == "__main__":
+    ok = check_ordering()
+    measure_scaling()
+    print("PASSED" if ok else "FAILED")
@@ -1,6 +1,11 @@
+import sys
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
+# The tables themselves are made by TapAPI's migrations (see tapapi/utils/migrations.py)
+sys.path.insert(0, "../tapapi")
+from utils.migrations import migrate
+
 
 username = input("Enter your database username:\n")
 password = input("Enter your database password:\n")
@@ -23,53 +28,7 @@ conn = psycopg2.connect(user=username,
                         port="5432",
                         database="tapid")
 
-with conn:
-    with conn.cursor() as curs:
-        curs.execute("""
-            create table public_keys (
-                uid varchar(11) primary key,
-                public_key text unique
-            );
-        """)
-
-        curs.execute("""
-            create table test_key_pairs (
-                uid varchar(11) primary key,
-                private_key text,
-                public_key text
-            );
-        """)
-
-        curs.execute("""
-            create table metrics (
-                metric_id serial primary key,
-                event_name text,
-                metric_data json,
-                timestamp timestamp
-            );
-        """)
-
-        curs.execute("""
-            create table books_borrowed (
-                borrow_id serial primary key,
-                book_id int references book_ids(book_id) not null,
-                due_on date not null
-            );
-        """)
-
-        curs.execute("""
-            create table book_ids (
-                book_id serial primary key,
-                book_name text
-            );
-        """)
-
-        curs.execute("""
-            create table canteen_chits (
-                transaction_number serial primary key,
-                uid varchar(11),
-                balance integer
-            );
-        """)
+migrate(conn)
+conn.close()
 
 print("Made database with no errors!")
@@ -0,0 +1,29 @@
+import sys
+import psycopg2
+
+# Run this after updating TapAPI, it brings an existing database up to date (new tables, columns and indexes).
+# It's safe to run more than once, and works on databases made before TapAPI had migrations too.
+# Running TapAPI with --migrate does the same thing.
+
+sys.path.insert(0, "../tapapi")
+from utils.migrations import migrate, check_schema, LATEST_VERSION
+
+username = input("Enter your database username:\n")
+password = input("Enter your database password:\n")
+
+conn = psycopg2.connect(user=username,
+                        password=password,
+                        host="localhost",
+                        port="5432",
+                        database="tapid")
+
+for migration in migrate(conn):
+    print(f"Applied migration {migration.version}: {migration.name}")
+
+problems = check_schema(conn)
+conn.close()
+
+for problem in problems:
+    print(problem)
+
+print(f"Database is at version {LATEST_VERSION} with no errors!" if not problems else "Database still has problems!")
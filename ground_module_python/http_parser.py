@@ -0,0 +1,167 @@
+try:
+    import ujson as json
+except ImportError:
+    # CPython (ex. extras/http_parser_benchmark.py)
+    import json
+
+
+class HTTPResponseParser:
+    # The end of the headers (it can be split between two chunks)
+    _END_OF_HEADERS = b"\r\n\r\n"
+
+    def __init__(self, head: bool = False, max_header_size: int = 1024):
+        """
+        Parses an HTTP/1.x response a chunk at a time, as it comes in (ex. each +IPD from the ESP-01)
+
+        Only the headers are kept as text. The body is copied once, into a bytearray the size of its Content-Length,
+         and decoded from JSON once it's complete (see json()). So the Pico's small memory doesn't fill up with copies
+         of the response.
+
+        :param head: If the response is to a HEAD request (it has no body, whatever its Content-Length says)
+        :param max_header_size: Maximum size of the status line and headers, in bytes
+        """
+        self.head = head
+
+        self._header = bytearray(max_header_size)
+        self._header_length = 0
+
+        # Filled in once the headers are complete
+        self.status = None
+        self.reason = None
+        self.version = None
+        self.headers = {}
+        self.content_length = None
+        self.keep_alive = True
+
+        self._body = None
+        self._body_length = 0
+
+        # True once the whole response was received, error says what went wrong if it can't be parsed
+        self.done = False
+        self.error = None
+
+    def feed(self, chunk) -> bool:
+        """
+        :param chunk: The next bytes of the response (bytes, bytearray or memoryview)
+        :return: True once the whole response was received
+        """
+        if self.done or self.error:
+            return self.done
+
+        chunk = memoryview(chunk)
+        start = 0
+
+        if self.status is None:
+            start = self._feed_header(chunk)
+            if start == -1 or self.error:
+                return False
+
+        if start < len(chunk):
+            self._feed_body(chunk[start:])
+
+        if self.content_length is not None and self._body_length >= self.content_length:
+            self.done = True
+
+        return self.done
+
+    def finish(self) -> bool:
+        """
+        Call when the server closed the connection. A response without a Content-Length ends there.
+
+        :return: If the response is complete
+        """
+        if not self.done and self.status is not None and self.content_length is None and not self.error:
+            self.done = True
+        return self.done
+
+    def _feed_header(self, chunk) -> int:
+        """:return: Where the body starts in chunk, -1 if the headers aren't complete yet"""
+        # bytes have find() (bytearray and memoryview don't on MicroPython). It's one copy of the chunk, and only until
+        #  the headers are complete, which is usually the first chunk.
+        data = bytes(chunk)
+        length = self._header_length
+
+        # The end of the headers can start in the last 3 bytes of the previous chunk
+        tail = bytes(memoryview(self._header)[max(length - 3, 0):length])
+        found = (tail + data[:3]).find(self._END_OF_HEADERS) if tail else -1
+        if found != -1:
+            end = found + 4 - len(tail)
+        else:
+            found = data.find(self._END_OF_HEADERS)
+            end = found + 4 if found != -1 else -1
+
+        count = end if end != -1 else len(data)
+        if length + count > len(self._header):
+            self.error = "headers too long"
+            return -1
+
+        self._header[length:length + count] = data[:count] if count < len(data) else data
+        self._header_length = length + count
+
+        if end == -1:
+            return -1
+
+        self._parse_header()
+        return end
+
+    def _parse_header(self) -> None:
+        lines = bytes(memoryview(self._header)[:self._header_length - 4]).decode().split("\r\n")
+
+        # Ex. HTTP/1.1 200 OK
+        status_line = lines[0].split(" ", 2)
+        try:
+            self.version = status_line[0]
+            self.status = int(status_line[1])
+            self.reason = status_line[2] if len(status_line) > 2 else ""
+        except (IndexError, ValueError):
+            self.error = "invalid status line"
+            return
+
+        for line in lines[1:]:
+            name, value = line.split(":", 1) if ":" in line else (line, "")
+            self.headers[name.strip().lower()] = value.strip()
+
+        connection = self.headers.get("connection", "").lower()
+        # HTTP/1.0 servers close the connection after every response, unless they say otherwise
+        self.keep_alive = connection == "keep-alive" if self.version == "HTTP/1.0" else connection != "close"
+
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            self.error = "chunked responses aren't supported"
+            return
+
+        if self.head or self.status == 204 or self.status == 304 or 100 <= self.status < 200:
+            self.content_length = 0
+        elif "content-length" in self.headers:
+            try:
+                self.content_length = int(self.headers["content-length"])
+            except ValueError:
+                self.error = "invalid Content-Length"
+                return
+
+        # Known size, so the body is allocated once
+        self._body = bytearray(self.content_length if self.content_length is not None else 0)
+
+    def _feed_body(self, chunk) -> None:
+        if self.content_length is None:
+            # No Content-Length, the body lasts until the connection is closed (see finish())
+            self._body.extend(chunk)
+            self._body_length += len(chunk)
+            return
+
+        # Anything after Content-Length bytes isn't part of this response
+        count = min(len(chunk), self.content_length - self._body_length)
+        self._body[self._body_length:self._body_length + count] = chunk[:count]
+        self._body_length += count
+
+    def body(self) -> bytes:
+        """The raw body received so far"""
+        return bytes(memoryview(self._body)[:self._body_length]) if self._body is not None else b""
+
+    def json(self):
+        """The body decoded from JSON, None if it's empty or isn't valid JSON"""
+        if not self._body_length:
+            return None
+        try:
+            return json.loads(self.body())
+        except ValueError:
+            return None
@@ -2,10 +2,11 @@
 LIBRARY MODULE CODE
 """
 from machine import I2C, Pin, UART
-from utils import parse_at_response, jwt_to_rfid_array, formatted_uid, ESP8266, writable_rfid_blocks, parse_ip_response
+from utils import parse_at_response, jwt_to_rfid_array, formatted_uid, ESP8266, parse_ip_response
 import utime
 from sys import exit
 from mfrc522 import MFRC522
+from card_reader import CardReader
 from pico_i2c_lcd import I2cLcd
 
 row_list = [Pin(x, Pin.OUT) for x in [8, 9, 10, 11]]
@@ -41,6 +42,9 @@ previous_card = []
 # MFRC522 reader class instantiation
 reader = MFRC522(spi_id=0, sck=2, miso=4, mosi=3, cs=1, rst=0)
 
+# Reads JWTs off the cards with the default key (see CardReader)
+card_reader = CardReader(reader)
+
 # Instantiate I2C communications for LCD
 i2c = I2C(1, sda=Pin(6), scl=Pin(7), freq=400000)
 I2C_ADDR = i2c.scan()[0]
@@ -103,8 +107,9 @@ esp8266.set_multiple_connections(False)
 
 clear_loading_screen(10)
 
-# Establish a TCP connection to the HTTP server
-conn_resp = esp8266.establish_connection("TCP", SERVER_IP, SERVER_PORT)
+# Establish a TCP connection to the HTTP server. It stays open between taps (HTTP/1.1 keep-alive), so taps don't
+#  wait for a new connection every time
+conn_resp = esp8266.connect(SERVER_IP, SERVER_PORT)
 
 # See if server is offline
 if parse_at_response(conn_resp) == "ERROR\nCLOSED\n":
@@ -154,6 +159,9 @@ while True:
 
             previous_card = uid
 
+            # If another card's last event never got an answer, it won't be retried anymore
+            esp8266.forget_unacknowledged(formatted_uid(uid))
+
             # The default card key 0xFF six times
             # For testing purposes you can use it to reduce possible headaches
             # In deployment, write the key in the trailer sectors (where sector_n%4==3; 1,3,5,7...)
@@ -162,53 +170,29 @@ while True:
             # Function to read entire card, remove comment if needed
             # reader.MFRC522_DumpClassic1K(uid, Start=0, End=64, keyA=defaultKey)
 
-            # Buffer for storing card information
-            jwt_buf = []
-
-            # Boolean to keep track if entire JWT was read
-            read_complete = False
-
-            # writable_rfid_blocks() are all blocks minus the trailer sectors)
-            for block_num in writable_rfid_blocks():
-                status = reader.auth(reader.AUTHENT1A, block_num, defaultKey, uid)
-                end_of_text = False
-
-                if status == reader.OK:
-                    _status, read_block = reader.read(block_num)
-
-                    if status == reader.OK:
-                        for char in read_block:
-                            # If we reach the end of text character (3 in decimal)
-                            if char == 3:
-                                end_of_text = True
-                                read_complete = True
-                                break
-                            jwt_buf.append(chr(char))
-                    else:
-                        print("Error reading RFID card")
-                else:
-                    break
-
-                if end_of_text:
-                    break
+            # Read the JWT, authenticating each sector once instead of each block (see card_reader.py)
+            read_start = utime.ticks_ms()
+            jwt = card_reader.read_jwt(uid)
 
             # If the end of text character wasn't read
-            if not read_complete:
-                print("Card not read completely, ignoring.")
+            if jwt is None:
+                print(f"Card not read completely ({card_reader.error}), ignoring.")
                 card_on_sensor_msg()
                 continue
 
             # JWTs have two periods. This is the only not-so-resource-intensive way to
             # Check if there is a valid JWT
-            if jwt_buf.count('.') != 2:
+            jwt = bytes(jwt)
+            if jwt.count(b'.') != 2:
                 print('Not a JWT. Ignoring card.')
                 continue
 
-            print(f"Read a JWT from RFID.")
+            print(f"Read a JWT from RFID in {utime.ticks_diff(utime.ticks_ms(), read_start)}ms.")
 
             lcd.move_to(0, 1)
             lcd.putstr("Card read!")
             book_id = 0
+            cancelled = False
             while True:
                 lcd.move_to(0, 1)
                 lcd.putstr("Enter book ID:")
@@ -220,13 +204,22 @@ while True:
                     elif key == "*":
                         lcd.clear()
                         book_id = 0
+                    elif key == "C":
+                        cancelled = True
+                        break
                     elif key == "D":
                         break
                     utime.sleep(0.3)
 
+            # Cancelled, so nothing is sent, and the card's last event (if it never got an answer) won't be retried
+            if cancelled:
+                esp8266.forget_unacknowledged()
+                card_on_sensor_msg()
+                continue
+
             # A valid TapAPI payload
             payload = {
-                "jwt": "".join(jwt_buf),
+                "jwt": jwt.decode(),
                 "uid": formatted_uid(uid),
                 "event_name": "borrow_book",
                 "event_data": {
@@ -238,9 +231,6 @@ while True:
 
             print(payload)
 
-            # Establish a TCP HTTP connection to the server ip and port
-            esp8266.establish_connection(type="TCP", ip=SERVER_IP, port=SERVER_PORT)
-
             lcd.move_to(0, 1)
             lcd.putstr("Authenticating")
 
@@ -253,7 +243,10 @@ while True:
                 # If there was an error parsing the HTTP response
                 lcd.clear()
                 lcd.move_to(0, 0)
-                lcd.putstr("Error. Try again.")
+                # esp8266.error says why there's no response (see ESP8266.post())
+                lcd.putstr("Timed out." if esp8266.error == ESP8266.TIMED_OUT else "Error.")
+                lcd.move_to(0, 1)
+                lcd.putstr("Try again.")
                 utime.sleep(2)
                 continue
 
@@ -282,4 +275,7 @@ while True:
     else:
         previous_card = []
 
+        # Reconnect to the server if it closed the connection, or ping it so it doesn't close it for being idle
+        esp8266.maintain()
+
     utime.sleep(1)
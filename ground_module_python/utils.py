@@ -1,27 +1,47 @@
 import ujson
+import utime
+import uselect
+import ubinascii
+from os import urandom
 from sys import exit
 from machine import UART
+from http_parser import HTTPResponseParser
 
 
 def writable_rfid_blocks():
     return [z for z in range(1, 64) if (z % 4) != 3]
 
 
-def parse_http_payload(raw_payload: str) -> dict:
-    """Parses raw HTTP payload from the ESP8266 into an organized dictionary"""
-    print(raw_payload)
-    try:
-        raw_payload = raw_payload.replace("\r", "")
-        split = raw_payload[raw_payload.find("SEND OK") + len("SEND OK") + 1:raw_payload.find("CLOSED")].split("\n\n")
-        _split = [x.split(": ") for x in split[0].split("\n") if x.split(": ")[0] != '']
-        _response_code = _split[0][0].split(" ")[1]
-        _final = {key: value for key, value in _split[1:]}
-        _final["response_code"] = _response_code
-        _final["json"] = ujson.loads(split[1])
-        return _final
-    except IndexError:
+def new_idempotency_key() -> str:
+    """32 random hex characters (like a UUID) that TapAPI uses to recognize a retried request, see ESP8266.post()"""
+    return ubinascii.hexlify(urandom(16)).decode()
+
+
+def parse_http_payload(raw_payload) -> dict:
+    """
+    Parses a whole raw HTTP response into an organized dictionary (headers, "response_code" and "json"). The ESP8266
+     class parses responses while they come in instead (see http_parser.py).
+    """
+    parser = HTTPResponseParser()
+    parser.feed(raw_payload.encode() if type(raw_payload) == str else raw_payload)
+    parser.finish()
+    return response_dict(parser)
+
+
+def response_dict(parser: HTTPResponseParser) -> dict:
+    """:return: The dictionary parse_http_payload() returns, for a complete response, None if it isn't valid"""
+    if not parser.done:
         return None
 
+    body = parser.json()
+    if body is None:
+        return None
+
+    _final = dict(parser.headers)
+    _final["response_code"] = str(parser.status)
+    _final["json"] = body
+    return _final
+
 
 def parse_at_response(resp: str):
     return resp.replace("\r", "").split("\n\n")[1]
@@ -32,14 +52,20 @@ def parse_ip_response(resp: str):
 
 
 def jwt_to_rfid_array(filename: str):
-    """Read a JWT (single line) in a text file on the root dir"""
-    jwt_str = open(filename, 'r').readline()
+    """
+    Read a JWT (single line) in a text file on the root dir
+
+    Works with RS256, ES256 and EdDSA JWTs. An RS256 JWT takes up around 30 of the 47 writable blocks, while ES256
+    and EdDSA JWTs fit in around 12, so they are read off the card (and sent to TapAPI) more than twice as fast.
+    """
+    jwt_str = open(filename, 'r').readline().strip()
     print(jwt_str)
     split_arr = [jwt_str[i:i+16] for i in range(0, len(jwt_str), 16)]
     eot_appended = False
     out_arr = []
 
-    if len(split_arr) > 47:
+    # One extra character is needed for the end of text character
+    if len(jwt_str) + 1 > len(writable_rfid_blocks()) * 16:
         return ValueError("JWT too big for 1K MIFARE card")
 
     for sector in split_arr:
@@ -85,6 +111,76 @@ class Response:
         return f"Response(\n    headers={self.headers}\n    body={self.body}\n)"
 
 
+class RingBuffer:
+    def __init__(self, size: int = 2048):
+        """
+        A fixed-size first in, first out buffer of bytes. The bytearray is made once, and bytes are written and read
+         around it in a circle, so receiving data never allocates (and fragments) the Pico's small memory.
+        Read more: https://en.wikipedia.org/wiki/Circular_buffer
+
+        :param size: Maximum number of bytes it holds
+        """
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._size = size
+        self._start = 0
+        self.length = 0
+
+    def __getitem__(self, index: int) -> int:
+        return self._buf[(self._start + index) % self._size]
+
+    def free(self) -> int:
+        return self._size - self.length
+
+    def fill_from(self, stream, count: int) -> int:
+        """Moves up to count bytes from stream (ex. a UART) straight into the buffer, returns how many were moved"""
+        count = min(count, self.free())
+        end = (self._start + self.length) % self._size
+        first = min(count, self._size - end)
+
+        moved = stream.readinto(self._view[end:end + first]) or 0
+        # The free space wraps around to the start of the bytearray
+        if moved == first and count > first:
+            moved += stream.readinto(self._view[0:count - first]) or 0
+
+        self.length += moved
+        return moved
+
+    def find(self, byte: int, start: int = 0) -> int:
+        """:return: The index of the first byte equal to byte (an int, ex. ord(":")) from start, -1 if there's none"""
+        for index in range(start, self.length):
+            if self[index] == byte:
+                return index
+        return -1
+
+    def startswith(self, prefix: bytes) -> bool:
+        if self.length < len(prefix):
+            return False
+        for index in range(len(prefix)):
+            if self[index] != prefix[index]:
+                return False
+        return True
+
+    def read_into(self, out, count: int) -> None:
+        """Moves the first count bytes into out (a bytearray or memoryview at least count long)"""
+        for index in range(count):
+            out[index] = self[index]
+        self.skip(count)
+
+    def read(self, count: int) -> bytes:
+        out = bytearray(count)
+        self.read_into(out, count)
+        return bytes(out)
+
+    def skip(self, count: int) -> None:
+        self._start = (self._start + count) % self._size
+        self.length -= count
+
+    def clear(self) -> None:
+        self._start = 0
+        self.length = 0
+
+
 # Some other useful AT commands
 # esp8266.send('AT+GMR')      # Check version information
 # esp8266.send('AT+CWMODE?')  # Query the Wi-Fi mode
@@ -99,38 +195,249 @@ class ESP8266:
     MODE_SOFT_AP = 2
     MODE_SOFTAP_STATION = 3
 
-    def __init__(self, uart: UART, tx_pin, rx_pin):
+    # What the ESP-01 sends back, as ESP8266._next() recognizes it while it streams in
+    OK = "OK"
+    ERROR = "ERROR"
+    FAIL = "FAIL"
+    SEND_OK = "SEND OK"
+    SEND_FAIL = "SEND FAIL"
+    CLOSED = "CLOSED"
+    # The > the ESP-01 sends when it's ready for the data of an AT+CIPSEND (it doesn't end with a new line)
+    PROMPT = ">"
+    # Data received from the server: +IPD,<length>:<data>, where data can have new lines in it
+    IPD = "+IPD"
+    # In passive receive mode, the ESP-01 only says how much data it's holding (+IPD,<length>) and sends it when
+    #  asked with AT+CIPRECVDATA, as +CIPRECVDATA,<length>:<data>
+    DATA_WAITING = "+IPD waiting"
+    RECV_DATA = "+CIPRECVDATA"
+    LINE = "LINE"
+
+    # The lines that end an AT command's response
+    COMMAND_DONE = (OK, ERROR, FAIL)
+
+    # Why the last get()/post() returned None, in ESP8266.error
+    NOT_CONNECTED = "not connected"
+    SEND_FAILED = "send failed"
+    TIMED_OUT = "timed out"
+    BAD_RESPONSE = "bad response"
+
+    # States of a response being received (see ESP8266._receive())
+    _SENDING = 0
+    _RECEIVING = 1
+    _DONE = 2
+
+    # Milliseconds to wait before trying to reconnect to the server, doubled after every failed attempt
+    MIN_BACKOFF = 500
+    MAX_BACKOFF = 30000
+
+    # Milliseconds after an unanswered POST during which the same payload counts as a retry of it (see post()). Any
+    #  later, it's a new transaction, even if it's the same card buying the same thing again.
+    RETRY_WINDOW = 30000
+
+    def __init__(self, uart: UART, tx_pin, rx_pin, buffer_size: int = 2048, ping_interval: int = 30000):
         """
         Class that handles communication with an ESP-01E module
         Uses AT commands (see https://docs.espressif.com/projects/esp-at/en/latest/AT_Command_Set/index.html)
 
+        The same UART is used for the whole session. Everything the ESP-01 sends is moved into a ring buffer and read
+         from there line by line, so each command returns as soon as its OK (or ERROR, ...) arrives instead of
+         waiting for the UART to time out, and no bytes are lost between two commands.
+
         :param uart: Pi Pico UART
         :param tx_pin: TX pin used
         :param rx_pin: RX pin used
+        :param buffer_size: Size of the ring buffer (bytes received but not read yet)
+        :param ping_interval: Milliseconds the connection to the server can be idle before maintain() pings it. Keep
+         it under the server's keep-alive timeout (see --keepalive in TapAPI).
         """
         self.uart = uart
         self.tx_pin = tx_pin
         self.rx_pin = rx_pin
+        self._rx = RingBuffer(buffer_size)
+
+        # Lets _wait() sleep until the UART receives something (or its deadline passes) instead of checking it in a loop
+        # Read more: https://docs.micropython.org/en/latest/library/select.html
+        self._poll = uselect.poll()
+        self._poll.register(uart, uselect.POLLIN)
+
+        # See receive_mode()
+        self.passive = False
+
+        # Why the last get()/post() returned None (ex. ESP8266.TIMED_OUT), None if it didn't
+        self.error = None
+
+        # The connection to the server, kept open between requests (see connect())
+        self.ping_interval = ping_interval
+        self._server = None
+        self._connected = False
+        self._backoff = self.MIN_BACKOFF
+        self._next_attempt = utime.ticks_ms()
+        self._last_used = utime.ticks_ms()
+
+        # The last payload that was POSTed without a final response (see post()), its idempotency key, when it was
+        #  sent and the UID of its card
+        self._unacknowledged_payload = None
+        self._idempotency_key = None
+        self._unacknowledged_at = 0
+        self._unacknowledged_uid = None
+
+    def _fill(self) -> int:
+        """Moves whatever the UART received into the ring buffer, without waiting"""
+        waiting = self.uart.any()
+        if not waiting or not self._rx.free():
+            return 0
+        return self._rx.fill_from(self.uart, waiting)
+
+    def _wait(self, deadline: int) -> bool:
+        """Waits for more bytes until the deadline (from utime.ticks_ms()), returns False if the deadline passed"""
+        while not self._fill():
+            remaining = utime.ticks_diff(deadline, utime.ticks_ms())
+            if remaining <= 0:
+                return False
+            self._poll.poll(remaining)
+        return True
+
+    def _read_exactly(self, count: int, deadline: int):
+        """Reads count bytes (less if the deadline passes first), as a bytearray"""
+        out = bytearray(count)
+        view = memoryview(out)
+        done = 0
+
+        while done < count:
+            if self._rx.length:
+                chunk = min(self._rx.length, count - done)
+                self._rx.read_into(view[done:done + chunk], chunk)
+                done += chunk
+            elif not self._wait(deadline):
+                return out[:done]
+
+        return out
+
+    def _next(self, deadline: int):
+        """
+        Reads the next complete thing the ESP-01 sent: a line, the > prompt, or the data of a +IPD
 
-    def change_uart_timeout(self, timeout=1000):
-        self.uart = UART(0, tx=self.tx_pin, rx=self.rx_pin, baudrate=115200, timeout=timeout)
+        :return: (what it is, ex. ESP8266.OK, its raw bytes), or (None, None) if nothing complete arrived before the
+         deadline
+        """
+        while True:
+            rx = self._rx
+
+            if rx.length:
+                if rx.startswith(b"+IPD,"):
+                    colon = rx.find(ord(":"))
+                    newline = rx.find(ord("\n"))
+                    if colon != -1 and (newline == -1 or colon < newline):
+                        header = rx.read(colon + 1)
+                        # +IPD,<length>: or, with multiple connections, +IPD,<link ID>,<length>:
+                        length = int(header[5:-1].split(b",")[-1])
+                        return self.IPD, self._read_exactly(length, deadline)
+                    elif newline != -1:
+                        # Passive receive mode, the line only has the length
+                        line = rx.read(newline + 1)
+                        return self.DATA_WAITING, int(line.strip()[5:].split(b",")[-1])
+                elif rx.startswith(b"+CIPRECVDATA") and rx.length > 13:
+                    # +CIPRECVDATA,<length>:<data>, or +CIPRECVDATA:<length>,<data> on newer firmware
+                    end = rx.find(ord(":") if rx[12] == ord(",") else ord(","), 13)
+                    if end != -1:
+                        header = rx.read(end + 1)
+                        return self.RECV_DATA, self._read_exactly(int(header[13:-1]), deadline)
+                elif rx[0] == ord(">"):
+                    rx.skip(1)
+                    return self.PROMPT, b">"
+                else:
+                    newline = rx.find(ord("\n"))
+                    if newline != -1:
+                        line = rx.read(newline + 1)
+                        kind = self._line_kind(line)
+                        if kind == self.CLOSED:
+                            # The server (or the network) closed the connection, it's reopened on the next request
+                            self._connected = False
+                        return kind, line
+
+            if not self._wait(deadline):
+                return None, None
+
+    def _line_kind(self, line: bytes) -> str:
+        line = line.strip()
+        if line in (b"OK", b"ERROR", b"FAIL", b"SEND OK", b"SEND FAIL"):
+            return line.decode()
+        # With multiple connections it's <link ID>,CLOSED
+        if line.endswith(b"CLOSED"):
+            return self.CLOSED
+        return self.LINE
+
+    def _drain(self) -> None:
+        """Reads and drops whatever the ESP-01 sent that nobody asked for, noticing if the connection was closed"""
+        self._fill()
+        now = utime.ticks_ms()
+        while self._rx.length:
+            kind, data = self._next(now)
+            if kind is None:
+                # Only part of a line arrived
+                data = self._rx.read(self._rx.length)
+            print("Dropped: " + str(data))
+
+    def _collect(self, deadline: int, until: tuple, linger: int = 0):
+        """
+        Reads until one of the kinds in until (or the deadline)
 
-    def send(self, cmd, timeout=1000):
+        :param linger: Milliseconds to keep reading after it, for responses that continue after their OK/ERROR
+        :return: (everything read, the kind that ended it or None if the deadline passed)
+        """
+        out = bytearray()
+        while True:
+            kind, data = self._next(deadline)
+            if kind is None:
+                return out, None
+
+            out.extend(data)
+            if kind in until:
+                if linger:
+                    more, _ = self._collect(utime.ticks_add(utime.ticks_ms(), linger), ())
+                    out.extend(more)
+                return out, kind
+
+    def _command(self, cmd: str, timeout: int = 1000, until: tuple = COMMAND_DONE, linger: int = 0, retries: int = 2):
+        """
+        Sends an AT command and reads its response
+
+        :return: (the response, the kind that ended it or None if there was no complete response)
+        """
         print("CMD: " + cmd)
-        self.uart = UART(0, tx=self.tx_pin, rx=self.rx_pin, baudrate=115200, timeout=timeout)
-        self.uart.write(cmd+'\r\n')
-        _resp = self.uart.read()
+
+        # Anything left over (ex. a CLOSED sent while the module was idle) isn't part of this command's response
+        self._drain()
+
+        for _ in range(retries + 1):
+            self.uart.write(cmd + '\r\n')
+            _resp, kind = self._collect(utime.ticks_add(utime.ticks_ms(), timeout), until, linger)
+
+            if _resp:
+                return _resp, kind
+            print('Retrying previous command (no response)')
+
+        return None, None
+
+    def send(self, cmd, timeout=1000, until: tuple = COMMAND_DONE, linger: int = 0):
+        """
+        Sends an AT command, and returns its response as soon as it's complete (or once timeout milliseconds passed)
+
+        :return: The response (bytes if it isn't valid text), None if the ESP-01 didn't answer at all
+        """
+        _resp, _ = self._command(cmd, timeout=timeout, until=until, linger=linger)
 
         print("resp:")
+        if _resp is None:
+            print(_resp)
+            return None
+
         try:
             print(_resp.decode())
             return _resp.decode()
         except UnicodeError:
             print(_resp)
-            return _resp
-        except AttributeError:
-            print('Retrying previous command (RESP: ' + str(_resp).replace("\r\n", " ") + ')')
-            return self.send(cmd, timeout=timeout)
+            return bytes(_resp)
 
     def startup(self, timeout=1000):
         return self.send('AT', timeout=timeout)
@@ -176,73 +483,299 @@ class ESP8266:
         :param port: The port of your server
         :return:
         """
-        return self.send(f'AT+CIPSTART="{type}","{ip}",{port}', timeout=timeout)
+        # When it fails, a CLOSED comes right after the ERROR
+        return self.send(f'AT+CIPSTART="{type}","{ip}",{port}', timeout=timeout, linger=20)
 
-    def get(self, ip: str, route: str):
+    def connect(self, ip: str, port: int, type: str = "TCP", timeout=1000):
         """
-        Do an HTTP GET request
+        Open the connection to the server, which then stays open between requests (HTTP/1.1 keep-alive). Opening a
+         connection is a TCP handshake plus an AT command, so each tap that reuses it gets its response sooner.
 
-        :param ip: The IP address of your server
-        :param route: Where the request will happen (ex. if you want 127.0.0.1/home, put "/home")
-        :return:
+        If the server closes it, the next request (or maintain()) opens it again.
+
+        :return: The response to AT+CIPSTART, like establish_connection()
+        """
+        self._server = (type, ip, port)
+        return self._open(timeout)
+
+    def _open(self, timeout=1000):
+        # A CLOSED of the last connection must not count against this one
+        self._drain()
+
+        # A CLOSED read while connecting (ex. right after an ERROR) sets _connected back to False
+        self._connected = True
+        resp = self.establish_connection(*self._server, timeout=timeout)
+
+        # Also true for ALREADY CONNECTED
+        if type(resp) != str or "CONNECT" not in resp:
+            self._connected = False
+        elif not self._connected and "ALREADY CONNECTED" in resp:
+            # The last connection was closing (ex. after a "Connection: close" response) just as it was reopened.
+            #  Now that its CLOSED arrived, try again.
+            self._connected = True
+            resp = self.establish_connection(*self._server, timeout=timeout)
+            if type(resp) != str or "CONNECT" not in resp:
+                self._connected = False
+
+        if self._connected:
+            self._backoff = self.MIN_BACKOFF
+            self._last_used = utime.ticks_ms()
+        else:
+            self._next_attempt = utime.ticks_add(utime.ticks_ms(), self._backoff)
+            self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+
+        return resp
+
+    def _ensure_connected(self, wait_for_backoff: bool = True) -> bool:
+        """Reopens the connection if it was closed. Returns False if it couldn't (or if it's too soon to try again)."""
+        if self._connected:
+            return True
+        if self._server is None:
+            return False
+        if wait_for_backoff and utime.ticks_diff(self._next_attempt, utime.ticks_ms()) > 0:
+            return False
+
+        self._open()
+        return self._connected
+
+    def close(self, timeout=1000):
+        """Close the connection to the server"""
+        self._connected = False
+        return self.send('AT+CIPCLOSE', timeout=timeout)
+
+    def _start_send(self, length: int) -> bool:
+        """Asks the ESP-01 to send length bytes over the connection, returns True once it's ready for them"""
+        _, kind = self._command(f'AT+CIPSEND={length}', timeout=1000, until=(self.PROMPT, self.ERROR), retries=0)
+        return kind == self.PROMPT
+
+    def receive_mode(self, passive: bool, timeout=1000):
         """
-        cmd = f"GET {route} HTTP/1.0\r\nHost: {ip}\r\n\r\n"
-        self.send(f'AT+CIPSEND=' + str(len(cmd) + cmd.count("\r\n") * 4))
-        self.change_uart_timeout(500)
-        self.uart.write(cmd + "\r\n")
+        Set how the ESP-01 hands over what the server sends.
+         - Active (the default): it sends the data as soon as it arrives, so a big response can fill up the ring
+            buffer before it's read.
+         - Passive: it keeps the data and says how much it has, and the data is asked for a chunk (half the ring
+            buffer) at a time. Slower, but a response of any size fits.
+        Read more: https://docs.espressif.com/projects/esp-at/en/latest/esp32/AT_Command_Set/TCP-IP_AT_Commands.html
+
+        :return: The response to AT+CIPRECVMODE
+        """
+        resp = self.send(f'AT+CIPRECVMODE={int(passive)}', timeout=timeout)
+        if type(resp) == str and "OK" in resp:
+            self.passive = passive
+        return resp
 
-        while True:
-            self.uart.write("AT\r\n")
-            _resp = self.uart.read()
+    def _request(self, request: str, timeout: int, head: bool = False):
+        """
+        Sends an HTTP request over the connection to the server, and reads its response
+
+        :param timeout: Milliseconds to wait for the whole response
+        :param head: If it's a HEAD request (its response has no body, whatever its Content-Length says)
+        :return: The parsed response (an HTTPResponseParser), or None if it couldn't be sent or the response didn't
+         arrive (and then ESP8266.error says why)
+        """
+        self.error = None
+        data = request.encode()
+
+        # Someone is waiting for this request, so don't wait for the backoff
+        if not self._ensure_connected(wait_for_backoff=False):
+            print("Could not connect to the server")
+            self.error = self.NOT_CONNECTED
+            return None
 
-            if _resp is None:
-                continue
-            else:
-                decode = _resp.decode()
-                parsed = parse_http_payload(decode[decode.find("+IPD"):])
-                body = parsed.pop('json')
+        # The ESP-01 answers with a > once it's ready for exactly len(data) bytes. If it isn't, the connection was
+        #  closed without us seeing its CLOSED, so it's opened again (the request wasn't sent, so it's safe to retry).
+        if not self._start_send(len(data)):
+            self._connected = False
+            if not self._ensure_connected(wait_for_backoff=False) or not self._start_send(len(data)):
+                print("Could not send the request")
+                self.error = self.SEND_FAILED
+                return None
 
-                return Response(body=body, headers=parsed)
+        self.uart.write(data)
 
-    def post(self, ip: str, route: str, payload: dict):
+        parser = self._receive(utime.ticks_add(utime.ticks_ms(), timeout), head)
+
+        if parser is not None:
+            self._last_used = utime.ticks_ms()
+        return parser
+
+    def _receive(self, deadline: int, head: bool):
         """
-        Do an HTTP POST request
+        Reads the response to the request that was just sent, until it's complete or the deadline passes. Nothing is
+         sent to the ESP-01 meanwhile, except AT+CIPRECVDATA in passive receive mode.
+
+        Its state goes from _SENDING (until SEND OK) to _RECEIVING (once the response starts coming in) to _DONE. The
+         response comes in +IPD chunks (sometimes even before the SEND OK), which are parsed as they arrive. With
+         keep-alive the server doesn't close the connection after it, so its end is found with the Content-Length
+         header.
 
-        :param timeout: Time before UART timeout
+        :return: The parsed response (an HTTPResponseParser), or None (and then ESP8266.error says why)
+        """
+        state = self._SENDING
+        parser = HTTPResponseParser(head=head)
+        closed = False
+
+        # Passive receive mode: bytes the ESP-01 is holding for us, and if an AT+CIPRECVDATA is waiting for its OK
+        waiting = 0
+        asking = False
+
+        while state != self._DONE:
+            if waiting and not asking:
+                self.uart.write(f'AT+CIPRECVDATA={min(waiting, self._rx._size // 2)}\r\n')
+                asking = True
+
+            kind, chunk = self._next(deadline)
+
+            if kind == self.SEND_OK:
+                state = max(state, self._RECEIVING)
+            elif kind == self.DATA_WAITING:
+                waiting += chunk
+            elif kind in (self.OK, self.ERROR) and asking:
+                asking = False
+                if kind == self.ERROR:
+                    # The data is gone (ex. the connection closed)
+                    waiting = 0
+            elif kind in (self.IPD, self.RECV_DATA):
+                state = self._RECEIVING
+                if kind == self.RECV_DATA:
+                    waiting = max(waiting - len(chunk), 0)
+
+                if parser.feed(chunk):
+                    state = self._DONE
+                elif parser.error:
+                    print("Invalid response: " + parser.error)
+                    break
+            elif kind in (self.SEND_FAIL, self.ERROR):
+                print("Could not send the request")
+                self._connected = False
+                self.error = self.SEND_FAILED
+                return None
+            elif kind == self.CLOSED:
+                closed = True
+            elif kind is None:
+                print("Timed out waiting for the response")
+                self.error = self.TIMED_OUT
+                # Don't let the rest of this response be read as the response to the next request
+                if self._connected:
+                    self.close()
+                return None
+
+            # Once the connection is closed, nothing more is coming (except what passive mode still holds)
+            if closed and not waiting and not asking:
+                # Without a Content-Length, whatever arrived before the CLOSED is the whole response
+                parser.finish()
+                break
+
+        if not parser.done:
+            self.error = self.BAD_RESPONSE
+            if self._connected:
+                self.close()
+            return None
+
+        if not parser.keep_alive and self._connected:
+            self._connected = False
+
+        return parser
+
+    def _response(self, parser):
+        """Turns a response from _request() into a Response, None if there's none or its body isn't JSON"""
+        if parser is None:
+            return None
+
+        parsed = response_dict(parser)
+
+        if not parsed:
+            self.error = self.BAD_RESPONSE
+            return None
+
+        body = parsed.pop('json')
+        return Response(body=body, headers=parsed)
+
+    def ping(self, route: str = "/", timeout: int = 2000) -> bool:
+        """
+        Sends a HEAD request (a GET without the body), so the server doesn't close the connection for being idle and
+         so a connection that was dropped is noticed before the next tap instead of during it
+
+        :return: If the server answered
+        """
+        parser = self._request(f"HEAD {route} HTTP/1.1\r\nHost: {self._server[1]}\r\n\r\n", timeout, head=True)
+        return parser is not None
+
+    def maintain(self) -> None:
+        """
+        Call this regularly while waiting for a card. It reconnects to the server if the connection was closed
+         (waiting longer after every failed attempt), and pings the server when the connection has been idle for
+         ping_interval milliseconds.
+        """
+        if self._server is None:
+            return
+
+        self._drain()
+
+        if not self._connected:
+            self._ensure_connected()
+        elif utime.ticks_diff(utime.ticks_ms(), self._last_used) >= self.ping_interval:
+            self.ping()
+
+    def get(self, ip: str, route: str, timeout: int = 5000):
+        """
+        Do an HTTP GET request (over the connection opened with connect())
+
+        :param ip: The IP address of your server
+        :param route: Where the request will happen (ex. if you want 127.0.0.1/home, put "/home")
+        :param timeout: Milliseconds to wait for the response
+        :return: Response, or None if there was no (valid) response
+        """
+        return self._response(self._request(f"GET {route} HTTP/1.1\r\nHost: {ip}\r\n\r\n", timeout))
+
+    def post(self, ip: str, route: str, payload: dict, timeout: int = 5000):
+        """
+        Do an HTTP POST request (over the connection opened with connect())
+
+        :param timeout: Milliseconds to wait for the response
         :param payload: dict of your JSON payload
         :param ip: The IP address of your server
         :param route: Where the request will happen (ex. if you want 127.0.0.1/home, put "/home")
-        :return: Response
+        :return: Response, or None if there was no (valid) response
         """
         json_str = ujson.dumps(payload)
-        cmd = f"POST {route} HTTP/1.0\r\nHost: {ip}\r\nContent-Type: application/json\r\nContent-Length: {len(json_str)}\r\n\r\n{json_str}\r\n"
-        self.send(f'AT+CIPSEND=' + str(len(cmd) + cmd.count("\r\n")*4), timeout=500)
-        self.change_uart_timeout(350)
-        self.uart.write(cmd + "\r\n")
 
-        while True:
-            self.uart.write("AT\r\n")
-            _resp = self.uart.read(1)
-
-            if _resp is None:
-                continue
-            else:
-                _resp = self.uart.read()
-                decode = _resp.decode()
-
-                # If the response isn't complete
-                while "CLOSED" not in decode:
-                    _resp = self.uart.read()
-                    try:
-                        decode = _resp.decode()
-                    except AttributeError:
-                        continue
-
-                parsed = parse_http_payload(decode[decode.find("+IPD"):])
-
-                if not parsed:
-                    return None
-
-                body = parsed.pop('json')
-                resp = Response(body=body, headers=parsed)
-                return resp
+        # TapAPI only runs a transaction once per idempotency key. Every new transaction gets a new key, but if the
+        #  last one never got a final response (ex. the ESP-01 timed out) and the same card taps for the same thing
+        #  again within RETRY_WINDOW, the retry is sent with the SAME key. If TapAPI did get the first one, it just
+        #  answers with the same response (so, for example, the canteen doesn't charge the student twice).
+        # The same payload after RETRY_WINDOW (or after forget_unacknowledged()) is a new purchase, not a retry, and
+        #  TapAPI would otherwise answer it with the old response for as long as it keeps the key (a day by default)
+        is_retry = (json_str == self._unacknowledged_payload
+                    and utime.ticks_diff(utime.ticks_ms(), self._unacknowledged_at) < self.RETRY_WINDOW)
+        if not is_retry:
+            self._unacknowledged_payload = json_str
+            self._idempotency_key = new_idempotency_key()
+            self._unacknowledged_uid = payload.get("uid")
+        self._unacknowledged_at = utime.ticks_ms()
+
+        cmd = f"POST {route} HTTP/1.1\r\nHost: {ip}\r\nContent-Type: application/json\r\nIdempotency-Key: {self._idempotency_key}\r\nContent-Length: {len(json_str)}\r\n\r\n{json_str}"
+        resp = self._response(self._request(cmd, timeout))
+
+        # Got a final answer, so the next payload is a new transaction even if it looks exactly the same. A 409 (the
+        #  first request is still being processed) or a 5xx isn't final, so the retry has to keep the same key: TapAPI
+        #  only lets a 5xx run the plug-in again if it didn't change anything, otherwise (ex. the plug-in timed out
+        #  but kept running) it stores the plug-in's real response under this key for the retry.
+        if resp and (200 <= resp.response_code < 300 or 400 <= resp.response_code < 500) and resp.response_code != 409:
+            self.forget_unacknowledged()
+
+        return resp
+
+    def forget_unacknowledged(self, uid: str = None) -> None:
+        """
+        Make the next post() a new transaction, even if its payload is the same as the last unanswered one. Call it
+         when the user cancels, or when a card is tapped (with its UID, so only another card's payload is forgotten).
+
+        :param uid: The formatted UID of the card that was tapped, None to always forget
+        """
+        if uid is not None and uid == self._unacknowledged_uid:
+            return
+
+        self._unacknowledged_payload = None
+        self._idempotency_key = None
+        self._unacknowledged_uid = None
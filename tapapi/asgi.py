@@ -0,0 +1,176 @@
+# Async (ASGI) serving mode for TapAPI
+#
+# main.py runs TapAPI on Flask, where every request takes up a whole thread until it's done (even while it's just
+#  waiting for Postgres or Google Sheets). This file serves the exact same routes with Quart, which is basically
+#  async Flask, on top of uvicorn. While a request waits on something, the event loop serves other requests, so
+#  a single process can hold hundreds of Ground Module requests in flight.
+#  Read more: https://quart.palletsprojects.com/en/latest/ and https://www.uvicorn.org
+#
+# Needs "pip install quart uvicorn". Launch it with the same arguments as main.py, for example:
+#  python3.9 asgi.py -user <user> -pass <pass> --port 8000
+#
+# Plug-ins don't need to change at all. Events are handled by the same code as in main.py (main._process_event()), in
+#  a worker thread. Regular run() functions run in their plug-in's threads, while plug-ins that define
+#  "async def run(...)" run on this event loop and get a utils.AsyncConnection (see utils/async_db.py).
+
+import asyncio
+import functools
+import uvicorn
+import utils
+import main
+from datetime import datetime
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, Response, request, jsonify, render_template
+
+# Reuse everything main.py set up on import (arguments, logger, plug-ins, database pool, caches...)
+log = main.log
+args = main.args
+
+app = Quart(__name__)
+
+# Psycopg2 (and JWT verification, and sync plug-ins) block, so they run in these threads instead of the event loop
+# A request that holds a database connection uses at most one thread at a time, so one thread per connection is enough
+db_executor = ThreadPoolExecutor(max_workers=args.pool_size, thread_name_prefix="tapapi-db")
+
+# /event requests run main._process_event() in these threads. They're separate from the db_executor because a request
+#  waiting here for an async plug-in needs a db_executor thread free for that plug-in's queries.
+event_executor = ThreadPoolExecutor(max_workers=args.pool_size, thread_name_prefix="tapapi-event")
+
+# Requests wait here (which costs nothing but a bit of memory) instead of in a thread for a free connection.
+# Otherwise, the threads could all end up waiting for connections held by requests that need a thread to finish!
+# Created on startup because asyncio objects belong to the event loop that's running
+db_slots = None
+
+
+@app.before_serving
+async def create_db_slots():
+    global db_slots
+    db_slots = asyncio.Semaphore(args.pool_size)
+
+
+@app.after_serving
+async def shutdown_executors():
+    # Also stops what main.py started here. gunicorn does call serve.py's worker_exit for uvicorn workers, but only
+    #  once the worker returns, and uvicorn 0.29 and later raise the SIGTERM again once they've shut down, which kills
+    #  the worker before worker_exit (or any atexit handler) runs. When worker_exit does run (ex. with the uvicorn in
+    #  the Pipfile), it stops everything a second time, which does nothing (every stop below can be called more than
+    #  once).
+    db_executor.shutdown(wait=False)
+    event_executor.shutdown(wait=False)
+    main.metrics_writer.stop()
+    if main.journal is not None:
+        main.journal.stop()
+    main.key_pool.shutdown()
+    if main.verify_executor is not None:
+        main.verify_executor.shutdown()
+    main.db_pool.close()
+
+
+async def run_blocking(func, *func_args, **kwargs):
+    """Runs a blocking function in the db_executor and awaits its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *func_args, **kwargs))
+
+
+@asynccontextmanager
+async def db_slot():
+    """
+    Wait for one of the --pool-size database slots. Code running inside the async with block (and the blocking
+     functions it runs) may use ONE connection from main.db_pool without ever waiting for it.
+
+    Raises a utils.PoolTimeoutError if no slot frees up within --pool-timeout seconds, just like the pool does
+    """
+    try:
+        await asyncio.wait_for(db_slots.acquire(), timeout=args.pool_timeout)
+    except asyncio.TimeoutError:
+        raise utils.PoolTimeoutError(f"No database connection available after {args.pool_timeout} seconds")
+
+    try:
+        yield
+    finally:
+        db_slots.release()
+
+
+def _respond(body, response_code: int):
+    """Turns a (body, response_code) into a Quart response. Dict bodies are sent as JSON, strings as text."""
+    if type(body) == dict:
+        return jsonify(body), response_code
+    return Response(body, response_code)
+
+
+@app.errorhandler(utils.PoolTimeoutError)
+@app.errorhandler(utils.VerifyExecutorError)
+@app.errorhandler(utils.JournalError)
+async def server_busy(error):
+    return _respond(*main._busy_response(error))
+
+
+@app.route('/')
+async def home_page():
+    return jsonify(main._home()), 200
+
+
+@app.route("/event", methods=["PUT", "POST"])
+async def route_event():
+    started = main.latency.start()
+    raw_body = await request.get_data()
+    loop = asyncio.get_running_loop()
+
+    # The event is handled exactly like in main.py, by main._process_event() in one of the event_executor's threads.
+    #  Async plug-ins still run on this event loop (with their queries in the db_executor), while the thread waits.
+    async with db_slot():
+        body, response_code, event_label = await loop.run_in_executor(
+            event_executor,
+            functools.partial(main._process_event, raw_body, request.headers, loop=loop, async_executor=db_executor)
+        )
+
+    return main._respond_event(_respond, started, body, response_code, event_label)
+
+
+@app.route("/events/batch", methods=["POST"])
+async def route_event_batch():
+    payloads = await request.get_json()
+
+    # A batch runs on a single connection from start to finish, so the whole thing runs in one thread
+    async with db_slot():
+        return _respond(*await run_blocking(main._handle_batch, payloads))
+
+
+@app.route("/metrics", methods=["POST"])
+async def status():
+    # Metrics are only queued (see utils/metrics_writer.py), so this doesn't block and can run on the event loop
+    return _respond(*main._handle_metrics_payload(await request.get_json()))
+
+
+@app.route("/stats")
+async def stats():
+    return jsonify(main._stats()), 200
+
+
+@app.route("/stats/prometheus")
+async def prometheus_stats():
+    return Response(main._prometheus_stats(), 200, mimetype="text/plain")
+
+
+@app.route("/library")
+async def library_home_page():
+    return await render_template("library_tracker.html")
+
+
+@app.route("/library/uid", methods=["GET", "POST"])
+async def library_uid():
+    log.info("Library UID request received.")
+
+    async with db_slot():
+        books = await run_blocking(main._library_books, request.args['uid'])
+
+    if books is not None:
+        return await render_template("library_tracker_success.html", books=books, now=datetime.now())
+    else:
+        return await render_template("library_tracker.html", error=True)
+
+
+if __name__ == '__main__':
+    log.info(f'Welcome to TapAPI (async mode)! Running on port {args.port}, debug level {args.level}')
+    uvicorn.run(app, port=args.port, host="0.0.0.0")
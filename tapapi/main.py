@@ -1,6 +1,10 @@
 # Made by Enrique Villa, Grade 12 Da Vinci, SY 2022-2023
 
 import re
+import atexit
+import concurrent.futures
+import asyncio
+import inspect
 import logging
 import utils
 import psycopg2
@@ -11,8 +15,9 @@ from datetime import datetime as dt
 from plugins.plugin_utils.library_utils import get_books_from_uid
 from utils.configure_logger import configure_logger
 from utils.configure_argparse import configure_argparse
+from utils.parse_payload import TapAPIRequestPayload
 from utils.responses.PluginResponse import PluginResponse
-from flask import Flask, Response, request, abort, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 
 # Set up the Flask server
 # A good Flask tutorial: https://www.youtube.com/watch?v=Z1RJmh_OqeA&t=2358s
@@ -44,7 +49,21 @@ log.debug('Logging and basic server setup complete! Re-run with -h or --help fla
 
 log.info('Loading plugins...')
 with open('config.json', 'r') as f:
-    plugin_dict, config_dict = utils.load_plugins(f=f, logger=log)
+    plugin_registry, config_dict = utils.load_plugins(f=f, args=args)
+
+# {event_name: function} dictionaries of the plug-ins' run(), run_batch() and acknowledge() functions
+# Plug-ins listed with their event_name in config.json are only imported once one of their functions is looked up
+#  (see utils/plugin_registry.py)
+plugin_dict = plugin_registry.run_funcs
+batch_plugin_dict = plugin_registry.batch_funcs
+deferred_plugin_dict = plugin_registry.ack_funcs
+
+# Slow imports show up here (for a breakdown of a single plug-in's imports, run python3.9 -X importtime main.py ...)
+log.info(f'Plug-ins:\n{plugin_registry.report()}')
+plugin_registry.start_background()
+
+# Checks every /event payload (and the event_data schemas the plug-ins declare) while decoding it
+payload_decoder = utils.PayloadDecoder(plugin_registry.event_data_schemas)
 
 
 def create_connection():
@@ -55,97 +74,721 @@ def create_connection():
                             database="tapid")
 
 
-if not utils.is_db_valid(create_connection()):
-    logging.critical("Database is invalid! Are you sure it has the proper tables? Consider running "
-                     "extras/make_databases.py")
+# Instead of opening a new connection for every request, TapAPI keeps a pool of open connections around
+# Use "with db_pool.connection() as conn:" to borrow one (see utils/connection_pool.py)
+db_pool = utils.ConnectionPool(create_connection, max_size=args.pool_size, timeout=args.pool_timeout)
+
+with db_pool.connection() as _conn:
+    if args.migrate:
+        _applied = utils.migrate(_conn)
+        log.warning(f'Database is at version {utils.LATEST_VERSION} ({len(_applied)} migration(s) applied).')
+
+    # Only looks at the tables' descriptions, not their rows, so it's just as fast on a big database
+    _db_valid = utils.is_db_valid(_conn)
+
+if not _db_valid:
+    logging.critical("Database is invalid! Run TapAPI with --migrate (or extras/migrate_database.py) to create the "
+                     "missing tables and indexes, or extras/make_databases.py for a new database.")
     exit()
 
+# Decoded claims of recently verified JWTs, so repeat taps of the same card skip the signature check
+token_cache = utils.VerifiedTokenCache(max_size=args.token_cache_size, ttl=args.token_cache_ttl)
+
+# Parsed public keys of recently seen cards, so repeat taps skip the database and the PEM parsing
+# Invalidating a key (ex. when it is rotated) also purges the UID's verified JWT from the token_cache
+key_cache = utils.PublicKeyCache(max_size=args.key_cache_size, ttl=args.key_cache_ttl, dependents=[token_cache])
+
+with db_pool.connection() as _conn:
+    log.info(f'Warmed up the public key cache with {key_cache.warm(_conn)} keys')
+
+# RSA key pairs for new cards are generated ahead of time in background processes
+# ES256 and EdDSA key pairs take well under a millisecond to make, so with those the pool stays empty (a target_size of
+#  0 never starts the background processes) and new cards get their key pair made right away
+key_pool = utils.KeyPairPool(target_size=args.key_pool_size if args.key_algorithm == 'RS256' else 0,
+                             workers=args.key_pool_workers)
+key_pool.start()
+atexit.register(key_pool.shutdown)
+
+# Optionally, JWT signatures can be verified in worker processes so auth isn't limited to a single CPU core
+verify_executor = None
+if args.verify_mode == 'process':
+    verify_executor = utils.VerifyExecutor(
+        workers=args.verify_workers,
+        max_pending=args.verify_max_pending,
+        timeout=args.verify_timeout,
+        preloaded=key_cache.pems()
+    )
+    atexit.register(verify_executor.shutdown)
+
+# Taps of the same card run one at a time and in order, while taps of different cards run in parallel (see
+#  utils/keyed_executor.py). The plug-ins run in their bulkhead's threads (see _submit_plugin()), so the
+#  KeyedExecutor never starts threads of its own.
+keyed_executor = utils.KeyedExecutor()
+
+
+def _create_bulkhead(event_name: str):
+    """The plug-in's limits come from its entry in config.json, or the --plugin-* arguments if it doesn't set them"""
+    options = plugin_registry.options(event_name)
+    return utils.Bulkhead(
+        event_name,
+        max_concurrency=options.get("max_concurrency", args.plugin_max_concurrency or args.pool_size),
+        max_queue=options.get("max_queue", args.plugin_max_queue),
+        timeout=options.get("timeout", args.plugin_timeout)
+    )
 
-@app.route('/')
-def home_page():
-    payload = {
+
+# Every plug-in runs in its own threads, with a limit on how many of its events run or wait at once and on how long
+#  they're waited for, so a slow plug-in can't hold up the others (see utils/bulkhead.py)
+bulkheads = {event_name: _create_bulkhead(event_name) for event_name in plugin_registry.event_names()}
+
+# Responses to events sent with an Idempotency-Key header, so retried taps don't run the plug-in twice
+idempotency_store = utils.IdempotencyStore(window=args.idempotency_window, cache_size=args.idempotency_cache_size)
+
+# Ground Module metrics are queued and written to the database in batches by a background thread
+metrics_writer = utils.MetricsWriter(
+    db_pool,
+    max_queue=args.metrics_queue_size,
+    batch_size=args.metrics_batch_size,
+    flush_interval=args.metrics_flush_interval,
+    spill_path=args.metrics_spill_file
+)
+atexit.register(metrics_writer.stop)
+
+# Histograms of how long each stage of an event takes (parsing, key lookup, verification, plug-in, response), per
+#  event_name. When disabled, the timing calls return right away.
+latency = utils.LatencyRecorder(enabled=not args.no_latency_stats)
+
+
+def _apply_journal_records(records: list) -> None:
+    """
+    Writes events saved to the event journal to the database, with the run_batch() function of their plug-in.
+    Raises an exception if any of them couldn't be written, so the journal tries the whole batch again later.
+    """
+    # Journaled events, grouped by their event_name: {event_name: [(jwt_decoded, payload_data), ...]}
+    groups = {}
+
+    for record in records:
+        if record["event_name"] not in deferred_plugin_dict:
+            log.critical(f'The event journal has an event of \"{record["event_name"]}\", which isn\'t a deferrable '
+                         f'plug-in anymore. Skipping it.')
+            continue
+
+        payload_data = TapAPIRequestPayload(jwt="", event_name=record["event_name"], uid=record["uid"],
+                                            event_data=record["event_data"],
+                                            received_at=datetime.fromisoformat(record["received_at"]))
+        groups.setdefault(record["event_name"], []).append((record["jwt_decoded"], payload_data))
+
+    with db_pool.connection() as conn:
+        for event_name, items in groups.items():
+            responses = batch_plugin_dict[event_name](items=items, args=args, conn=conn)
+            failed = sum(1 for resp in responses if resp.response_code >= 500)
+
+            if failed:
+                raise RuntimeError(f'{event_name}\'s run_batch() failed on {failed} of {len(items)} journaled events')
+
+
+# With --journal-dir, events of deferrable plug-ins are saved to a journal on disk and answered right away, then
+#  written to the database in batches by a background thread (see utils/journal.py)
+journal = None
+if args.journal_dir is not None:
+    journal = utils.EventJournal(
+        args.journal_dir,
+        apply=_apply_journal_records,
+        batch_size=args.journal_batch_size,
+        max_bytes=args.journal_max_bytes
+    )
+    # Write the events that a previous run of TapAPI accepted but didn't get to write to the database
+    journal.start()
+    atexit.register(journal.stop)
+
+
+def _busy_response(error):
+    """
+    Turns the errors raised when TapAPI is overloaded into a (message, response_code)
+    (shared by the Flask app and the async app in asgi.py)
+    """
+    if isinstance(error, utils.PoolTimeoutError):
+        # Every database connection is busy and none was given back in time (see --pool-size and --pool-timeout)
+        log.critical(f'503: {error}. Consider raising --pool-size.')
+        return "Server busy, try again.", 503
+    elif isinstance(error, utils.VerifyOverloadedError):
+        log.critical(f'503: {error}. Consider raising --verify-workers or --verify-max-pending.')
+        return "Server busy, try again.", 503
+    elif isinstance(error, utils.JournalError):
+        # The event couldn't be saved, so it must not be acknowledged (the Ground Module will send it again)
+        log.critical(f'503: {error}. Check the disk of --journal-dir.')
+        return "Server busy, try again.", 503
+    else:
+        log.critical(f'504: {error}.')
+        return "Authentication timed out, try again.", 504
+
+
+def _respond(body, response_code: int):
+    """Turns a (body, response_code) into a Flask response. Dict bodies are sent as JSON, strings as text."""
+    if type(body) == dict:
+        return jsonify(body), response_code
+    return Response(body, response_code)
+
+
+@app.errorhandler(utils.PoolTimeoutError)
+@app.errorhandler(utils.VerifyExecutorError)
+@app.errorhandler(utils.JournalError)
+def server_busy(error):
+    return _respond(*_busy_response(error))
+
+
+def _home():
+    return {
         "api_version": config_dict.get('version', 'unknown'),
         "status": "online"
     }
-    return jsonify(payload), 200
+
+
+@app.route('/')
+def home_page():
+    return jsonify(_home()), 200
+
+
+def _event_label(event_name: str) -> str:
+    """The event_name latency is recorded under (unknown event names all share one, so they can't flood /stats)"""
+    return event_name if event_name in plugin_registry else 'unknown'
+
+
+def _parse_event_payload(body: bytes):
+    """
+    :param body: The raw body of the request
+    :return: (payload_data, None) if the payload follows the TapAPI format, (None, (message, response_code)) if not
+    """
+    started = latency.start()
+    try:
+        payload_data = payload_decoder.decode(body)
+    except utils.PayloadError as e:
+        log.warning(f'400: Invalid payload, {e}.')
+        return None, (f"Invalid payload: {e}. Follow the format detailed in the GitHub page.", 400)
+
+    log.info(f'Received POST/PUT request with a "{payload_data.event_name}" event.')
+
+    latency.observe('parse', _event_label(payload_data.event_name), started)
+    return payload_data, None
+
+
+def _check_event_data(payload_data):
+    """
+    Checks the event_data against the plug-in's event_data_schema. Only called once the card is authenticated, since
+     it imports the plug-in (see utils/payload_decoder.py).
+
+    :return: None if the event_data is fine, (message, response_code) if not
+    """
+    try:
+        payload_decoder.check_event_data(payload_data)
+    except utils.PayloadError as e:
+        log.warning(f'400: Invalid payload, {e}.')
+        return f"Invalid payload: {e}. Follow the format detailed in the GitHub page.", 400
+
+    return None
+
+
+def _get_idempotency_key(headers):
+    """
+    :return: (idempotency_key or None if there is none, None) if the key is valid, (None, (message, response_code)) if
+     it isn't
+    """
+    key = headers.get(utils.IDEMPOTENCY_HEADER)
+
+    if key is not None and not 0 < len(key) <= utils.MAX_KEY_LENGTH:
+        log.warning('400: Invalid idempotency key.')
+        return None, (f"Invalid {utils.IDEMPOTENCY_HEADER}. It must be 1 to {utils.MAX_KEY_LENGTH} characters.", 400)
+
+    return key, None
 
 
 @app.route("/event", methods=["PUT", "POST"])
 def route_event():
-    payload = request.get_json()
+    started = latency.start()
+    body, response_code, event_label = _process_event(request.get_data(), request.headers)
+    return _respond_event(_respond, started, body, response_code, event_label)
+
+
+def _process_event(raw_body: bytes, headers, loop=None, async_executor=None):
+    """
+    Everything /event does, from the raw body of the request to its response. The Flask route above and the async app
+     in asgi.py (which runs this in a worker thread) both use it, so only how they read and answer requests differs.
+
+    :param raw_body: The raw body of the request
+    :param headers: The request's headers
+    :param loop: asgi.py's event loop, where async plug-ins run (see _run_plugin())
+    :param async_executor: Where the AsyncConnection of an async plug-in runs its queries (see utils/async_db.py)
+    :return: (body, response_code, event_label), event_label being what latency is recorded under
+    """
+    payload_data, error = _parse_event_payload(raw_body)
+
+    if error:
+        return (*error, _event_label(None))
+
+    event_label = _event_label(payload_data.event_name)
+    idempotency_key, error = _get_idempotency_key(headers)
+
+    if error:
+        return (*error, event_label)
 
     try:
-        log.info(f'Received POST/PUT request with payload, (keys: {", ".join(list(payload.keys()))}).')
-        payload_data = utils.parse_payload(payload)
-    except (KeyError, AttributeError):
-        log.warning('400: Invalid payload.')
-        abort(Response("Invalid payload. Follow the format detailed in the GitHub page.", 400))
-        return
+        # Borrow a connection from the pool, it is given back automatically once the with block ends
+        with db_pool.connection() as conn:
+            body, response_code = _handle_event(payload_data, conn, idempotency_key=idempotency_key, loop=loop,
+                                                async_executor=async_executor)
+    except (utils.PoolTimeoutError, utils.VerifyExecutorError, utils.JournalError) as e:
+        body, response_code = _busy_response(e)
+
+    return body, response_code, event_label
+
 
-    conn = create_connection()
+def _respond_event(respond, started: float, body, response_code: int, event_label: str):
+    """
+    Turns what _process_event() returned into a response with respond (the _respond() of the Flask or the async app),
+     recording how long that took and how long the whole request took
+    """
+    responding = latency.start()
+    response = respond(body, response_code)
+
+    latency.observe('respond', event_label, responding)
+    latency.observe('total', event_label, started)
+    return response
+
+
+def _verify_card_jwt(payload_data, conn):
+    """
+    Verify (decrypt) the attached JWT with the public key associated with the UID.
+    The signature check is skipped if the exact same JWT was verified for the UID recently (see token_cache).
 
-    # If the payload is in the correct format, get the UID's public key
-    public_key = utils.authentication.get_public_key_from_uid(
+    :return: The decoded JWT, or None if the UID's public key couldn't be loaded
+    """
+    jwt_decoded = token_cache.get_claims(payload_data.uid, payload_data.jwt)
+
+    if jwt_decoded is not None:
+        log.info(f'JWT of \"{payload_data.uid}\" was already verified recently, skipping the signature check')
+        return jwt_decoded
+
+    event_label = _event_label(payload_data.event_name)
+
+    # Get the UID's public key
+    started = latency.start()
+    public_key = utils.authentication.get_cached_public_key_from_uid(
         uid=payload_data.uid,
-        conn=conn
+        conn=conn,
+        cache=key_cache,
+        key_pool=key_pool,
+        algorithm=args.key_algorithm
     )
 
-    try:
-        # Verify (decrypt) the attached JWT with the public key associated with the UID
+    latency.observe('key_lookup', event_label, started)
+
+    if public_key is None:
+        return None
+
+    started = latency.start()
+    if verify_executor is not None:
+        jwt_decoded = verify_executor.verify(
+            uid=payload_data.uid,
+            public_key=public_key,
+            json_web_token=payload_data.jwt
+        )
+    else:
         jwt_decoded = utils.authentication.verify_jwt_with_public_key(
             json_web_token=payload_data.jwt,
-            public_key=bytes(public_key, 'utf-8')
+            public_key=public_key
         )
-        log.info(f'Successfully authenticated \"{payload_data.uid}\"s JWT! Checking validity...')
 
-        # Check if the JWT is valid (has the right format)
-        if not utils.is_jwt_valid(jwt_decoded=jwt_decoded):
-            log.critical(f"Invalid JWT detected from {payload_data.uid}!")
-            return Response("Invalid JWT.", 400)
+    # Only reached if the signature checked out (verifying raises an exception otherwise)
+    latency.observe('jwt_verify', event_label, started)
+    token_cache.put_claims(payload_data.uid, payload_data.jwt, jwt_decoded)
+    return jwt_decoded
+
+
+def _authenticate(payload_data, conn):
+    """
+    Runs every check a card has to pass before its event is handed to a plug-in
+
+    :return: (jwt_decoded, None) with the password removed from jwt_decoded if the card passed,
+     or (None, (message, response_code)) if it didn't
+    """
+    try:
+        # If the payload is in the correct format, verify the JWT with the UID's public key
+        jwt_decoded = _verify_card_jwt(payload_data, conn)
+    except (jwt.exceptions.InvalidSignatureError, jwt.exceptions.InvalidAlgorithmError):
+        # If the card doesn't decrypt properly (or was signed with a different algorithm than its key's), something
+        #  is suspicious!
+        log.critical(f'Invalid signature detected. Investigate card {payload_data.uid} immediately!')
+        return None, ("Invalid signature. Card UID does not decrypt properly.", 403)
+    except jwt.exceptions.InvalidTokenError:
+        # The JWT is malformed (ex. a card that wasn't read completely) or has expired
+        log.critical(f"Invalid JWT detected from {payload_data.uid}!")
+        return None, ("Invalid JWT.", 400)
+
+    if jwt_decoded is None:
+        log.critical(f'Could not get the public key of {payload_data.uid}. Check the database!')
+        return None, ("Internal server error.", 500)
+
+    log.info(f'Successfully authenticated \"{payload_data.uid}\"s JWT! Checking validity...')
+
+    # Check if the JWT is valid (has the right format)
+    if not utils.is_jwt_valid(jwt_decoded=jwt_decoded):
+        log.critical(f"Invalid JWT detected from {payload_data.uid}!")
+        return None, ("Invalid JWT.", 400)
+
+    log.info('JWT is valid.')
+
+    # Check if the password present in the JWT is correct
+    if jwt_decoded["pass"] != environ.get("TAPID_JWT_PASSWORD", None):
+        log.critical(f"Invalid password detected from {payload_data.uid}!")
+        return None, ("Invalid password.", 401)
+
+    log.info('Correct pass in JWT.')
+
+    # Plug-ins only ever get the password-removed JWT
+    jwt_decoded.pop("pass")
+    return jwt_decoded, None
 
-        log.info('JWT is valid.')
 
-        # Check if the password present in the JWT is correct
-        if jwt_decoded["pass"] != environ.get("TAPID_JWT_PASSWORD", None):
-            log.critical(f"Invalid password detected from {payload_data.uid}!")
-            return Response("Invalid password.", 401)
+def _run_plugin(event_func, jwt_decoded: dict, payload_data, conn, loop=None, async_executor=None,
+                timeout: float = None):
+    """
+    Runs a plug-in's run() function. Plug-ins may also define it as "async def run(...)", in which case they get a
+     utils.AsyncConnection instead of the plain Psycopg2 connection (see utils/async_db.py).
+
+    :param loop: An event loop running in another thread (asgi.py's) to run async plug-ins on, instead of starting one
+    :param async_executor: See _process_event()
+    :param timeout: Seconds to wait for an async plug-in running on loop before giving up on it
+    """
+    if inspect.iscoroutinefunction(event_func):
+        coroutine = event_func(jwt_decoded=jwt_decoded, payload_data=payload_data, args=args,
+                               conn=utils.AsyncConnection(conn, executor=async_executor))
+
+        if loop is None:
+            # We're not running inside an event loop here, so start one just for this plug-in
+            return asyncio.run(coroutine)
+
+        # The coroutine runs on the server's event loop, this thread just waits for it (and holds the card's turn)
+        future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            # Without a limit, a stuck event loop would hold this card's turn (and the thread) forever
+            future.cancel()
+            # It may still be in the middle of a query, so the pool throws the connection away instead of reusing it
+            conn.close()
+            raise
+
+    return event_func(jwt_decoded=jwt_decoded, payload_data=payload_data, args=args, conn=conn)
+
+
+def _is_deferred(event_name: str) -> bool:
+    """Whether events with this event_name are saved to the event journal instead of running the plug-in right away"""
+    return journal is not None and event_name in deferred_plugin_dict
+
+
+def _defer_event(jwt_decoded: dict, payload_data, conn=None, idempotency_key: str = None):
+    """
+    Saves the event of a deferrable plug-in to the event journal and returns the plug-in's acknowledge() response,
+     without waiting for the database (the journal writes the event there in the background)
+
+    If saving it takes too long but it may still be saved, the JournalError is raised with the key still claimed. Like
+     a plug-in that timed out (see _plugin_timed_out()), the response is stored under the key once the event is on
+     disk, so a retry gets it instead of saving the event a second time.
+    """
+    payload_data.received_at = datetime.now()
+    resp = deferred_plugin_dict[payload_data.event_name](jwt_decoded=jwt_decoded, payload_data=payload_data, args=args)
+
+    # Only returns once the event is safely on disk, raises a JournalError otherwise
+    try:
+        journal.append({
+            "event_name": payload_data.event_name,
+            "uid": payload_data.uid,
+            "jwt_decoded": jwt_decoded,
+            "event_data": payload_data.event_data,
+            "received_at": payload_data.received_at.isoformat()
+        })
+    except utils.JournalError as e:
+        if e.write is not None and idempotency_key is not None:
+            def store_response(write):
+                if write.cancelled() or write.exception() is not None:
+                    idempotency_store.abandon(payload_data.uid, idempotency_key, conn)
+                    return
+                body, response_code = _plugin_response(payload_data.event_name, resp)
+                idempotency_store.finish(payload_data.uid, idempotency_key, payload_data.event_name, body,
+                                         response_code, conn)
+
+            # Added before keep_until_done(), so it runs before the connection goes back to the pool
+            e.write.add_done_callback(store_response)
+            db_pool.keep_until_done(conn, e.write)
+        raise
+
+    return resp
+
+
+def _submit_plugin(event_name: str, uid: str, fn, *fn_args, **kwargs):
+    """
+    Runs fn(*fn_args, **kwargs) in the bulkhead of the event's plug-in, after the card's earlier taps are done
+
+    :return: A Future with what fn returned, or None if the plug-in's bulkhead is full
+    """
+    bulkhead = bulkheads[event_name]
 
-        log.info('Correct pass in JWT.')
+    if not bulkhead.admit():
+        log.critical(f'503: Too many \"{event_name}\" events running or waiting. Consider raising its '
+                     f'max_concurrency or max_queue in config.json.')
+        return None
 
-        # Now grab the run() function of the event being requested
-        event_func = plugin_dict.get(payload_data.event_name, None)
+    # Waits for this card's earlier taps to finish first (ex. so two canteen debits can't overlap)
+    return keyed_executor.submit_to(bulkhead, uid, fn, *fn_args, **kwargs)
 
-        # If the plug-in was configured properly, the plugin_dict should have the event's run() function
-        if event_func:
 
-            log.info(f'Imported {payload_data.event_name}\'s run() function, running it')
+def _plugin_busy() -> PluginResponse:
+    return PluginResponse(503, payload={"msg": "server busy, try again"})
 
-            # Run the run() function with the password-removed JWT
-            jwt_decoded.pop("pass")
-            resp = event_func(jwt_decoded=jwt_decoded, payload_data=payload_data, args=args, conn=create_connection())
 
-            log.info(f'\"{payload_data.event_name}\" ran successfully!')
+def _plugin_timed_out(future, payload_data, conn, idempotency_key: str = None):
+    """
+    Called once an event's plug-in took longer than its bulkhead's timeout. If it hadn't started yet, it never will.
+     If it's already running it can't be stopped, so it keeps the connection until it's done and (if the event had an
+     idempotency key) its response is stored then, so a retry doesn't run the plug-in again.
+
+    :return: (PluginResponse, still_running)
+    """
+    bulkhead = bulkheads[payload_data.event_name]
+    bulkhead.timed_out()
+    log.critical(f'504: \"{payload_data.event_name}\" took longer than {bulkhead.timeout} seconds.')
+
+    still_running = not future.cancel()
+
+    if still_running:
+        if idempotency_key is not None:
+            def store_response(done):
+                retry_safe = True
+                try:
+                    body, response_code = _plugin_response(payload_data.event_name, done.result())
+                except concurrent.futures.TimeoutError:
+                    # An async plug-in that was given up on (see _run_plugin()) may have committed something before,
+                    #  so the retry gets this answer instead of running it again
+                    body, response_code, retry_safe = {"msg": "plug-in timed out"}, 504, False
+                except Exception:
+                    # The plug-in raised an error, so its transaction was rolled back and the retry can run it again
+                    body, response_code = None, None
+
+                def store(store_conn):
+                    if response_code is None:
+                        idempotency_store.abandon(payload_data.uid, idempotency_key, store_conn)
+                    else:
+                        idempotency_store.finish(payload_data.uid, idempotency_key, payload_data.event_name, body,
+                                                 response_code, store_conn, retry_safe=retry_safe)
+
+                if conn.closed:
+                    # An async plug-in that never finished has its connection closed (see _run_plugin())
+                    with db_pool.connection() as other_conn:
+                        store(other_conn)
+                else:
+                    store(conn)
+
+            # Added before keep_until_done(), so it runs before the connection goes back to the pool
+            future.add_done_callback(store_response)
+
+        db_pool.keep_until_done(conn, future)
+
+    return PluginResponse(504, payload={"msg": "plug-in timed out"}), still_running
+
+
+def _unknown_event(event_name: str):
+    # If the plug-in is not in the plugin_dict either it doesn't exist or wasn't setup properly
+    log.critical(f'Unknown event name \"{event_name}\"! Plug-in doesn\'t exist or improper '
+                 f'configuration of the event_name/Ground Module.')
+    return 'Unknown event name.', 400
+
+
+def _plugin_response(event_name: str, resp):
+    """Turns what a plug-in's run() returned into a (body, response_code)"""
+    log.info(f'\"{event_name}\" ran successfully!')
+
+    # It will only accept PluginResponses. If you try and return something else it will return a 501.
+    if type(resp) == PluginResponse:
+        log.info(f'Received PluginResponse from \"{event_name}\"')
+        return resp.payload, resp.response_code
+    else:
+        log.critical('Invalid plug-in return type. TapAPI plug-ins should only return a PluginResponse.')
+        return 'Invalid plug-in return type.', 501
+
 
-            # It will only accept PluginResponses. If you try and return something else it will return a 501.
-            if type(resp) == PluginResponse:
-                log.info(f'Received PluginResponse from \"{payload_data.event_name}\"')
-                return jsonify(resp.payload), resp.response_code
+def _handle_event(payload_data, conn, idempotency_key: str = None, loop=None, async_executor=None):
+    """
+    Authenticates the card and runs the requested plug-in using a connection borrowed from db_pool
+
+    :param idempotency_key: If the same card already sent an event with this key, its response is sent back instead of
+     running the plug-in again (see utils/idempotency.py)
+    :param loop: See _process_event()
+    :param async_executor: See _process_event()
+    :return: (body, response_code) where body is a dict (sent as JSON) or a string (sent as text)
+    """
+    jwt_decoded, error = _authenticate(payload_data, conn)
+
+    if error:
+        return error
+
+    # Now grab the run() function of the event being requested
+    event_func = plugin_dict.get(payload_data.event_name, None)
+
+    # If the plug-in was configured properly, the plugin_dict should have the event's run() function
+    if not event_func:
+        return _unknown_event(payload_data.event_name)
+
+    error = _check_event_data(payload_data)
+    if error:
+        return error
+
+    if idempotency_key is not None:
+        # Only checked once the card is authenticated, so nobody else can get its stored responses
+        replay = idempotency_store.begin(payload_data.uid, idempotency_key, payload_data.event_name, conn)
+        if replay is not None:
+            return replay
+
+    log.info(f'Imported {payload_data.event_name}\'s run() function, running it')
+
+    # Run the run() function with the password-removed JWT
+    started = latency.start()
+    still_running = False
+    try:
+        if _is_deferred(payload_data.event_name):
+            resp = _defer_event(jwt_decoded, payload_data, conn, idempotency_key)
+        else:
+            timeout = bulkheads[payload_data.event_name].timeout
+            # Taps of the same card run one at a time and in order, in the plug-in's bulkhead
+            future = _submit_plugin(payload_data.event_name, payload_data.uid, _run_plugin, event_func,
+                                    jwt_decoded=jwt_decoded, payload_data=payload_data, conn=conn, loop=loop,
+                                    async_executor=async_executor, timeout=timeout)
+            if future is None:
+                resp = _plugin_busy()
             else:
-                log.critical('Invalid plug-in return type. TapAPI plug-ins should only return a PluginResponse.')
-                return Response('Invalid plug-in return type.', 501)
+                try:
+                    resp = future.result(timeout=timeout)
+                except concurrent.futures.TimeoutError:
+                    resp, still_running = _plugin_timed_out(future, payload_data, conn, idempotency_key)
+    except Exception as e:
+        # A journal write that may still finish stores its response under the key itself (see _defer_event())
+        if idempotency_key is not None and not (isinstance(e, utils.JournalError) and e.write is not None):
+            idempotency_store.abandon(payload_data.uid, idempotency_key, conn)
+        raise
+    latency.observe('plugin', _event_label(payload_data.event_name), started)
+
+    body, response_code = _plugin_response(payload_data.event_name, resp)
+
+    # A plug-in that is still running stores its own response once it's done (see _plugin_timed_out())
+    if idempotency_key is not None and not still_running:
+        idempotency_store.finish(payload_data.uid, idempotency_key, payload_data.event_name, body, response_code, conn)
+
+    return body, response_code
+
+
+def _batch_result(response_code: int, payload: dict) -> dict:
+    """One item of the /events/batch response"""
+    return {"response_code": response_code, "payload": payload}
+
+
+def _run_plugin_batch(event_name: str, items: list, conn) -> list:
+    """
+    Runs a plug-in on a group of authenticated events that all have the same event_name
+
+    :param items: List of (jwt_decoded, payload_data)
+    :return: List of batch results, in the same order as items
+    """
+    batch_func = batch_plugin_dict.get(event_name, None)
+    started = latency.start()
+
+    try:
+        if batch_func:
+            # The plug-in handles the whole group at once (ex. in a single database transaction)
+            log.info(f'Running {event_name}\'s run_batch() function on {len(items)} events')
+            responses = batch_func(items=items, args=args, conn=conn)
         else:
-            # If the plug-in is not in the plugin_dict either it doesn't exist or wasn't setup properly
-            log.critical(f'Unknown event name \"{payload_data.event_name}\"! Plug-in doesn\'t exist or improper '
-                         f'configuration of the event_name/Ground Module.')
-            return Response('Unknown event name.', 400)
+            # Otherwise, fall back to running run() once per event (still on the same connection)
+            responses = [_run_plugin(plugin_dict[event_name], jwt_decoded=jwt_decoded, payload_data=payload_data,
+                                     conn=conn)
+                         for jwt_decoded, payload_data in items]
+    except Exception:
+        log.exception(f'\"{event_name}\" raised an error while running a batch')
+        return [_batch_result(500, {"msg": "internal server error"})] * len(items)
 
-    except jwt.exceptions.InvalidSignatureError:
-        # If the card doesn't decrypt properly, something is suspicious!
-        log.critical(f'Invalid signature detected. Investigate card {payload_data.uid} immediately!')
-        abort(Response("Invalid signature. Card UID does not decrypt properly.", 403))
+    latency.observe('plugin_batch', event_name, started)
+
+    if len(responses) != len(items) or any(type(resp) != PluginResponse for resp in responses):
+        log.critical('Invalid plug-in return type. TapAPI plug-ins should only return a PluginResponse per event.')
+        return [_batch_result(501, {"msg": "Invalid plug-in return type."})] * len(items)
+
+    return [_batch_result(resp.response_code, resp.payload) for resp in responses]
+
+
+@app.route("/events/batch", methods=["POST"])
+def route_event_batch():
+    """
+    Handles many TapAPI payloads in one request (ex. taps buffered by a Ground Module or a gateway).
+    The body is a JSON array of payloads, and the response has one result per payload, in the same order.
+    """
+    return _respond(*_handle_batch(request.get_json()))
+
+
+def _handle_batch(payloads):
+    """
+    :return: (body, response_code) of a /events/batch request
+    """
+    if type(payloads) != list:
+        log.warning('400: Batch payload is not a list.')
+        return "Invalid payload. A batch must be a JSON array of TapAPI payloads.", 400
+
+    if len(payloads) > args.max_batch_size:
+        log.warning(f'413: Batch of {len(payloads)} events is over --max-batch-size.')
+        return f"Too many events. Send at most {args.max_batch_size} per batch.", 413
 
-    # Always close the connection to free up resources
-    conn.close()
+    log.info(f'Received a batch of {len(payloads)} events.')
+
+    results = [None] * len(payloads)
+
+    # Authenticated events, grouped by their event_name: {event_name: [(index, jwt_decoded, payload_data), ...]}
+    groups = {}
+
+    with db_pool.connection() as conn:
+        for index, payload in enumerate(payloads):
+            try:
+                payload_data = payload_decoder.validate(payload)
+            except utils.PayloadError as e:
+                results[index] = _batch_result(400, {"msg": f"Invalid payload: {e}."})
+                continue
+
+            # Cards that appear more than once share the key lookup and signature check (see the caches)
+            jwt_decoded, error = _authenticate(payload_data, conn)
+
+            if error:
+                results[index] = _batch_result(error[1], {"msg": error[0]})
+                continue
+
+            if payload_data.event_name not in plugin_dict:
+                message, response_code = _unknown_event(payload_data.event_name)
+                results[index] = _batch_result(response_code, {"msg": message})
+                continue
+
+            error = _check_event_data(payload_data)
+            if error:
+                results[index] = _batch_result(error[1], {"msg": error[0]})
+                continue
+
+            groups.setdefault(payload_data.event_name, []).append((index, jwt_decoded, payload_data))
+
+        for event_name, group in groups.items():
+            group_results = _run_plugin_batch(
+                event_name,
+                [(jwt_decoded, payload_data) for _, jwt_decoded, payload_data in group],
+                conn
+            )
+
+            for (index, _, _), result in zip(group, group_results):
+                results[index] = result
+
+    return {"results": results}, 200
 
 
 @app.route("/metrics", methods=["POST"])
@@ -153,19 +796,76 @@ def status():
     """
     Handles Ground Module metrics
     """
-    payload = request.get_json()
+    return _respond(*_handle_metrics_payload(request.get_json()))
+
+
+def _handle_metrics_payload(payload):
+    """
+    :return: (body, response_code) of a /metrics request
+    """
     if ("event_name" in payload.keys()) and ("metric_data" in payload.keys()):
         logging.info(f"Received metrics payload from {payload['event_name']}!")
-        utils.handle_metrics(
-            conn=create_connection(),
-            metric_data=payload["metric_data"],
-            event_name=payload["event_name"]
-        )
+        # Only queued here, the metrics_writer inserts it into the database (with others) in the background
+        if not metrics_writer.submit(event_name=payload["event_name"], metric_data=payload["metric_data"]):
+            return "Server busy, try again.", 503
     else:
         # Metrics payload is invalid
         logging.warning("Received invalid metrics payload")
-        return Response('Invalid payload', 400)
-    return Response('OK', 200)
+        return 'Invalid payload', 400
+    return 'OK', 200
+
+
+def _stats():
+    return {
+        "db_pool": db_pool.stats(),
+        "key_cache": key_cache.stats(),
+        "token_cache": token_cache.stats(),
+        "key_pool": key_pool.stats(),
+        "verify_executor": verify_executor.stats() if verify_executor is not None else None,
+        "metrics_writer": metrics_writer.stats(),
+        "idempotency_cache": idempotency_store.stats(),
+        "keyed_executor": keyed_executor.stats(),
+        "bulkheads": {event_name: bulkhead.stats() for event_name, bulkhead in bulkheads.items()},
+        "plugins": plugin_registry.stats(),
+        "journal": journal.stats() if journal is not None else None,
+        "latency": latency.summary()
+    }
+
+
+def _prometheus_stats() -> str:
+    """The counters from _stats() and the latency histograms, in the Prometheus text format"""
+    lines = []
+
+    for section, counters in _stats().items():
+        for key, value in (counters or {}).items():
+            # Only plain numbers can be scraped (the latency summary is replaced by the full histograms below)
+            if type(value) in (int, float):
+                lines.append(f'tapapi_{section}_{key} {value}')
+            elif type(value) == dict:
+                # Sections with one set of counters per plug-in (ex. bulkheads) get the event_name as a label
+                for name, number in value.items():
+                    if type(number) in (int, float):
+                        lines.append(f'tapapi_{section}_{name}{{event_name="{key}"}} {number}')
+
+    return "\n".join(lines) + "\n" + latency.prometheus()
+
+
+@app.route("/stats")
+def stats():
+    """
+    Shows TapAPI's internal counters (ex. how many database connections are in use) and the p50/p95/p99 of how long
+     each stage of every event_name takes
+    """
+    return jsonify(_stats()), 200
+
+
+@app.route("/stats/prometheus")
+def prometheus_stats():
+    """
+    The same as /stats, but in a format that Prometheus can scrape (ex. to graph it with Grafana)
+    Read more: https://prometheus.io/docs/introduction/overview/
+    """
+    return Response(_prometheus_stats(), 200, mimetype="text/plain")
 
 
 @app.route("/library")
@@ -176,14 +876,24 @@ def library_home_page():
 @app.route("/library/uid", methods=["GET", "POST"])
 def library_uid():
     log.info("Library UID request received.")
-    result = re.fullmatch(r"([a-zA-Z0-9]{2} ?){4}", request.args['uid'])
-    if result:
-        books = get_books_from_uid(request.args['uid'].upper(), conn=create_connection())
+    books = _library_books(request.args['uid'])
+    if books is not None:
         return render_template("library_tracker_success.html", books=books, now=datetime.now())
     else:
         return render_template("library_tracker.html", error=True)
 
 
+def _library_books(uid: str):
+    """
+    :return: The books borrowed by the UID, or None if the UID isn't valid
+    """
+    result = re.fullmatch(r"([a-zA-Z0-9]{2} ?){4}", uid)
+    if result:
+        with db_pool.connection() as conn:
+            return get_books_from_uid(uid.upper(), conn=conn)
+    return None
+
+
 if __name__ == '__main__':
     log.info(f'Welcome to TapAPI! Running on port {args.port}, debug level {args.level}')
     # If you ever want to test the server on the same machine, do a requests.put/post on http://localhost:<port>
@@ -7,11 +7,42 @@ import psycopg2.errors
 
 event_name = "attendance"
 
+# Taps only need to end up in the attendance logs eventually, so with --journal-dir TapAPI answers with acknowledge()
+#  as soon as the tap is saved to its journal, and logs it into the database later with run_batch()
+deferrable = True
+
+
+def _time_now(received_at: datetime) -> str:
+    # Format time to Day (name) Day (number) Hour (24-hour):minute
+    return received_at.strftime("%a %d %H:%I")
+
+
+def acknowledge(jwt_decoded: dict, payload_data: TapAPIRequestPayload, args) -> PluginResponse:
+    """The response to a tap that was saved to the event journal (it can't use the database)"""
+    return PluginResponse(200, payload={"msg": "ok", "data": {"time_now": _time_now(payload_data.received_at)}})
+
 
 def run(jwt_decoded: dict, payload_data: TapAPIRequestPayload, args, conn) -> PluginResponse:
     try:
         attendance_utils.insert_into_attendance_logs(jwt_decoded["name"], payload_data.uid, conn)
-        # Format time to Day (name) Day (number) Hour (24-hour):minute
-        return PluginResponse(200, payload={"msg": "ok", "data": {"time_now": datetime.now().strftime("%a %d %H:%I")}})
+        return PluginResponse(200, payload={"msg": "ok", "data": {"time_now": _time_now(datetime.now())}})
     except psycopg2.errors.Error:
         return PluginResponse(500, payload={"msg": "internal server database error"})
+
+
+def run_batch(items: list, args, conn) -> list:
+    """
+    Logs many taps at once, items is a list of (jwt_decoded, payload_data)
+    Taps from the event journal are logged with the time they were received, not the time they're written.
+    """
+    now = datetime.now()
+    try:
+        attendance_utils.insert_many_into_attendance_logs(
+            [(jwt_decoded["name"], payload_data.uid, payload_data.received_at or now)
+             for jwt_decoded, payload_data in items],
+            conn
+        )
+        time_now = _time_now(now)
+        return [PluginResponse(200, payload={"msg": "ok", "data": {"time_now": time_now}}) for _ in items]
+    except psycopg2.errors.Error:
+        return [PluginResponse(500, payload={"msg": "internal server database error"}) for _ in items]
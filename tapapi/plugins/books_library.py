@@ -1,15 +1,15 @@
 import google.auth.exceptions
 
-from plugins.plugin_utils import library_utils
+from plugins.plugin_utils import library_utils, sheets_outbox
 from utils.parse_payload import TapAPIRequestPayload
 import os
 import logging
+import requests
+import psycopg2
 import psycopg2.errors
 from utils.responses import PluginResponse
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import Request, AuthorizedSession
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 
@@ -25,30 +25,91 @@ SPREADSHEET_ID = '12mlNwnZBP7GxGX5OJ0oCd19DcYDErBRVncyljzSwiwI'
 # Edit with the length of the first row of headers
 RANGE_NAME = 'borrow_log!A1:D1'
 
-creds = None
-
-# The file token.json stores the user's access and refresh tokens, and is
-# created automatically when the authorization flow completes for the first
-# time.
-if os.path.exists('plugins/token.json'):
-    creds = Credentials.from_authorized_user_file('plugins/token.json', SCOPES)
-
-# If there are no (valid) credentials available, let the user log in.
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-        try:
-            creds.refresh(Request())
-        except google.auth.exceptions.RefreshError:
+# TapAPI answers 400 to events whose event_data doesn't match this, before run() (see utils/payload_decoder.py)
+event_data_schema = {
+    "type": "object",
+    "properties": {
+        "book_id": {"type": "integer", "minimum": 1},
+        # Number of days until the book has to be returned
+        "due_on": {"type": "integer", "minimum": 0},
+        "save_to_google_docs": {"type": "boolean"}
+    },
+    "required": ["book_id", "due_on"]
+}
+
+# Sends borrows to Google Sheets in the background, so taps don't wait for Google (see plugin_utils/sheets_outbox.py)
+outbox = None
+
+
+def _log_in() -> Credentials:
+    creds = None
+
+    # The file token.json stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists('plugins/token.json'):
+        creds = Credentials.from_authorized_user_file('plugins/token.json', SCOPES)
+
+    # If there are no (valid) credentials available, let the user log in.
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+            except google.auth.exceptions.RefreshError:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    'plugins/credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+        else:
             flow = InstalledAppFlow.from_client_secrets_file(
                 'plugins/credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
+        # Save the credentials for the next run
+        with open('plugins/token.json', 'w') as token:
+            token.write(creds.to_json())
+
+    return creds
+
+
+def setup(args, options: dict) -> None:
+    """
+    Logs into Google and starts the Google Sheets outbox. TapAPI calls this once, right after importing the plug-in (on
+     its first event, unless config.json says otherwise), so starting TapAPI doesn't wait for Google.
+
+    Set "sheets_endpoint" in the plug-in's entry in config.json to send the rows somewhere else than Google, without
+     logging in (ex. to extras/fake_sheets_server.py for testing)
+    """
+    global outbox
+
+    endpoint = options.get("sheets_endpoint")
+    if endpoint is None:
+        # One session for every append, it keeps the connection to Google open and refreshes the login by itself
+        session = AuthorizedSession(_log_in())
+        endpoint = sheets_outbox.SHEETS_ENDPOINT
     else:
-        flow = InstalledAppFlow.from_client_secrets_file(
-            'plugins/credentials.json', SCOPES)
-        creds = flow.run_local_server(port=0)
-    # Save the credentials for the next run
-    with open('plugins/token.json', 'w') as token:
-        token.write(creds.to_json())
+        _log.warning(f'Sending Google Sheets rows to {endpoint} instead of Google')
+        session = requests.Session()
+
+    client = sheets_outbox.SheetsClient(session, SPREADSHEET_ID, RANGE_NAME, endpoint=endpoint)
+
+    outbox = sheets_outbox.SheetsOutbox(
+        connect=lambda: psycopg2.connect(user=args.dbuser,
+                                         password=args.dbpass,
+                                         host="localhost",
+                                         port="5432",
+                                         database="tapid"),
+        append_rows=client.append_rows,
+        batch_size=options.get("sheets_batch_size", 100)
+    )
+    outbox.start()
+
+
+def stats() -> dict:
+    return outbox.stats() if outbox is not None else {}
+
+
+def _sheets_row(db_entry: tuple, student_name: str) -> list:
+    #       Borrow ID    Book Title   Student Name  Due When
+    return [db_entry[0], db_entry[1], student_name, db_entry[2].strftime("%A %b %d, %Y")]
 
 
 def run(jwt_decoded: dict, payload_data: TapAPIRequestPayload, args, conn) -> PluginResponse:
@@ -56,44 +117,27 @@ def run(jwt_decoded: dict, payload_data: TapAPIRequestPayload, args, conn) -> Pl
     # Extract the payload data
     data = payload_data.event_data
 
+    # If the client requests you save to Google Docs, the row is queued in the same transaction as the borrow
+    save_to_google_docs = bool(data.get('save_to_google_docs'))
+
     # Insert an entry into the database
     try:
         db_entry = library_utils.borrow_book(
             uid=payload_data.uid,
             book_id=data['book_id'],
             due_on=data['due_on'],
-            conn=conn
+            conn=conn,
+            to_sheets_row=(lambda entry: _sheets_row(entry, jwt_decoded["name"])) if save_to_google_docs else None
         )
     except (KeyError, psycopg2.errors.InvalidForeignKey):
         return PluginResponse(response_code=400, payload={"msg": "invalid data"})
     except psycopg2.errors.Error:
         return PluginResponse(response_code=500, payload={"msg": "internal server error"})
 
-    # If the client requests you save to Google Docs
-    if data['save_to_google_docs']:
-        try:
-            # Build the Google service with your credentials
-            service = build('sheets', 'v4', credentials=creds)
-
-            # Call the Sheets API
-            sheet = service.spreadsheets()
-            #               Borrow ID    Book Title   Student Name         Due When
-            sheets_entry = (db_entry[0], db_entry[1], jwt_decoded["name"], db_entry[2].strftime("%A %b %d, %Y"))
-            result = sheet.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=RANGE_NAME,
-                valueInputOption="USER_ENTERED",
-                insertDataOption="INSERT_ROWS",
-                body={
-                    "values": [sheets_entry]
-                }
-            ).execute()
-
-            if result:
-                return PluginResponse(response_code=200, payload={"google_resp": result, "entry": sheets_entry})
-            else:
-                return PluginResponse(response_code=500, payload={"msg": "google api error"})
-        except HttpError:
-            return PluginResponse(response_code=500, payload={"msg": "saved to local db but cant connect to google api"})
+    if save_to_google_docs:
+        # Send it now instead of on the outbox's next check
+        outbox.notify()
+        sheets_entry = _sheets_row(db_entry, jwt_decoded["name"])
+        return PluginResponse(response_code=200, payload={"msg": "ok", "entry": sheets_entry})
 
     return PluginResponse(response_code=200, payload={"msg": "ok"})
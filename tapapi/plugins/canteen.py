@@ -4,27 +4,39 @@ from plugins.plugin_utils import canteen_utils
 
 event_name = "canteen_event"
 
+# TapAPI answers 400 to events whose event_data doesn't match this, before run() (see utils/payload_decoder.py)
+event_data_schema = {
+    "type": "object",
+    "properties": {
+        "action": {"type": "string", "enum": list(canteen_utils.ACTIONS)},
+        # In the smallest unit of the currency, so it's never a float
+        "bal": {"type": "integer", "minimum": 0}
+    },
+    "required": ["action", "bal"]
+}
+
 
 def run(jwt_decoded: dict, payload_data: TapAPIRequestPayload, args, conn) -> PluginResponse:
     uid = payload_data.uid
     event_data = payload_data.event_data
 
-    old_bal = canteen_utils.get_balance_of_uid(conn, uid)
-
     # If the action (subtract or add) is not in event_data
     if "action" not in event_data:
         return PluginResponse(400, payload={"msg": "Invalid dict"})
 
-    if event_data["action"] == "subtract":
-        new_bal = old_bal - event_data["bal"]
-    elif event_data["action"] == "add":
-        new_bal = old_bal + event_data["bal"]
-    else:
+    if event_data["action"] not in canteen_utils.ACTIONS:
         return PluginResponse(400, payload={"msg": "Invalid action"})
 
+    # A negative amount would turn a subtract into an add (and the other way around)
+    amount = event_data.get("bal")
+    if type(amount) != int or amount < 0:
+        return PluginResponse(400, payload={"msg": "Invalid amount"})
+
+    # The balance check and the update happen together in the database (see canteen_utils.apply_transaction)
+    entry = canteen_utils.apply_transaction(conn, uid, action=event_data["action"], amount=amount)
+
     # If there isn't enough balance
-    if new_bal < 0:
+    if entry is None:
         return PluginResponse(response_code=403, payload={"msg": "missing balance"})
     else:
-        canteen_utils.update_balance_of_uid(conn, uid, new_bal=new_bal, action=event_data["action"], bal=event_data["bal"])
-        return PluginResponse(response_code=200, payload={"msg": "success", "new_bal": new_bal})
+        return PluginResponse(response_code=200, payload={"msg": "success", "new_bal": entry.new_bal})
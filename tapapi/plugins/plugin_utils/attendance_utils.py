@@ -1,7 +1,21 @@
 from datetime import datetime
+from psycopg2.extras import execute_values
 
 
 def insert_into_attendance_logs(name: str, uid: str, conn):
     with conn:
         with conn.cursor() as curs:
             curs.execute('insert into attendance (name, uid, date) values (%s, %s, %s)', (name, uid, datetime.now()))
+
+
+def insert_many_into_attendance_logs(entries: list, conn):
+    """
+    Insert many attendance logs in a single transaction
+
+    :param entries: List of (name, uid, date)
+    """
+    with conn:
+        with conn.cursor() as curs:
+            # execute_values sends every row in one multi-row insert instead of one insert per row
+            # Read more: https://www.psycopg.org/docs/extras.html#fast-execution-helpers
+            execute_values(curs, 'insert into attendance (name, uid, date) values %s', entries)
@@ -1,5 +1,40 @@
 import psycopg2
 from datetime import datetime
+from typing import NamedTuple, Optional
+
+# How actions are stored in the canteen_transactions ledger
+ACTIONS = {
+    "subtract": 0,
+    "add": 1
+}
+
+
+class LedgerEntry(NamedTuple):
+    """A row of the canteen_transactions ledger"""
+    timestamp: datetime
+    uid: str
+    action: int
+    new_bal: int
+    amount: int
+
+
+# Updates the balance AND writes the ledger row in one statement (so in one round trip to the database)
+# - The update only happens if the balance won't go below zero (the "where" does the check, not Python)
+# - Updating a row locks it until the transaction ends, so a second tap of the same card waits for the first one and
+#    then re-checks the where against the NEW balance. No tap can read a balance that is about to change.
+#    Read more: https://www.postgresql.org/docs/current/transaction-iso.html#XACT-READ-COMMITTED
+# - The ledger insert takes its new_bal from the update's returning, so both always agree
+_APPLY_TRANSACTION = """
+    with updated as (
+        update canteen_chits
+        set balance = balance + %(delta)s
+        where uid = %(uid)s and balance + %(delta)s >= 0
+        returning uid, balance
+    )
+    insert into canteen_transactions (timestamp, uid, action, new_bal, amount)
+    select %(now)s, uid, %(action)s, balance, %(amount)s from updated
+    returning timestamp, uid, action, new_bal, amount;
+"""
 
 
 def get_balance_of_uid(conn, uid: str) -> int:
@@ -10,13 +45,65 @@ def get_balance_of_uid(conn, uid: str) -> int:
 
             # If the card still hasn't been registered with a balance, add it to the database
             if not row:
-                curs.execute("insert into canteen_chits (uid, balance) values (%s, 0)", (uid,))
-                curs.execute("select balance from canteen_chits where uid = %s;", (uid,))
-                return curs.fetchone()
+                _register_uid(curs, uid)
+                return 0
 
             return row[0]
 
 
+def _register_uid(curs, uid: str) -> None:
+    """Give a card that never used the canteen a balance of 0"""
+    # Two first taps of the same card at once would both see no row and both insert one. The advisory lock makes the
+    #  second tap wait until the first one commits, and the "where not exists" then sees its row. It's released by
+    #  itself when the transaction ends. Read more: https://www.postgresql.org/docs/current/explicit-locking.html
+    # This doesn't need the unique index on canteen_chits (uid) (database migration 6), "on conflict do nothing" only
+    #  adds to it once that index exists
+    curs.execute("select pg_advisory_xact_lock(hashtext('canteen_chits:' || %(uid)s)); "
+                 "insert into canteen_chits (uid, balance) "
+                 "select %(uid)s, 0 where not exists (select 1 from canteen_chits where uid = %(uid)s) "
+                 "on conflict do nothing;", {"uid": uid})
+
+
+def apply_transaction(conn, uid: str, action: str, amount: int) -> Optional[LedgerEntry]:
+    """
+    Add to or subtract from a card's balance, safely even if the card is tapped on many Ground Modules at once
+
+    :param conn: The Psycopg2 connection object
+    :param uid: The card's UID
+    :param action: "add" or "subtract"
+    :param amount: How much to add or subtract (not negative)
+    :return: The ledger row (with the new balance) if it went through, None if the balance was too low
+    """
+    params = {
+        "uid": uid,
+        "delta": amount if action == "add" else -amount,
+        "action": ACTIONS[action],
+        "amount": amount,
+        "now": datetime.now()
+    }
+
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute(_APPLY_TRANSACTION, params)
+            row = curs.fetchone()
+
+            if row:
+                return LedgerEntry(*row)
+
+            # Nothing was updated, either because the balance is too low or because the card has no balance yet.
+            #  Only this (rare) case takes another round trip.
+            curs.execute("select 1 from canteen_chits where uid = %s;", (uid,))
+            if not curs.fetchone():
+                _register_uid(curs, uid)
+
+            # Even if the row exists now, it might not have when the update started (another tap registered the card in
+            #  between), so the update is tried once more. Each statement sees every row committed before it started.
+            curs.execute(_APPLY_TRANSACTION, params)
+            row = curs.fetchone()
+
+            return LedgerEntry(*row) if row else None
+
+
 def update_balance_of_uid(conn, uid, new_bal: int, action, bal) -> int:
     if action == "subtract":
         action = 0
@@ -28,7 +115,7 @@ def update_balance_of_uid(conn, uid, new_bal: int, action, bal) -> int:
             # Update the balance with the new_bal
             curs.execute("update canteen_chits set balance = %s where uid = %s;", (new_bal, uid))
             # Add to logs
-            curs.execute("insert into canteen_transactions (timestamp, uid, action, new_bal, amount) values (%s, %s, %s, %s, %s)", (datetime.now(), uid, action, bal, new_bal))
+            curs.execute("insert into canteen_transactions (timestamp, uid, action, new_bal, amount) values (%s, %s, %s, %s, %s)", (datetime.now(), uid, action, new_bal, bal))
             return True
 
 
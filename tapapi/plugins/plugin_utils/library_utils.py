@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from plugins.plugin_utils import sheets_outbox
 
 
 def get_books_from_uid(uid: str, conn):
@@ -13,18 +14,29 @@ def get_books_from_uid(uid: str, conn):
             return curs.fetchall()
 
 
-def borrow_book(uid: str, book_id: int, due_on: int, conn):
+def borrow_book(uid: str, book_id: int, due_on: int, conn, to_sheets_row=None):
     """
     Insert a borrowed book into the database
+
+    :param to_sheets_row: Optional function that turns the borrow into a Google Sheets row. If given, the row is added
+     to the sheets_outbox table in the same transaction (see sheets_outbox.py)
+    :return: (borrow_id, book_name, due_on) of the new borrow
     """
     with conn:
         with conn.cursor() as curs:
+            # Insert and select the just added row (with its book's name) so we can update the google sheets file with
+            #  a book number
             curs.execute(
-                "insert into books_borrowed (book_id, due_on, uid) values (%s, %s, %s)",
+                "with borrowed as ("
+                "    insert into books_borrowed (book_id, due_on, uid) values (%s, %s, %s) "
+                "    returning borrow_id, book_id, due_on"
+                ") select borrow_id, b.book_name, due_on from borrowed "
+                "inner join book_ids b on b.book_id = borrowed.book_id;",
                 (book_id, datetime.now() + timedelta(days=due_on), uid)
             )
+            db_entry = curs.fetchone()
 
-            curs.execute("select borrow_id, b.book_name, due_on from books_borrowed p inner join book_ids b on b.book_id = p.book_id AND p.uid = %s;", (uid,))
+            if to_sheets_row is not None:
+                sheets_outbox.enqueue(curs, to_sheets_row(db_entry))
 
-            # Select the just added row so we can update the google sheets file with a book number
-            return curs.fetchone()
+            return db_entry
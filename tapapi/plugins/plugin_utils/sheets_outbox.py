@@ -0,0 +1,190 @@
+import os
+import logging
+import threading
+import psycopg2
+from urllib.parse import quote
+from psycopg2.extras import Json
+
+_log = logging.getLogger("main.logger")
+
+SHEETS_ENDPOINT = "https://sheets.googleapis.com"
+
+
+class SheetsClient:
+    def __init__(self, session, spreadsheet_id: str, range_name: str, endpoint: str = SHEETS_ENDPOINT,
+                 timeout: float = 10.0):
+        """
+        Appends rows to a Google Sheet with the Sheets REST API.
+        Read more: https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets.values/append
+
+        The same session is used for every append, so its connection to Google stays open (and, if it's a
+         google.auth AuthorizedSession, it refreshes the login by itself when it expires).
+
+        :param session: A requests.Session (ex. google.auth.transport.requests.AuthorizedSession)
+        :param endpoint: Where the Sheets API is. Change it to test against a stand-in instead of Google (ex.
+         extras/fake_sheets_server.py)
+        :param timeout: Seconds to wait for the Sheets API to answer
+        """
+        self.session = session
+        # The range (ex. borrow_log!A1:D1) is part of the URL, so its ! and : have to be escaped
+        self.url = (f"{endpoint.rstrip('/')}/v4/spreadsheets/{spreadsheet_id}/values/"
+                    f"{quote(range_name, safe='')}:append")
+        self.timeout = timeout
+
+    def append_rows(self, rows: list) -> dict:
+        """Adds the rows under the last row of the range, raises an exception if it didn't work"""
+        response = self.session.post(
+            self.url,
+            params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+            json={"values": rows},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+def enqueue(curs, row: list) -> None:
+    """
+    Add a row to the sheets_outbox table. Use the cursor of the transaction that saves the row's data (ex. the
+     borrow in library_utils.borrow_book), so the row is queued if and only if that data is saved.
+    """
+    curs.execute("insert into sheets_outbox (row) values (%s);", (Json(row),))
+
+
+class SheetsOutbox:
+    def __init__(self, connect, append_rows, batch_size: int = 100, poll_interval: float = 5.0,
+                 max_backoff: float = 300.0):
+        """
+        Sends the rows in the sheets_outbox table to Google Sheets from a background thread, many rows per request.
+
+        This is called the outbox pattern: instead of calling Google during the tap (which is slow, and fails when
+         Google or the internet is down), the row is saved in the database together with the borrow. The outbox
+         then sends whatever is in the table, and only deletes rows once Google accepted them. Rows that couldn't be
+         sent are retried later, waiting twice as long after every failure (exponential backoff).
+         Read more: https://microservices.io/patterns/data/transactional-outbox.html
+
+        Rows are locked while they're being sent ("for update skip locked"), so several TapAPI processes can each run
+         an outbox without sending the same row twice. A row could still be sent twice if TapAPI stops right after
+         Google accepted it but before it was deleted.
+
+        :param connect: A function that opens a new Psycopg2 connection (the outbox keeps its own)
+        :param append_rows: A function that sends a list of rows to Google Sheets, raising an exception if it couldn't
+        :param batch_size: Maximum number of rows sent per request
+        :param poll_interval: Seconds between checks of the table when nothing called notify()
+        :param max_backoff: Maximum seconds a row waits before being retried
+        """
+        self._connect = connect
+        self.append_rows = append_rows
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+
+        self._stats = {
+            "sent_rows": 0,
+            "sent_batches": 0,
+            "failed_batches": 0
+        }
+
+        self._inherited = []
+        self._reset()
+
+        # The thread and the database connection belong to the process that started them (see serve.py)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self) -> None:
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._conn = None
+
+    def _after_fork(self) -> None:
+        # Closing the parent's connection here would log the parent out of Postgres too (see utils/connection_pool.py)
+        if self._conn is not None:
+            self._inherited.append(self._conn)
+        self._reset()
+
+    def start(self) -> None:
+        """Start the background thread (it also sends the rows left over from before TapAPI was restarted)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="tapapi-sheets-outbox", daemon=True)
+            self._thread.start()
+
+    def notify(self) -> None:
+        """Call after committing a row with enqueue(), so it's sent right away instead of on the next poll"""
+        self.start()
+        self._wake.set()
+
+    def _loop(self) -> None:
+        while not self._stopping.is_set():
+            self._wake.clear()
+
+            try:
+                sent = self._send_batch()
+            except psycopg2.Error as e:
+                _log.critical(f'Google Sheets outbox lost its database connection: {e}')
+                self._close_connection()
+                sent = 0
+
+            # A full batch means there might be more rows waiting, so keep going without waiting
+            if sent < self.batch_size:
+                self._wake.wait(self.poll_interval)
+
+        self._close_connection()
+
+    def _send_batch(self) -> int:
+        """
+        :return: How many rows were sent to Google Sheets
+        """
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+
+        with self._conn:
+            with self._conn.cursor() as curs:
+                curs.execute("select outbox_id, row from sheets_outbox where next_attempt_at <= now() "
+                             "order by outbox_id limit %s for update skip locked;", (self.batch_size,))
+                batch = curs.fetchall()
+
+                if not batch:
+                    return 0
+
+                outbox_ids = [outbox_id for outbox_id, _ in batch]
+
+                try:
+                    self.append_rows([row for _, row in batch])
+                except Exception as e:
+                    _log.warning(f'Could not send {len(batch)} rows to Google Sheets, retrying them later: {e}')
+                    curs.execute("update sheets_outbox set attempts = attempts + 1, "
+                                 "next_attempt_at = now() + least(power(2, attempts), %s) * interval '1 second' "
+                                 "where outbox_id = any(%s);", (self.max_backoff, outbox_ids))
+                    with self._lock:
+                        self._stats["failed_batches"] += 1
+                    return 0
+
+                curs.execute("delete from sheets_outbox where outbox_id = any(%s);", (outbox_ids,))
+
+        with self._lock:
+            self._stats["sent_rows"] += len(batch)
+            self._stats["sent_batches"] += 1
+
+        return len(batch)
+
+    def _close_connection(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,122 @@
+# Production launcher for TapAPI
+#
+# "python main.py" runs Flask's development server, which is a single process (and so, a single CPU core) and isn't
+#  built to handle a lot of traffic. This file runs TapAPI on gunicorn instead, a production server that starts
+#  several worker processes that all answer requests on the same port.
+#  Read more: https://docs.gunicorn.org/en/stable/design.html
+#
+# Needs "pip install gunicorn" (Linux/macOS only). It takes the same arguments as main.py, plus a few of its own, ex.:
+#  python3.9 serve.py -user <user> -pass <pass> --port 8000 --workers 4
+#  python3.9 serve.py -user <user> -pass <pass> --worker-class async     (serves asgi.py instead, needs uvicorn)
+#
+# main.py is imported (plug-ins loaded, database checked, public key cache warmed) ONCE in the main process, and the
+#  workers are then forked from it so they start with all of that already done. Things that can't be shared between
+#  processes (database connections, the key pair and verification processes) are started over in every worker.
+#
+# Send SIGTERM (ex. "kill <pid>" or systemctl stop) for a graceful shutdown: workers stop accepting new requests and
+#  get --graceful-timeout seconds to finish the ones they're handling.
+
+import os
+import logging
+from gunicorn.app.base import BaseApplication
+
+# Importing main parses the arguments and sets up everything before any worker is forked
+import main
+
+log = main.log
+args = main.args
+
+
+def when_ready(server):
+    """Runs in the main process right before the workers are forked"""
+    # A thread that is still importing a plug-in when the workers are forked could leave them with a half-imported
+    #  module, so the plug-ins with "load": "background" (see config.json) are waited for
+    main.plugin_registry.join_background()
+
+    # The main process never answers requests, so it doesn't need these anymore. Workers open their own.
+    # The processes are waited for, so the workers don't inherit (and try to clean up) the main process's children
+    main.db_pool.close()
+    main.key_pool.shutdown(wait=True)
+    if main.verify_executor is not None:
+        main.verify_executor.shutdown(wait=True)
+
+    log.info(f'TapAPI is ready, starting {server.num_workers} workers')
+
+
+def post_fork(server, worker):
+    """Runs in every worker right after it was forked"""
+    # Start generating this worker's own reserve of key pairs (see utils/key_pool.py)
+    main.key_pool.start()
+    log.info(f'Worker {os.getpid()} started')
+
+
+def worker_exit(server, worker):
+    """
+    Runs in every worker when it stops (ex. after a SIGTERM). Uvicorn workers (--worker-class async) of uvicorn 0.29
+     and later die before getting here, so asgi.py stops the same things itself. Running both does nothing the second
+     time.
+    """
+    main.metrics_writer.stop()
+    if main.journal is not None:
+        main.journal.stop()
+    main.key_pool.shutdown()
+    if main.verify_executor is not None:
+        main.verify_executor.shutdown()
+    main.db_pool.close()
+    log.info(f'Worker {os.getpid()} stopped')
+
+
+class TapAPIServer(BaseApplication):
+    def __init__(self, application, options: dict):
+        """
+        Runs a WSGI/ASGI app on gunicorn with the given settings (instead of gunicorn's command-line arguments)
+        Read more: https://docs.gunicorn.org/en/stable/custom.html
+        """
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def gunicorn_options() -> dict:
+    """Translates TapAPI's arguments into gunicorn settings (see https://docs.gunicorn.org/en/stable/settings.html)"""
+    options = {
+        "bind": f"0.0.0.0:{args.port}",
+        "workers": args.workers or os.cpu_count() or 1,
+        "graceful_timeout": args.graceful_timeout,
+        # Ground Modules keep their connection open between taps (HTTP/1.1 keep-alive), gunicorn closes it after 2
+        #  idle seconds by default
+        "keepalive": args.keepalive,
+        "loglevel": logging.getLevelName(log.level).lower(),
+        # Import main.py before forking (this is what lets the workers share the work done on startup)
+        "preload_app": True,
+        "when_ready": when_ready,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit
+    }
+
+    if args.worker_class == 'async':
+        options["worker_class"] = "uvicorn.workers.UvicornWorker"
+    else:
+        # Each thread can hold one database connection, so by default there's one thread per connection
+        options["worker_class"] = "gthread"
+        options["threads"] = args.threads or args.pool_size
+
+    return options
+
+
+if __name__ == '__main__':
+    if args.worker_class == 'async':
+        import asgi
+        app = asgi.app
+    else:
+        app = main.app
+
+    log.info(f'Welcome to TapAPI! Serving on port {args.port} with gunicorn, debug level {args.level}')
+    TapAPIServer(app, gunicorn_options()).run()
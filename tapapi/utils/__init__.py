@@ -2,10 +2,27 @@ __all__ = ['port_type', 'parse_payload', 'factory']
 
 from utils.port_type import port_type
 from utils.factory import load_plugins
+from utils.plugin_registry import PluginRegistry
 from utils.parse_payload import parse_payload
-from utils.authentication import get_public_key_from_uid, verify_jwt_with_public_key, generate_key_pairs
+from utils.authentication import get_public_key_from_uid, verify_jwt_with_public_key, generate_key_pairs, \
+    get_cached_public_key_from_uid, rotate_public_key
 from utils.configure_logger import configure_logger
 from utils.configure_argparse import configure_argparse
 from utils.handle_metrics import handle_metrics
 from utils.is_db_valid import is_db_valid
+from utils.migrations import migrate, check_schema, MIGRATIONS, LATEST_VERSION
 from utils.is_jwt_valid import is_jwt_valid
+from utils.connection_pool import ConnectionPool, PoolTimeoutError
+from utils.ttl_cache import TTLCache
+from utils.key_cache import PublicKey, PublicKeyCache
+from utils.token_cache import VerifiedTokenCache
+from utils.key_pool import KeyPairPool
+from utils.verify_executor import VerifyExecutor, VerifyExecutorError, VerifyOverloadedError, VerifyTimeoutError
+from utils.async_db import AsyncConnection
+from utils.latency import LatencyHistogram, LatencyRecorder
+from utils.metrics_writer import MetricsWriter
+from utils.idempotency import IdempotencyStore, IDEMPOTENCY_HEADER, MAX_KEY_LENGTH
+from utils.keyed_executor import KeyedExecutor
+from utils.bulkhead import Bulkhead
+from utils.journal import EventJournal, JournalError
+from utils.payload_decoder import PayloadDecoder, PayloadError
@@ -0,0 +1,32 @@
+import asyncio
+import functools
+
+
+class AsyncConnection:
+    def __init__(self, conn, executor=None):
+        """
+        Lets async code (ex. an "async def run(...)" plug-in) use a Psycopg2 connection without blocking the event loop.
+
+        Psycopg2 is a blocking library, meaning a query holds up whatever thread runs it until Postgres answers. In an
+         async server every request shares ONE thread (the event loop), so a blocking query would freeze all of them.
+         Instead, every call is handed to a worker thread and awaited, so the event loop keeps serving other requests.
+         Read more: https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.run_in_executor
+
+        Any function that takes a conn keyword (like the ones in plugins/plugin_utils) works, for example:
+
+            balance = await conn.run(canteen_utils.get_balance_of_uid, uid=jwt_decoded["uid"])
+
+        :param conn: The Psycopg2 connection object (borrowed from the pool by TapAPI)
+        :param executor: The concurrent.futures executor that runs the queries (None for asyncio's default one)
+        """
+        self.conn = conn
+        self._executor = executor
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs func(*args, conn=<the connection>, **kwargs) in a worker thread and returns what it returned
+
+        Calls are awaited one after another, so a connection is never used by two threads at once.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, conn=self.conn, **kwargs))
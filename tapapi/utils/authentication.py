@@ -4,7 +4,9 @@ import jwt
 import random
 import psycopg2
 import os
-from cryptography.hazmat.primitives.asymmetric import rsa
+from typing import Union
+from utils.key_cache import PublicKey, PublicKeyCache, SUPPORTED_ALGORITHMS, load_public_key
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 from cryptography.hazmat.primitives import serialization
 
 _log = logging.getLogger("main.logger")
@@ -16,20 +18,35 @@ def _generate_fake_uid():
     return ' '.join([''.join(random.choices(string.hexdigits.upper()[:-6], k=2)) for _ in range(4)])
 
 
-def generate_key_pairs(to_database=False, conn=None, uid=None):
+def generate_key_pairs(to_database=False, conn=None, uid=None, algorithm='RS256'):
     """
-    Generates an RSA key pair
+    Generates a key pair
     :param to_database: if to send to the database configured in connect_to_database()
     :param conn: The Psycopg2 connection object
+    :param algorithm: The JWT algorithm the key pair is for ("RS256", "ES256" or "EdDSA")
     :returns: utf-8 decrypted (public_key, private_key)
     """
-
-    # 65537 as a public exponent is standard (e=3 is used sometimes, but a
-    #  student can do future research on the security of this RSA implementation)
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048
-    )
+    if algorithm not in SUPPORTED_ALGORITHMS:
+        raise ValueError(f"Unsupported algorithm {algorithm}, use one of {', '.join(SUPPORTED_ALGORITHMS)}")
+
+    if algorithm == 'RS256':
+        # 65537 as a public exponent is standard (e=3 is used sometimes, but a
+        #  student can do future research on the security of this RSA implementation)
+        private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048
+        )
+        # PKCS1 is RSA-only, but it's what the public_keys table has always used for RSA keys
+        public_format = serialization.PublicFormat.PKCS1
+    elif algorithm == 'ES256':
+        # Elliptic curve keys are much smaller (and faster to make) than RSA keys of the same strength, so the JWT's
+        #  signature is only 86 characters instead of 342. That's a lot less to fit in a MIFARE card!
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        public_format = serialization.PublicFormat.SubjectPublicKeyInfo
+    else:
+        # Ed25519 signatures are also 86 characters, and are the fastest of the three to verify
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        public_format = serialization.PublicFormat.SubjectPublicKeyInfo
 
     # What's all this PEM, PKCS8, PKCS1 stuff?
     # Read: https://stackoverflow.com/questions/48958304/pkcs1-and-pkcs8-format-for-rsa-private-key
@@ -41,7 +58,7 @@ def generate_key_pairs(to_database=False, conn=None, uid=None):
 
     encrypted_pem_public_key = private_key.public_key().public_bytes(
         encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.PKCS1
+        format=public_format
     )
 
     # The private keys come in a byte-encoded format, so we turn it into a string by using .decode('utf-8')
@@ -59,8 +76,9 @@ def generate_key_pairs(to_database=False, conn=None, uid=None):
         cursor = connection.cursor()
 
         # ALWAYS use query parameters to prevent SQL injection attacks
-        item_tuple = (uid, utf8_pem_private_key, utf8_pem_public_key)
-        cursor.execute('insert into test_key_pairs (uid, private_key, public_key) values (%s, %s, %s);', item_tuple)
+        item_tuple = (uid, utf8_pem_private_key, utf8_pem_public_key, algorithm)
+        cursor.execute('insert into test_key_pairs (uid, private_key, public_key, algorithm) values (%s, %s, %s, %s);',
+                       item_tuple)
 
         # Commit the connection
         # You can commit this way, or check get_public_key_from_uid to see another way to automatically connect
@@ -70,7 +88,8 @@ def generate_key_pairs(to_database=False, conn=None, uid=None):
     return utf8_pem_public_key, utf8_pem_private_key
 
 
-def get_public_key_from_uid(uid: str, conn, save_priv_key_on_new_uid=False):
+def get_public_key_from_uid(uid: str, conn, save_priv_key_on_new_uid=False, cache: PublicKeyCache = None,
+                            key_pool=None, algorithm='RS256'):
     """
     Get a public key from a card UID.
 
@@ -78,7 +97,11 @@ def get_public_key_from_uid(uid: str, conn, save_priv_key_on_new_uid=False):
     :param conn: The Psycopg2 connection object
     :param save_priv_key_on_new_uid: Whether to save the private key to an external table named test_key_pairs.
      Could be used in testing.
-    :return: An error (check DB configuration), and a tuple consisting of (uid, public_key) when successful
+    :param cache: The PublicKeyCache to invalidate if a new key gets inserted for the UID
+    :param key_pool: A KeyPairPool to take a pre-generated RSA key pair from, instead of generating one right away
+    :param algorithm: The algorithm of the key pair made if the UID doesn't have one yet
+    :return: None if there was an error (check DB configuration), and a tuple consisting of (public_key, algorithm)
+     when successful
     """
 
     try:
@@ -88,44 +111,113 @@ def get_public_key_from_uid(uid: str, conn, save_priv_key_on_new_uid=False):
         with conn:
             with conn.cursor() as curs:
                 # Get the public key associated with the UID
-                curs.execute("select * from public_keys where uid = %s;", (uid,))
+                curs.execute("select public_key, algorithm from public_keys where uid = %s;", (uid,))
 
                 # Returned result
                 row = curs.fetchone()
 
                 # Check if the row exists
                 if row is None:
-                    # Generate a new RSA key pair
-                    public_key, private_key = generate_key_pairs()
+                    # Generate a new key pair (or take an RSA one that was generated ahead of time)
+                    if key_pool is not None and algorithm == 'RS256':
+                        public_key, private_key = key_pool.take()
+                    else:
+                        public_key, private_key = generate_key_pairs(algorithm=algorithm)
 
-                    # Insert into the public_keys database (row 1 - uid, row 2 - public_key)
-                    curs.execute("insert into public_keys (uid, public_key) values (%s, %s);", (uid, public_key))
+                    # Insert into the public_keys database (row 1 - uid, row 2 - public_key, row 3 - algorithm)
+                    curs.execute("insert into public_keys (uid, public_key, algorithm) values (%s, %s, %s);",
+                                 (uid, public_key, algorithm))
 
                     if save_priv_key_on_new_uid:
                         # Insert the key pair into the test_key_pairs database
-                        curs.execute("insert into test_key_pairs (uid, public_key, private_key) values (%s, %s, %s);",
-                                     (uid, public_key, private_key))
+                        curs.execute("insert into test_key_pairs (uid, public_key, private_key, algorithm) "
+                                     "values (%s, %s, %s, %s);", (uid, public_key, private_key, algorithm))
 
-                    _log.info(f'Successfully made new public-private key pair for uid {uid}')
-                    return public_key
+                    if cache is not None:
+                        cache.invalidate(uid)
+
+                    _log.info(f'Successfully made new {algorithm} public-private key pair for uid {uid}')
+                    return public_key, algorithm
                 else:
                     _log.info(f'UID {uid} already has an associated key, using that instead')
-                    return row[1]
+                    return row[0], row[1]
     except (Exception, psycopg2.Error) as error:
         _log.critical(f"Error while connecting to PostgreSQL: {error}")
         return None
 
 
-def verify_jwt_with_public_key(json_web_token: str, public_key: bytes):
+def get_cached_public_key_from_uid(uid: str, conn, cache: PublicKeyCache, save_priv_key_on_new_uid=False,
+                                   key_pool=None, algorithm='RS256'):
+    """
+    Get the parsed public key of a card UID, only going to the database if it isn't in the cache.
+
+    :param uid: The UID of the card (casted to string)
+    :param conn: The Psycopg2 connection object (not used when the key is cached)
+    :param cache: The PublicKeyCache to look in first
+    :param save_priv_key_on_new_uid: See get_public_key_from_uid()
+    :param key_pool: See get_public_key_from_uid()
+    :param algorithm: See get_public_key_from_uid()
+    :return: A PublicKey, or None if there was a database error
+    """
+    public_key = cache.get(uid)
+
+    if public_key is not None:
+        return public_key
+
+    row = get_public_key_from_uid(uid, conn, save_priv_key_on_new_uid=save_priv_key_on_new_uid, cache=cache,
+                                  key_pool=key_pool, algorithm=algorithm)
+
+    if row is None:
+        return None
+
+    pem, algorithm = row
+    return cache.put_pem(uid, pem, algorithm)
+
+
+def rotate_public_key(uid: str, public_key: str, conn, cache: PublicKeyCache = None, algorithm='RS256'):
+    """
+    Replace (or insert) the public key of a card UID, for example after re-writing a card with a new JWT.
+
+    :param uid: The UID of the card (casted to string)
+    :param public_key: The new PEM-encoded public key
+    :param conn: The Psycopg2 connection object
+    :param cache: The PublicKeyCache to invalidate so the old key stops being used right away
+    :param algorithm: The algorithm of the new key ("RS256", "ES256" or "EdDSA")
+    """
+    # Parse the key first, so a bad key (or one that doesn't match the algorithm) never makes it to the database
+    load_public_key(public_key, algorithm)
+
+    with conn:
+        with conn.cursor() as curs:
+            curs.execute("update public_keys set public_key = %s, algorithm = %s where uid = %s;",
+                         (public_key, algorithm, uid))
+
+            if curs.rowcount == 0:
+                curs.execute("insert into public_keys (uid, public_key, algorithm) values (%s, %s, %s);",
+                             (uid, public_key, algorithm))
+
+    if cache is not None:
+        cache.invalidate(uid)
+
+    _log.info(f'Rotated the public key of uid {uid}')
+
+
+def verify_jwt_with_public_key(json_web_token: str, public_key: Union[bytes, PublicKey], algorithm='RS256'):
     """
     Decode a JWT with a public key.
 
     :param json_web_token: The JSON Web Token
-    :param public_key: The public key casted to bytes
+    :param public_key: The public key casted to bytes, or an already parsed PublicKey (faster, no PEM parsing)
+    :param algorithm: The algorithm of a bytes public key (a PublicKey already knows its algorithm)
     :return: Decoded JWT if successful, jwt.exceptions.InvalidSignatureError if not
     """
     _log.info(f'Verifying JWT \"{json_web_token[:12]}...\"')
-    return jwt.decode(jwt=json_web_token, key=public_key, algorithms='RS256')
+    if isinstance(public_key, PublicKey):
+        public_key, algorithm = public_key.key, public_key.algorithm
+
+    # Only ever accept the algorithm stored with the key, never the one the JWT's header claims to use
+    # Read more: https://auth0.com/blog/critical-vulnerabilities-in-json-web-token-libraries/
+    return jwt.decode(jwt=json_web_token, key=public_key, algorithms=[algorithm])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Bulkhead:
+    def __init__(self, name: str, max_concurrency: int = 10, max_queue: int = 32, timeout: float = 30.0):
+        """
+        Gives a plug-in its own threads, with a limit on how many of its events can run or wait at once.
+
+        Without it, every plug-in shares the same threads. If one of them gets slow (ex. books_library waiting on
+         Google Sheets), its events pile up until they use every thread, and the other plug-ins (ex. canteen) have to
+         wait behind them. With a bulkhead per plug-in, a slow plug-in can only use up its own threads, and events
+         over its limit are turned away right away instead of waiting. The name comes from the walls that split a
+         ship's hull, so one leak only floods one compartment. Read more:
+         https://learn.microsoft.com/en-us/azure/architecture/patterns/bulkhead
+
+        Use it as an executor: admit() an event first (it returns False if the plug-in is at its limit), then submit()
+         exactly one task for it. Waiting for the result (up to timeout seconds) is up to the caller.
+
+        :param name: The plug-in's event_name (used to name its threads)
+        :param max_concurrency: Maximum number of the plug-in's events running at once
+        :param max_queue: Maximum number of the plug-in's events waiting for a thread on top of those
+        :param timeout: Seconds an event gets (waiting included) before TapAPI stops waiting for it
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._reset()
+
+        # Threads don't survive a fork (see serve.py), so a forked child starts with a fresh pool
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=f"tapapi-{self.name}")
+        self._lock = threading.Lock()
+
+        # Events admitted and not finished yet (running or waiting)
+        self._admitted = 0
+        self._running = 0
+
+        self._stats = {
+            "completed": 0,
+            "rejected": 0,
+            "timed_out": 0
+        }
+
+    def admit(self) -> bool:
+        """
+        Reserve a spot for an event. Every successful admit() must be followed by exactly one submit().
+
+        :return: False if max_concurrency events are already running and max_queue are already waiting
+        """
+        with self._lock:
+            if self._admitted >= self.max_concurrency + self.max_queue:
+                self._stats["rejected"] += 1
+                return False
+            self._admitted += 1
+            return True
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Run fn(*args, **kwargs) in one of the plug-in's threads, freeing the spot reserved by admit() once done"""
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._admitted -= 1
+                self._stats["completed"] += 1
+
+    def timed_out(self) -> None:
+        """Count an event whose caller stopped waiting for it after timeout seconds"""
+        with self._lock:
+            self._stats["timed_out"] += 1
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        """
+        Returns the limits, how many events are running and waiting, and the counters.
+        saturation is how full the bulkhead is (1.0 means new events are being rejected).
+        """
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "timeout": self.timeout,
+                "running": self._running,
+                "queued": self._admitted - self._running,
+                "saturation": self._admitted / (self.max_concurrency + self.max_queue),
+                **self._stats
+            }
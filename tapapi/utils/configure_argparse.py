@@ -40,4 +40,247 @@ def configure_argparse():
                         action='store',
                         type=str)
 
+    parser.add_argument('--pool-size',
+                        dest='pool_size',
+                        help='Maximum number of PostgreSQL connections kept open by TapAPI',
+                        action='store',
+                        default=10,
+                        type=int)
+
+    parser.add_argument('--pool-timeout',
+                        dest='pool_timeout',
+                        help='Seconds to wait for a free PostgreSQL connection before giving up',
+                        action='store',
+                        default=5.0,
+                        type=float)
+
+    parser.add_argument('--key-cache-size',
+                        dest='key_cache_size',
+                        help='Maximum number of parsed card public keys kept in memory',
+                        action='store',
+                        default=8192,
+                        type=int)
+
+    parser.add_argument('--key-cache-ttl',
+                        dest='key_cache_ttl',
+                        help='Seconds a cached public key is trusted before re-reading it from the database',
+                        action='store',
+                        default=3600.0,
+                        type=float)
+
+    parser.add_argument('--token-cache-size',
+                        dest='token_cache_size',
+                        help='Maximum number of already verified card JWTs remembered (0 to always verify)',
+                        action='store',
+                        default=8192,
+                        type=int)
+
+    parser.add_argument('--token-cache-ttl',
+                        dest='token_cache_ttl',
+                        help='Seconds an already verified card JWT is trusted without checking its signature again',
+                        action='store',
+                        default=600.0,
+                        type=float)
+
+    parser.add_argument('--key-algorithm',
+                        dest='key_algorithm',
+                        help='Algorithm of the key pair made when an unknown card UID taps for the first time',
+                        action='store',
+                        default='RS256',
+                        choices=['RS256', 'ES256', 'EdDSA'],
+                        type=str)
+
+    parser.add_argument('--key-pool-size',
+                        dest='key_pool_size',
+                        help='Number of RSA key pairs generated ahead of time for new cards (0 to disable, only '
+                             'used with --key-algorithm RS256)',
+                        action='store',
+                        default=8,
+                        type=int)
+
+    parser.add_argument('--key-pool-workers',
+                        dest='key_pool_workers',
+                        help='Number of background processes generating RSA key pairs',
+                        action='store',
+                        default=1,
+                        type=int)
+
+    parser.add_argument('--verify-mode',
+                        dest='verify_mode',
+                        help='Where JWT signatures are verified: "inline" (in the request thread) or "process" '
+                             '(in a pool of worker processes, uses every CPU core)',
+                        action='store',
+                        default='inline',
+                        choices=['inline', 'process'],
+                        type=str)
+
+    parser.add_argument('--verify-workers',
+                        dest='verify_workers',
+                        help='Number of verification worker processes in "process" mode (default: number of CPU cores)',
+                        action='store',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--verify-max-pending',
+                        dest='verify_max_pending',
+                        help='Maximum verifications queued in "process" mode before new ones are rejected with a 503',
+                        action='store',
+                        default=64,
+                        type=int)
+
+    parser.add_argument('--verify-timeout',
+                        dest='verify_timeout',
+                        help='Seconds to wait for a verification in "process" mode before answering with a 504',
+                        action='store',
+                        default=2.0,
+                        type=float)
+
+    parser.add_argument('--max-batch-size',
+                        dest='max_batch_size',
+                        help='Maximum number of events accepted in one /events/batch request',
+                        action='store',
+                        default=200,
+                        type=int)
+
+    parser.add_argument('--idempotency-window',
+                        dest='idempotency_window',
+                        help='Seconds the response to an event with an Idempotency-Key header is remembered for, so '
+                             'retries get it back instead of running the plug-in again',
+                        action='store',
+                        default=86400.0,
+                        type=float)
+
+    parser.add_argument('--idempotency-cache-size',
+                        dest='idempotency_cache_size',
+                        help='Maximum number of idempotent responses kept in memory (the rest are in the database)',
+                        action='store',
+                        default=4096,
+                        type=int)
+
+    parser.add_argument('--metrics-queue-size',
+                        dest='metrics_queue_size',
+                        help='Maximum number of Ground Module metrics waiting to be written to the database',
+                        action='store',
+                        default=10000,
+                        type=int)
+
+    parser.add_argument('--metrics-batch-size',
+                        dest='metrics_batch_size',
+                        help='Maximum number of metrics written to the database at once',
+                        action='store',
+                        default=500,
+                        type=int)
+
+    parser.add_argument('--metrics-flush-interval',
+                        dest='metrics_flush_interval',
+                        help='Maximum seconds a metric waits before being written to the database',
+                        action='store',
+                        default=1.0,
+                        type=float)
+
+    parser.add_argument('--metrics-spill-file',
+                        dest='metrics_spill_file',
+                        help='File to save metrics to when the queue is full or the database is down (they are '
+                             'written to the database later). By default, those metrics are dropped.',
+                        action='store',
+                        default=None,
+                        type=str)
+
+    parser.add_argument('--no-latency-stats',
+                        dest='no_latency_stats',
+                        help='Stop recording how long each stage of an event takes (shown on /stats)',
+                        action='store_true')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        help='Number of worker processes started by serve.py (default: number of CPU cores). Each '
+                             'worker has its own --pool-size database connections.',
+                        action='store',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--worker-class',
+                        dest='worker_class',
+                        help='How serve.py workers handle requests: "threads" (the Flask app in main.py, with '
+                             '--threads threads per worker) or "async" (the Quart app in asgi.py)',
+                        action='store',
+                        default='threads',
+                        choices=['threads', 'async'],
+                        type=str)
+
+    parser.add_argument('--threads',
+                        dest='threads',
+                        help='Threads per worker with --worker-class threads (default: --pool-size)',
+                        action='store',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--graceful-timeout',
+                        dest='graceful_timeout',
+                        help='Seconds serve.py workers get to finish their requests after a SIGTERM before being '
+                             'killed',
+                        action='store',
+                        default=30,
+                        type=int)
+
+    parser.add_argument('--keepalive',
+                        dest='keepalive',
+                        help='Seconds serve.py keeps an idle connection open for its next request (Ground Modules '
+                             'reuse one connection between taps and ping it every 30 seconds)',
+                        action='store',
+                        default=75,
+                        type=int)
+
+    parser.add_argument('--plugin-max-concurrency',
+                        dest='plugin_max_concurrency',
+                        help='Maximum number of events of the same plug-in running at once (default: --pool-size). '
+                             'Can be set per plug-in with "max_concurrency" in config.json.',
+                        action='store',
+                        default=None,
+                        type=int)
+
+    parser.add_argument('--plugin-max-queue',
+                        dest='plugin_max_queue',
+                        help='Maximum number of events of the same plug-in waiting to run, events over it get a 503. '
+                             'Can be set per plug-in with "max_queue" in config.json.',
+                        action='store',
+                        default=32,
+                        type=int)
+
+    parser.add_argument('--plugin-timeout',
+                        dest='plugin_timeout',
+                        help='Seconds an event waits for its plug-in before getting a 504. Can be set per plug-in with '
+                             '"timeout" in config.json.',
+                        action='store',
+                        default=30.0,
+                        type=float)
+
+    parser.add_argument('--journal-dir',
+                        dest='journal_dir',
+                        help='Folder for the event journal. When set, events of deferrable plug-ins (ex. attendance) '
+                             'are answered as soon as they are saved there, and written to the database in the '
+                             'background. By default, every plug-in writes to the database before answering.',
+                        action='store',
+                        default=None,
+                        type=str)
+
+    parser.add_argument('--journal-batch-size',
+                        dest='journal_batch_size',
+                        help='Maximum number of journal records saved per fsync and written to the database at once',
+                        action='store',
+                        default=256,
+                        type=int)
+
+    parser.add_argument('--journal-max-bytes',
+                        dest='journal_max_bytes',
+                        help='Size (in bytes) after which a journal that was fully written to the database is emptied',
+                        action='store',
+                        default=64 * 1024 * 1024,
+                        type=int)
+
+    parser.add_argument('--migrate',
+                        dest='migrate',
+                        help='Create the missing tables and indexes (see utils/migrations.py) before starting',
+                        action='store_true')
+
     return parser
@@ -0,0 +1,230 @@
+import os
+import time
+import logging
+import threading
+import psycopg2
+from collections import deque
+from contextlib import contextmanager
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+_log = logging.getLogger("main.logger")
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no database connection could be checked out before the timeout ran out"""
+
+
+class ConnectionPool:
+    def __init__(self, connect, max_size: int = 10, timeout: float = 5.0, health_check_after: float = 30.0):
+        """
+        A bounded pool of PostgreSQL connections.
+
+        Opening a connection to Postgres means a TCP handshake AND a login, so doing it for every tap is slow.
+        Instead, we open connections once and hand them out (check them out) to whoever needs one, then take them
+        back (check them in) when they're done.
+
+        :param connect: A function that opens a brand-new Psycopg2 connection (ex. create_connection in main.py)
+        :param max_size: The maximum number of connections that can be open at once
+        :param timeout: How many seconds to wait for a free connection before raising a PoolTimeoutError
+        :param health_check_after: If a connection sat unused for this many seconds, run "select 1" on it before
+         handing it out to make sure the server didn't drop it
+        """
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+
+        # Idle connections are stored with the time they were last checked in, (connection, last_used)
+        self._idle = deque()
+        self._size = 0
+        # A Condition is a lock that threads can also wait() on until another thread notify()s them
+        # Read more: https://docs.python.org/3/library/threading.html#condition-objects
+        self._cond = threading.Condition()
+
+        # Connections that putconn() gives back only once a Future is done, {id(conn): future} (see keep_until_done())
+        self._kept = {}
+
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "opened": 0,
+            "discarded": 0,
+            "health_checks": 0,
+            "wait_seconds": 0.0
+        }
+
+        # Connections can't be shared between processes, so a forked child (ex. a worker started by serve.py) must
+        #  not use the ones it inherited. Read more: https://docs.python.org/3/library/os.html#os.register_at_fork
+        self._inherited = []
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        """Runs in a freshly forked child process, which then starts with an empty pool"""
+        # The inherited connections still belong to the parent. We keep a reference to them instead of closing them,
+        #  since closing (or garbage collecting) them here would log the parent out of Postgres too!
+        self._inherited.extend(conn for conn, _ in self._idle)
+        self._idle = deque()
+        self._size = 0
+        self._kept = {}
+        self._cond = threading.Condition()
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        """Checks if a connection is still usable. Only talks to the server if it has been idle for a while."""
+        if conn.closed:
+            return False
+
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+
+        with self._cond:
+            self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as curs:
+                curs.execute("select 1;")
+            # Don't leave the health check's transaction open
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn) -> None:
+        """Closes a connection and frees up its slot in the pool. Call with self._cond held."""
+        self._size -= 1
+        self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._cond.notify()
+
+    def getconn(self, timeout: float = None):
+        """
+        Check out a connection from the pool. Prefer using the connection() context manager instead.
+
+        :param timeout: Overrides the pool's default checkout timeout
+        :return: A Psycopg2 connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    # The pool is full, so wait for someone to give a connection back
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(f"No database connection available after {timeout} seconds")
+
+                if self._idle:
+                    # Reuse the most recently used idle connection (it's the least likely to have been dropped)
+                    conn, last_used = self._idle.pop()
+                else:
+                    # Otherwise, reserve a slot so other threads don't overshoot max_size while we connect
+                    conn, last_used = None, None
+                    self._size += 1
+
+            if conn is None:
+                break
+
+            # The health check talks to the server, so it runs outside the lock
+            if self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._stats["checkouts"] += 1
+                    self._stats["wait_seconds"] += time.monotonic() - started
+                return conn
+
+            _log.warning("Discarding a dead database connection from the pool")
+            with self._cond:
+                self._discard(conn)
+
+        # Connect outside the lock so other threads can still check in/out connections in the meantime
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats["opened"] += 1
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds"] += time.monotonic() - started
+
+        return conn
+
+    def putconn(self, conn) -> None:
+        """
+        Give a connection back to the pool.
+
+        :param conn: A connection checked out with getconn()
+        """
+        with self._cond:
+            future = self._kept.pop(id(conn), None)
+
+        if future is not None:
+            # Something still uses the connection, so it's given back once that's done
+            future.add_done_callback(lambda _: self.putconn(conn))
+            return
+
+        with self._cond:
+            if conn.closed:
+                self._discard(conn)
+                return
+
+            # If whoever used the connection left a transaction open (or broken), roll it back so the next user
+            #  starts fresh. If even that fails, the connection is useless so we throw it away.
+            if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+                    return
+
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def keep_until_done(self, conn, future) -> None:
+        """
+        Don't give conn back to the pool when it's put back (ex. at the end of its with block), but once future is
+         done. Used when TapAPI stops waiting for a plug-in that is still running (see utils/bulkhead.py), so no other
+         request gets the connection while the plug-in still uses it.
+        """
+        with self._cond:
+            self._kept[id(conn)] = future
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """
+        Borrow a connection for the duration of a with block, for example:
+
+            with pool.connection() as conn:
+                get_books_from_uid(uid, conn=conn)
+
+        The connection is always given back to the pool, even if an error happens inside the with block.
+        """
+        conn = self.getconn(timeout=timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def close(self) -> None:
+        """Closes every idle connection (ex. when shutting down the server)"""
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self) -> dict:
+        """Returns a snapshot of the pool's counters"""
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._stats
+            }
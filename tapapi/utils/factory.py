@@ -1,22 +1,17 @@
-import importlib
 import json
-from typing import Dict, TextIO, Callable, Tuple
+from typing import TextIO, Tuple
+from utils.plugin_registry import PluginRegistry
 
 
-def load_plugins(f: TextIO, logger) -> Tuple[Dict[str, Callable], dict]:
-    """ Load the plug-ins via the config.json file and importlib """
-    plugin_dict = {}
+def load_plugins(f: TextIO, args=None) -> Tuple[PluginRegistry, dict]:
+    """
+    Load the plug-ins via the config.json file. Plug-ins listed with their event_name are only imported when first
+     needed, the rest are imported right away with importlib (see utils/plugin_registry.py).
 
+    :param args: TapAPI's command-line arguments, passed to the plug-ins' setup() function
+    :return: (registry, config) where registry.run_funcs has every plug-in's run() function, registry.batch_funcs has
+     the run_batch() function of plug-ins that have one and registry.ack_funcs has the acknowledge() function of
+     deferrable plug-ins (all keyed by event_name)
+    """
     config = json.load(f)
-
-    for count, plugin in enumerate(config["plugins"]):
-        try:
-            plugin = importlib.import_module(plugin)
-            plugin_dict[plugin.event_name] = plugin.run
-            logger.info(f'Successfully loaded plugin "{plugin.event_name}" ({count+1}/{len(config["plugins"])})')
-        except ModuleNotFoundError as e:
-            logger.critical(f'{e}. Recheck your config.json setup or is the plug-in in the /plugins directory?')
-        except AttributeError as e:
-            logger.critical(f'{e}. Recheck your plug-in setup, make sure it meets the requirements in the wiki.')
-
-    return plugin_dict, config
+    return PluginRegistry(config["plugins"], args=args), config
@@ -1,5 +1,6 @@
 import json
 from datetime import datetime
+from psycopg2.extras import execute_values
 
 
 def handle_metrics(conn, event_name: str, metric_data: dict) -> None:
@@ -9,3 +10,17 @@ def handle_metrics(conn, event_name: str, metric_data: dict) -> None:
                 "insert into metrics ( event_name, metric_data, timestamp ) values ( %s, %s, %s )",
                 (event_name, json.dumps(metric_data), datetime.now())
             )
+
+
+def insert_many_metrics(conn, rows: list) -> None:
+    """
+    Insert many metrics in one multi-row insert (and one commit)
+
+    :param conn: The Psycopg2 connection object
+    :param rows: List of (event_name, metric_data as a JSON string, timestamp)
+    """
+    with conn:
+        with conn.cursor() as curs:
+            # Read more: https://www.psycopg.org/docs/extras.html#fast-execution-helpers
+            execute_values(curs, "insert into metrics ( event_name, metric_data, timestamp ) values %s", rows,
+                           page_size=max(len(rows), 1))
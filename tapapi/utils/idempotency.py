@@ -0,0 +1,130 @@
+import time
+import logging
+from datetime import datetime, timedelta
+from psycopg2.extras import Json
+from utils.ttl_cache import TTLCache
+
+_log = logging.getLogger("main.logger")
+
+# The header Ground Modules send the key in (the same name Stripe and others use)
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 64
+
+
+class IdempotencyStore:
+    def __init__(self, window: float = 86400.0, cache_size: int = 4096, claim_timeout: float = 60.0):
+        """
+        Remembers the response of every event sent with an idempotency key, so a retried request gets the same response
+         instead of running the plug-in again (ex. charging a card twice because the first response got lost).
+         Read more: https://stripe.com/docs/api/idempotent_requests
+
+        Responses are kept in memory for fast retries and in the idempotency_keys table, so every TapAPI process (see
+         serve.py) knows about them. Keys are per card: two cards can use the same key without clashing.
+
+        :param window: Seconds a key (and its response) is remembered for
+        :param cache_size: Maximum number of responses kept in memory
+        :param claim_timeout: Seconds after which a key whose request never finished (ex. TapAPI was restarted in the
+         middle of it) can be claimed again
+        """
+        self.window = window
+        self.claim_timeout = claim_timeout
+        self._cache = TTLCache(max_size=cache_size, ttl=window)
+        self._last_purge = 0.0
+
+    def begin(self, uid: str, key: str, event_name: str, conn):
+        """
+        Call before running the plug-in. Either claims the key for this request or returns what to answer instead.
+
+        :return: None if the plug-in should run (then call finish() or abandon()), or (body, response_code) if the key
+         was already used
+        """
+        cached = self._cache.get((uid, key))
+        if cached is not None:
+            return self._replay(cached, event_name)
+
+        now = datetime.now()
+        expired = now - timedelta(seconds=self.window)
+        stale = now - timedelta(seconds=self.claim_timeout)
+
+        with conn:
+            with conn.cursor() as curs:
+                if time.monotonic() - self._last_purge > min(self.window, 3600):
+                    # Every so often, forget the keys of every card that are too old
+                    self._last_purge = time.monotonic()
+                    curs.execute("delete from idempotency_keys where created_at < %s;", (expired,))
+
+                # Claiming the key is a single insert, so two requests with the same key can't both claim it
+                curs.execute("delete from idempotency_keys where uid = %(uid)s and key = %(key)s and "
+                             "(created_at < %(expired)s or (response_code is null and created_at < %(stale)s));"
+                             "insert into idempotency_keys (uid, key, event_name, created_at) "
+                             "values (%(uid)s, %(key)s, %(event_name)s, %(now)s) "
+                             "on conflict do nothing returning key;",
+                             {"uid": uid, "key": key, "event_name": event_name, "now": now, "expired": expired,
+                              "stale": stale})
+
+                if curs.fetchone():
+                    return None
+
+                curs.execute("select event_name, response_code, payload from idempotency_keys "
+                             "where uid = %s and key = %s;", (uid, key))
+                row = curs.fetchone()
+
+        if row is None:
+            # The request that had the key gave it up in the meantime (see abandon())
+            return None
+
+        stored_event_name, response_code, payload = row
+
+        if response_code is None:
+            # The first request is still running
+            _log.warning(f'409: Idempotency key of {uid} is still being processed.')
+            return "Request with this idempotency key is still being processed, try again.", 409
+
+        stored = (stored_event_name, payload, response_code)
+        self._cache.put((uid, key), stored)
+        return self._replay(stored, event_name)
+
+    @staticmethod
+    def _replay(stored: tuple, event_name: str):
+        stored_event_name, payload, response_code = stored
+
+        if stored_event_name != event_name:
+            _log.warning(f'422: Idempotency key reused for a different event ({event_name}).')
+            return "Idempotency key was already used for a different event.", 422
+
+        _log.info('Idempotency key was already used, answering with the stored response.')
+        return payload, response_code
+
+    def finish(self, uid: str, key: str, event_name: str, payload: dict, response_code: int, conn,
+               retry_safe: bool = True) -> None:
+        """
+        Store the response of a request that claimed its key with begin()
+
+        Ground Modules send the same key again after a 5xx (see ESP8266.post()), so a 5xx frees the key up only if
+         running the plug-in again is safe: it didn't run, or it failed without changing anything (a plug-in that
+         answers 5xx must have rolled back what it did). Otherwise, pass retry_safe=False and the 5xx is stored like
+         any other response.
+
+        :param retry_safe: Whether a 5xx response means the plug-in changed nothing
+        """
+        if response_code >= 500 and retry_safe:
+            # Server errors may be temporary, so the key is freed up to let the retry run the plug-in again
+            self.abandon(uid, key, conn)
+            return
+
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("update idempotency_keys set response_code = %s, payload = %s "
+                             "where uid = %s and key = %s;", (response_code, Json(payload), uid, key))
+
+        self._cache.put((uid, key), (event_name, payload, response_code))
+
+    def abandon(self, uid: str, key: str, conn) -> None:
+        """Free up a key claimed with begin() whose plug-in didn't finish (ex. it raised an error)"""
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("delete from idempotency_keys where uid = %s and key = %s and response_code is null;",
+                             (uid, key))
+
+    def stats(self) -> dict:
+        return self._cache.stats()
@@ -1,15 +1,22 @@
+import logging
 import psycopg2.errors
+from utils.migrations import check_schema
 
+_log = logging.getLogger("main.logger")
 
-def is_db_valid(conn):
 
-    with conn:
-        with conn.cursor() as curs:
-            try:
-                curs.execute('select * from metrics;')
-                curs.execute('select * from public_keys;')
-                curs.execute('select * from test_key_pairs;')
-            except psycopg2.errors.Error:
-                return False
+def is_db_valid(conn) -> bool:
+    """
+    Checks that the database has every table and column TapAPI and its plug-ins use, logging what's wrong if it doesn't.
+    Only Postgres's catalog is read (see utils/migrations.py), so this doesn't get slower as the tables grow.
+    """
+    try:
+        problems = check_schema(conn)
+    except psycopg2.errors.Error as e:
+        _log.critical(f'Could not check the database: {e}')
+        return False
 
-            return True
\ No newline at end of file
+    for problem in problems:
+        _log.critical(f'{problem}.')
+
+    return not problems
@@ -0,0 +1,373 @@
+import os
+import glob
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from utils.latency import LatencyHistogram
+from utils.processes import is_running
+
+try:
+    import fcntl
+except ImportError:
+    # Windows doesn't have fcntl, there we just don't lock (only one TapAPI process can run there anyway)
+    fcntl = None
+
+_log = logging.getLogger("main.logger")
+
+
+class JournalError(Exception):
+    """Raised when an event couldn't be written to the journal (so it must not be acknowledged)"""
+
+    def __init__(self, message: str, write: Future = None):
+        """
+        :param write: The record's write if it may still finish (see EventJournal.append()), done once the record is
+         on disk (or failed). None if the record was not saved.
+        """
+        super().__init__(message)
+        self.write = write
+
+
+class EventJournal:
+    def __init__(self, directory: str, apply, batch_size: int = 256, max_bytes: int = 64 * 1024 * 1024,
+                 append_timeout: float = 2.0):
+        """
+        An append-only log of accepted events, kept on disk, that is applied to the database in the background.
+
+        This is called write-behind: instead of waiting for Postgres to commit, TapAPI answers as soon as the event is
+         safely on its own disk (fsync'd), and a background thread (the projector) writes the events to Postgres in
+         batches. If TapAPI crashes or is restarted, the events that weren't applied yet are still in the journal and
+         are applied the next time it starts. Read more: https://en.wikipedia.org/wiki/Write-ahead_logging
+
+        fsync is slow (it waits for the disk), so events that arrive together share one fsync (group commit).
+
+        Each process writes its own journal file (events.<pid>.journal) next to a checkpoint file (events.<pid>.applied)
+         with the seq of the last record applied to the database. Records may be applied more than once if TapAPI dies
+         in the middle of applying a batch, but are never lost once append() returns.
+
+        :param directory: Folder for the journal files (ex. on the server's local SSD)
+        :param apply: Function that writes a list of records to the database, raising an exception if it couldn't
+        :param batch_size: Maximum number of records written per fsync and applied to the database at once
+        :param max_bytes: Once everything in the journal is applied and it's bigger than this, it's emptied
+        :param append_timeout: Seconds append() waits for the record to be on disk before raising a JournalError
+        """
+        self.directory = directory
+        self.apply = apply
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.append_timeout = append_timeout
+
+        self.fsync_latency = LatencyHistogram()
+
+        self._stats = {
+            "appended": 0,
+            "fsyncs": 0,
+            "applied": 0,
+            "apply_failures": 0,
+            "replayed": 0
+        }
+
+        os.makedirs(directory, exist_ok=True)
+        self._reset()
+
+        # The journal file and threads belong to the process that opened them, so forked children open their own
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        # Records waiting to be written, as (record, future)
+        self._to_write = deque()
+        self._write_ready = threading.Condition(self._lock)
+        # Records written (and fsync'd) but not applied to the database yet
+        self._to_apply = deque()
+        self._apply_ready = threading.Condition(threading.Lock())
+        self._stopping = threading.Event()
+
+        self._file = None
+        self._threads = []
+        self._written_seq = 0
+        self._applied_seq = 0
+        self._next_orphan_check = 0.0
+
+    def _paths(self, pid: int):
+        return (os.path.join(self.directory, f'events.{pid}.journal'),
+                os.path.join(self.directory, f'events.{pid}.applied'))
+
+    def start(self) -> None:
+        """Apply the records left behind by TapAPI processes that aren't running anymore (call on startup)"""
+        self._replay_orphans(include_own_pid=True)
+
+    def _ensure_started(self) -> None:
+        """Opens this process's journal and starts the writer and projector threads on the first append()"""
+        if self._threads:
+            return
+
+        with self._lock:
+            if self._threads:
+                return
+
+            journal_path, _ = self._paths(os.getpid())
+            # Unbuffered binary mode, so a write() really hands the bytes over to the operating system
+            self._file = open(journal_path, 'ab', buffering=0)
+
+            self._threads = [
+                threading.Thread(target=self._write_loop, name="tapapi-journal-writer", daemon=True),
+                threading.Thread(target=self._project_loop, name="tapapi-journal-projector", daemon=True)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def append(self, record: dict) -> int:
+        """
+        Write a record to the journal, only returning once it's safely on disk
+
+        :param record: Anything that can be turned into JSON
+        :return: The record's seq (its number in this process's journal)
+        """
+        self._ensure_started()
+        future = Future()
+
+        with self._write_ready:
+            self._to_write.append((record, future))
+            self._write_ready.notify()
+
+        try:
+            return future.result(timeout=self.append_timeout)
+        except TimeoutError:
+            # A record that's still waiting is taken out of the queue, so it's never written
+            if future.cancel():
+                raise JournalError(f"Journal write took longer than {self.append_timeout} seconds, the event was not "
+                                   f"saved")
+            # Too late, it's being written right now
+            raise JournalError(f"Journal write took longer than {self.append_timeout} seconds, the event may still be "
+                               f"saved", write=future)
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._write_ready:
+                while not self._to_write and not self._stopping.is_set():
+                    self._write_ready.wait()
+
+                if not self._to_write:
+                    return
+
+                # Everything that arrived while the last fsync was running is written (and fsync'd) together
+                batch = [self._to_write.popleft() for _ in range(min(len(self._to_write), self.batch_size))]
+
+            # Records whose append() already gave up (and cancelled them) are skipped. The others can't be cancelled
+            #  from now on. Read more: https://docs.python.org/3/library/concurrent.futures.html#future-objects
+            batch = [(record, future) for record, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            seq = self._written_seq
+            lines = []
+            for record, _ in batch:
+                seq += 1
+                lines.append(json.dumps({"seq": seq, **record}) + "\n")
+
+            started = time.perf_counter()
+            try:
+                with self._file_lock:
+                    self._write_durably("".join(lines).encode(), seq)
+            except OSError as e:
+                _log.critical(f'Could not write to the event journal: {e}')
+                for _, future in batch:
+                    future.set_exception(JournalError(str(e)))
+                continue
+
+            self.fsync_latency.observe(time.perf_counter() - started)
+
+            with self._lock:
+                self._stats["appended"] += len(batch)
+                self._stats["fsyncs"] += 1
+
+            with self._apply_ready:
+                self._to_apply.extend(dict(record, seq=seq - len(batch) + index + 1)
+                                      for index, (record, _) in enumerate(batch))
+                self._apply_ready.notify()
+
+            # Only acknowledged once the record is durable
+            for index, (_, future) in enumerate(batch):
+                future.set_result(seq - len(batch) + index + 1)
+
+    def _write_durably(self, data: bytes, last_seq: int) -> None:
+        """Write and fsync the records (the caller holds _file_lock), raising an OSError if they aren't durable"""
+        # Not tell(), which is out of date right after _maybe_truncate() (the file is appended to, wherever tell() is)
+        offset = os.fstat(self._file.fileno()).st_size
+
+        try:
+            self._file.write(data)
+            os.fsync(self._file.fileno())
+        except OSError:
+            try:
+                # Some of the records may have made it to the file before the error. They weren't acknowledged, so
+                #  they are cut off, and their seqs are used again by the next records.
+                self._file.truncate(offset)
+            except OSError:
+                # They couldn't be cut off, so their seqs are never used again (a replay would see two records with
+                #  the same seq otherwise)
+                self._written_seq = last_seq
+            raise
+
+        self._written_seq = last_seq
+
+    def _project_loop(self) -> None:
+        _, applied_path = self._paths(os.getpid())
+
+        while True:
+            with self._apply_ready:
+                if not self._to_apply:
+                    if self._stopping.is_set() and not any(thread.is_alive() for thread in self._threads[:1]):
+                        return
+                    self._apply_ready.wait(1.0)
+
+                batch = [self._to_apply.popleft() for _ in range(min(len(self._to_apply), self.batch_size))]
+
+            if not batch:
+                if time.monotonic() >= self._next_orphan_check:
+                    # Nothing to do, so check for journals left behind by workers that died
+                    self._next_orphan_check = time.monotonic() + 30
+                    self._replay_orphans()
+                continue
+
+            try:
+                self.apply(batch)
+            except Exception as e:
+                _log.critical(f'Could not apply {len(batch)} journal records to the database: {e}')
+                with self._lock:
+                    self._stats["apply_failures"] += 1
+                with self._apply_ready:
+                    self._to_apply.extendleft(reversed(batch))
+                # Give the database some time before trying again
+                time.sleep(1.0)
+                continue
+
+            self._applied_seq = batch[-1]["seq"]
+            _write_checkpoint(applied_path, self._applied_seq)
+
+            with self._lock:
+                self._stats["applied"] += len(batch)
+
+            self._maybe_truncate()
+
+    def _maybe_truncate(self) -> None:
+        """Empty the journal if it got big and everything in it is already in the database"""
+        with self._file_lock:
+            if self._applied_seq != self._written_seq or self._file.tell() < self.max_bytes:
+                return
+
+            # Checked again with the file locked, so nothing can be written in the meantime
+            with self._lock:
+                if self._to_write:
+                    return
+
+            self._file.truncate(0)
+            os.fsync(self._file.fileno())
+            _log.info('Event journal was fully applied, emptied it')
+
+    def _replay_orphans(self, include_own_pid: bool = False) -> None:
+        """Apply and delete the journals of processes that aren't running anymore"""
+        lock_file = open(os.path.join(self.directory, 'replay.lock'), 'w')
+        try:
+            if fcntl is not None:
+                try:
+                    # Only one process replays at a time (and the others skip it instead of waiting)
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return
+
+            for journal_path in glob.glob(os.path.join(self.directory, 'events.*.journal')):
+                pid = int(journal_path.split('.')[-2])
+
+                if pid == os.getpid() and not include_own_pid:
+                    continue
+                if pid != os.getpid() and is_running(pid):
+                    continue
+
+                self._replay(pid)
+        finally:
+            lock_file.close()
+
+    def _replay(self, pid: int) -> None:
+        journal_path, applied_path = self._paths(pid)
+        applied_seq = _read_checkpoint(applied_path)
+
+        records = []
+        with open(journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A record that was only half written when the process died (it was never acknowledged)
+                    continue
+                if record["seq"] > applied_seq:
+                    records.append(record)
+
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            try:
+                self.apply(batch)
+            except Exception as e:
+                # The journal stays there, it will be tried again later
+                _log.critical(f'Could not replay the event journal of process {pid}: {e}')
+                return
+
+            _write_checkpoint(applied_path, batch[-1]["seq"])
+            with self._lock:
+                self._stats["replayed"] += len(batch)
+
+        if records:
+            _log.info(f'Replayed {len(records)} events from the journal of process {pid}')
+
+        os.remove(journal_path)
+        if os.path.exists(applied_path):
+            os.remove(applied_path)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Write and apply every pending record, then stop the threads (ex. when shutting down)"""
+        self._stopping.set()
+        with self._write_ready:
+            self._write_ready.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+        # Only if the threads are done with it (they may still be writing if the timeout ran out)
+        if not any(thread.is_alive() for thread in self._threads):
+            with self._file_lock:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+
+    def stats(self) -> dict:
+        """Returns the counters, how many records are waiting to be applied and how long fsyncs take (in seconds)"""
+        snapshot = self.fsync_latency.snapshot()
+        with self._lock:
+            return {
+                **self._stats,
+                "records_per_fsync": self._stats["appended"] / self._stats["fsyncs"] if self._stats["fsyncs"] else 0.0,
+                "apply_lag": self._written_seq - self._applied_seq,
+                "fsync_latency_p50": self.fsync_latency.percentile(0.50, snapshot),
+                "fsync_latency_p99": self.fsync_latency.percentile(0.99, snapshot)
+            }
+
+
+def _write_checkpoint(path: str, seq: int) -> None:
+    """Atomically replace the checkpoint file (a crash leaves either the old or the new one, never half of one)"""
+    temporary = path + ".tmp"
+    with open(temporary, 'w') as f:
+        f.write(str(seq))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def _read_checkpoint(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
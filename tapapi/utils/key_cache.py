@@ -0,0 +1,102 @@
+import logging
+from typing import NamedTuple
+from utils.ttl_cache import TTLCache
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+
+_log = logging.getLogger("main.logger")
+
+# The JWT algorithms card keys can use, and the type of key each one needs
+# RS256 is what all cards used before, ES256 and EdDSA make much shorter JWTs (see generate_key_pairs())
+_KEY_TYPES = {
+    'RS256': rsa.RSAPublicKey,
+    'ES256': ec.EllipticCurvePublicKey,
+    'EdDSA': ed25519.Ed25519PublicKey
+}
+SUPPORTED_ALGORITHMS = tuple(_KEY_TYPES)
+
+
+class PublicKey(NamedTuple):
+    """A card's public key, both as the PEM text stored in the database and as a loaded (parsed) key object"""
+    pem: str
+    key: object
+    algorithm: str = 'RS256'
+
+
+def load_public_key(pem: str, algorithm: str = 'RS256') -> PublicKey:
+    """Parse a PEM-encoded public key (this is the slow part we want to only do once per card)"""
+    if algorithm not in _KEY_TYPES:
+        raise ValueError(f"Unsupported algorithm {algorithm}")
+
+    key = serialization.load_pem_public_key(bytes(pem, 'utf-8'))
+
+    # Make sure the key really is for the algorithm stored next to it
+    if not isinstance(key, _KEY_TYPES[algorithm]):
+        raise ValueError(f"Public key is not a {algorithm} key")
+
+    if algorithm == 'ES256' and not isinstance(key.curve, ec.SECP256R1):
+        raise ValueError("ES256 keys must use the P-256 (secp256r1) curve")
+
+    return PublicKey(pem=pem, key=key, algorithm=algorithm)
+
+
+class PublicKeyCache(TTLCache):
+    """
+    Remembers the already-parsed public keys of the cards that tapped recently, keyed by UID.
+
+    This way, a card that taps again doesn't need a trip to the database or a PEM parse to be authenticated.
+    Each TapAPI process has its own cache, so call invalidate(uid) whenever a UID's key changes (the ttl takes care
+     of keys changed by other processes or by hand in the database).
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 3600.0, dependents: list = None):
+        """
+        :param max_size: Maximum number of keys stored at once
+        :param ttl: Seconds a key stays valid after being stored
+        :param dependents: Other caches keyed by UID (ex. a VerifiedTokenCache) that must also forget a UID whenever
+         its key is invalidated
+        """
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.dependents = dependents or []
+
+    def invalidate(self, uid) -> bool:
+        for dependent in self.dependents:
+            dependent.invalidate(uid)
+        return super().invalidate(uid)
+
+    def clear(self) -> None:
+        for dependent in self.dependents:
+            dependent.clear()
+        super().clear()
+
+    def put_pem(self, uid: str, pem: str, algorithm: str = 'RS256') -> PublicKey:
+        """Parse a PEM-encoded public key and store it under the UID"""
+        public_key = load_public_key(pem, algorithm)
+        self.put(uid, public_key)
+        return public_key
+
+    def pems(self) -> dict:
+        """Returns {uid: (public_key_pem, algorithm)} of every cached key (ex. to send to other processes)"""
+        return {uid: (public_key.pem, public_key.algorithm) for uid, public_key in self.items()}
+
+    def warm(self, conn) -> int:
+        """
+        Load the public keys of up to max_size cards into the cache at once (ex. on startup)
+
+        :param conn: The Psycopg2 connection object
+        :return: How many keys were loaded
+        """
+        loaded = 0
+
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute("select uid, public_key, algorithm from public_keys limit %s;", (self.max_size,))
+
+                for uid, pem, algorithm in curs:
+                    try:
+                        self.put_pem(uid, pem, algorithm)
+                        loaded += 1
+                    except ValueError:
+                        _log.warning(f'Could not parse the public key of UID {uid}, skipping it')
+
+        return loaded
@@ -0,0 +1,136 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils.authentication import generate_key_pairs
+
+_log = logging.getLogger("main.logger")
+
+
+class KeyPairPool:
+    def __init__(self, target_size: int = 8, workers: int = 1):
+        """
+        Keeps a reserve of pre-generated RSA key pairs so new cards don't have to wait for one.
+
+        Generating a 2048-bit RSA key pair takes a lot of CPU, so instead of making one in the middle of a request,
+         we make them ahead of time in separate processes (so the server itself isn't slowed down) and just grab one
+         from the reserve when a new UID taps. Read more: https://docs.python.org/3/library/concurrent.futures.html
+
+        :param target_size: How many key pairs to keep ready
+        :param workers: How many processes generate key pairs in the background
+        """
+        self.target_size = target_size
+        self.workers = workers
+
+        # deque.append() and deque.popleft() are thread-safe and O(1), perfect for a reserve like this
+        self._pairs = deque()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+        # When each of the recent key pairs finished generating, used to calculate the refill rate
+        self._finished_at = deque(maxlen=256)
+
+        self._stats = {
+            "taken": 0,
+            "generated": 0,
+            "empty_pool_fallbacks": 0,
+            "failures": 0
+        }
+
+        # The background processes belong to the process that started them, so forked children start over
+        #  (see serve.py, which calls start() again in every worker)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        """Runs in a freshly forked child process"""
+        # The reserve is thrown away too, otherwise every worker would hand out the same key pairs to new cards!
+        self._pairs = deque()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def start(self) -> None:
+        """Start generating key pairs in the background until the pool is full"""
+        if self.target_size > 0:
+            self._refill()
+
+    def shutdown(self, wait: bool = False) -> None:
+        """
+        Stop the background processes (key pairs that are still generating are thrown away)
+
+        :param wait: Wait for the processes to actually exit (ex. before forking, see serve.py)
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        # Outside the lock, since the callbacks of the key pairs being thrown away need it
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _refill(self) -> None:
+        """Ask the background processes for as many key pairs as needed to get back to target_size"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+            missing = self.target_size - len(self._pairs) - self._pending
+            for _ in range(missing):
+                self._pending += 1
+                self._executor.submit(generate_key_pairs).add_done_callback(self._on_generated)
+
+    def _on_generated(self, future) -> None:
+        """Runs (in a background thread) whenever a process finishes generating a key pair"""
+        with self._lock:
+            self._pending -= 1
+
+            if future.cancelled():
+                return
+
+            if future.exception() is not None:
+                self._stats["failures"] += 1
+                _log.critical(f'Background key pair generation failed: {future.exception()}')
+                return
+
+            self._stats["generated"] += 1
+            self._finished_at.append(time.monotonic())
+            self._pairs.append(future.result())
+
+    def take(self):
+        """
+        Get a key pair, ready to use
+
+        :return: utf-8 decrypted (public_key, private_key), just like generate_key_pairs()
+        """
+        try:
+            pair = self._pairs.popleft()
+        except IndexError:
+            # The reserve ran out (ex. lots of new cards at once), so make one the slow way
+            _log.warning('Key pair pool is empty, generating a key pair in the request instead')
+            with self._lock:
+                self._stats["empty_pool_fallbacks"] += 1
+            pair = generate_key_pairs()
+
+        with self._lock:
+            self._stats["taken"] += 1
+
+        if self.target_size > 0:
+            self._refill()
+
+        return pair
+
+    def stats(self) -> dict:
+        """Returns the pool's depth, refill rate (key pairs per second over the last minute) and counters"""
+        with self._lock:
+            now = time.monotonic()
+            recent = [t for t in self._finished_at if now - t <= 60]
+
+            return {
+                "depth": len(self._pairs),
+                "target_size": self.target_size,
+                "pending": self._pending,
+                "refill_rate": len(recent) / 60,
+                **self._stats
+            }
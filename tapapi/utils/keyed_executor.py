@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class KeyedExecutor:
+    def __init__(self, max_workers: int = None):
+        """
+        Runs tasks in a pool of threads, but never runs two tasks with the same key at the same time, and runs the tasks
+         of each key in the order they were submitted.
+
+        TapAPI uses the card's UID as the key. Two taps of the SAME card (ex. two canteen debits) always run one after
+         the other, in order, while taps of DIFFERENT cards still run in parallel. A single global lock would also make
+         things correct, but then only one card could be handled at a time.
+
+        Each TapAPI process has its own KeyedExecutor, so with several serve.py workers this only orders the taps that
+         reach the same worker (the database's row locks take care of the rest, see canteen_utils.apply_transaction).
+
+        :param max_workers: Maximum number of tasks (of different keys) running at once in the KeyedExecutor's own
+         threads, which are only started on the first submit() (submit_to() runs tasks in another executor instead)
+        """
+        self.max_workers = max_workers
+        self._reset()
+
+        # Threads don't survive a fork (see serve.py), so a forked child starts with a fresh pool
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # The in-flight map: every key that has a task running has an entry here, with the tasks waiting behind it
+        #  {key: deque([(future, executor, fn, args, kwargs), ...])}
+        self._queues = {}
+
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "waited_for_same_key": 0
+        }
+
+    def submit(self, key, fn, *args, **kwargs) -> Future:
+        """
+        Run fn(*args, **kwargs) once every task submitted before it with the same key is done
+
+        :return: A Future, call .result() on it to wait for fn's return value (or exception)
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tapapi-keyed")
+
+        return self.submit_to(self._executor, key, fn, *args, **kwargs)
+
+    def submit_to(self, executor, key, fn, *args, **kwargs) -> Future:
+        """
+        Like submit(), but fn runs in the given executor instead of the KeyedExecutor's own threads (ex. in the
+         plug-in's utils.Bulkhead). Tasks of the same key are still run one at a time and in order.
+
+        Cancelling the returned Future before fn started means fn never runs
+        """
+        future = Future()
+
+        with self._lock:
+            self._stats["submitted"] += 1
+            waiting = self._queues.get(key)
+
+            if waiting is not None:
+                # A task with this key is already running, so get in line behind it
+                waiting.append((future, executor, fn, args, kwargs))
+                self._stats["waited_for_same_key"] += 1
+                return future
+
+            self._queues[key] = deque()
+
+        executor.submit(self._run, key, future, fn, args, kwargs)
+        return future
+
+    def _run(self, key, future: Future, fn, args, kwargs) -> None:
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        with self._lock:
+            self._stats["completed"] += 1
+            waiting = self._queues[key]
+
+            if not waiting:
+                del self._queues[key]
+                return
+
+            next_future, executor, *next_task = waiting.popleft()
+
+        # Give the next task of this key back to the pool instead of running it right here, so a card that taps a
+        #  lot can't keep a thread to itself while other cards wait
+        executor.submit(self._run, key, next_future, *next_task)
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executor = self._executor
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        """Returns how many keys have a task running, how many tasks are waiting behind them, and the counters"""
+        with self._lock:
+            return {
+                "max_workers": self._executor._max_workers if self._executor is not None else self.max_workers,
+                "in_flight_keys": len(self._queues),
+                "queued": sum(len(waiting) for waiting in self._queues.values()),
+                **self._stats
+            }
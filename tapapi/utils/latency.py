@@ -0,0 +1,151 @@
+import time
+import threading
+from bisect import bisect_left
+
+# Upper bounds (in seconds) of the histogram buckets, from 50 microseconds (parsing a payload is about that fast)
+#  up to 10 seconds. Read more: https://prometheus.io/docs/practices/histograms/
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Counts how many measurements fell into each bucket instead of storing every single one.
+
+        This makes recording a measurement O(log buckets) and the memory used constant, no matter how many taps
+         TapAPI handles. The price is that percentiles are estimates (accurate to about the width of a bucket).
+
+        :param buckets: Sorted upper bounds of the buckets, in seconds (an extra +Inf bucket is always added)
+        """
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += seconds
+            self._count += 1
+
+    def snapshot(self):
+        """Returns (bucket counts, sum, count), all from the same moment"""
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    def percentile(self, p: float, snapshot=None) -> float:
+        """
+        Estimate the p-th percentile (ex. 0.95) by finding its bucket and assuming the measurements inside that
+         bucket are spread out evenly (the same estimate Prometheus' histogram_quantile() makes)
+        """
+        counts, _, count = snapshot or self.snapshot()
+
+        if count == 0:
+            return 0.0
+
+        rank = p * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count > 0:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                # Measurements in the +Inf bucket are reported as the largest finite bound
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+
+        return self.buckets[-1]
+
+
+class LatencyRecorder:
+    def __init__(self, enabled: bool = True, buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Records how long each stage of handling an event takes, with one histogram per (event_name, stage).
+
+        Usage, where started is None when the recorder is disabled (so the only cost left is a function call):
+
+            started = latency.start()
+            payload_data = payload_decoder.decode(body)
+            latency.observe('parse', payload_data.event_name, started)
+
+        Each process has its own histograms (ex. every worker started by serve.py).
+
+        :param enabled: Record anything at all
+        :param buckets: Upper bounds of the histogram buckets, in seconds
+        """
+        self.enabled = enabled
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """:return: The current time to pass to observe(), or None if disabled"""
+        return time.perf_counter() if self.enabled else None
+
+    def observe(self, stage: str, event_name: str, started) -> None:
+        """Record the time passed since started (from start()) under the event_name and stage"""
+        if started is None:
+            return
+
+        elapsed = time.perf_counter() - started
+        key = (event_name, stage)
+
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram(self.buckets))
+
+        histogram.observe(elapsed)
+
+    def summary(self) -> dict:
+        """Returns {event_name: {stage: {count, mean, p50, p95, p99}}} with the times in seconds"""
+        result = {}
+
+        for (event_name, stage), histogram in sorted(self._histograms.copy().items()):
+            snapshot = histogram.snapshot()
+            _, total, count = snapshot
+            result.setdefault(event_name, {})[stage] = {
+                "count": count,
+                "mean": total / count if count else 0.0,
+                "p50": histogram.percentile(0.50, snapshot),
+                "p95": histogram.percentile(0.95, snapshot),
+                "p99": histogram.percentile(0.99, snapshot)
+            }
+
+        return result
+
+    def prometheus(self, name: str = "tapapi_stage_latency_seconds") -> str:
+        """
+        Returns the histograms in the Prometheus text format, so they can be scraped
+        Read more: https://prometheus.io/docs/instrumenting/exposition_formats/
+        """
+        histogram_lines = [
+            f"# HELP {name} Time spent in each stage of handling an event",
+            f"# TYPE {name} histogram"
+        ]
+        quantile_lines = [
+            f"# HELP {name}_quantile Estimated p50/p95/p99 of each stage, from the histogram",
+            f"# TYPE {name}_quantile gauge"
+        ]
+
+        for (event_name, stage), histogram in sorted(self._histograms.copy().items()):
+            snapshot = histogram.snapshot()
+            counts, total, count = snapshot
+            labels = f'event_name="{event_name}",stage="{stage}"'
+
+            # Prometheus buckets are cumulative (every bucket also counts the ones below it)
+            cumulative = 0
+            for bound, bucket_count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                histogram_lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+            histogram_lines.append(f'{name}_sum{{{labels}}} {total}')
+            histogram_lines.append(f'{name}_count{{{labels}}} {count}')
+
+            for quantile in (0.5, 0.95, 0.99):
+                quantile_lines.append(f'{name}_quantile{{{labels},quantile="{quantile}"}} '
+                                      f'{histogram.percentile(quantile, snapshot)}')
+
+        return "\n".join(histogram_lines + quantile_lines) + "\n"
@@ -0,0 +1,303 @@
+import os
+import glob
+import json
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from utils.latency import LatencyHistogram
+from utils.processes import is_running
+from utils.handle_metrics import insert_many_metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows doesn't have fcntl, there only the threads of this process are kept apart (only one TapAPI process can
+    #  run there anyway)
+    fcntl = None
+
+_log = logging.getLogger("main.logger")
+
+
+class MetricsWriter:
+    def __init__(self, pool, max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 1.0,
+                 spill_path: str = None):
+        """
+        Writes Ground Module metrics to the database in the background, many rows at a time.
+
+        Inserting (and committing) every heartbeat on its own makes Postgres do a disk flush per metric. Instead,
+         /metrics just puts the metric in a queue and answers right away, while a background thread inserts
+         everything in the queue at once, either when batch_size metrics are waiting or every flush_interval seconds.
+
+        The queue is bounded so a slow or down database can't make TapAPI run out of memory. When it's full, metrics
+         are written to the spill file (and inserted later, once things calm down) or dropped if there isn't one.
+
+        :param pool: The ConnectionPool to borrow connections from
+        :param max_queue: Maximum number of metrics waiting to be written
+        :param batch_size: Maximum number of metrics inserted at once
+        :param flush_interval: Maximum seconds a metric waits in the queue before being written
+        :param spill_path: File (JSON lines) for metrics that don't fit in the queue or failed to insert. None to drop
+         them instead.
+        """
+        self.pool = pool
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+
+        self.flush_latency = LatencyHistogram()
+
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "flushes": 0,
+            "failed_flushes": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "dropped": 0
+        }
+
+        self._reset()
+
+        # The writer thread only exists in the process that started it (see serve.py)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        # queue.Queue is thread-safe, and put_nowait() fails right away instead of waiting if the queue is full
+        # Read more: https://docs.python.org/3/library/queue.html
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._next_replay = 0.0
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[counter] += amount
+
+    def _ensure_started(self) -> None:
+        """Starts the writer thread on the first metric, so it's started in the process that actually serves them"""
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tapapi-metrics-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, event_name: str, metric_data: dict) -> bool:
+        """
+        Queue a metric to be written
+
+        :return: True if it will be written, False if it was dropped because the queue was full
+        """
+        self._ensure_started()
+        row = (event_name, json.dumps(metric_data), datetime.now())
+
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            if self._spill([row]):
+                return True
+
+            self._count("dropped")
+            _log.warning('Metrics queue is full, dropped a metric')
+            return False
+
+        self._count("submitted")
+        return True
+
+    def _take_batch(self) -> list:
+        """Wait for up to batch_size metrics, or until flush_interval seconds have passed"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if self._stopping.is_set():
+                    # Shutting down, so write out whatever is left without waiting for more
+                    batch.append(self._queue.get_nowait())
+                elif remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    break
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                batch = self._take_batch()
+
+                if batch:
+                    self._flush(batch)
+                elif self.spill_path and time.monotonic() >= self._next_replay and not self._stopping.is_set():
+                    # Nothing new to write, so catch up on the metrics that were spilled to disk
+                    self._replay_spill()
+            except Exception:
+                # If this thread died, every metric from then on would pile up in the queue (and then be dropped)
+                _log.exception('Unexpected error in the metrics writer, it keeps running')
+                self._stopping.wait(self.flush_interval)
+
+    def _insert(self, rows: list) -> bool:
+        """Insert the rows at once. Returns False if the database couldn't be written to."""
+        started = time.perf_counter()
+
+        try:
+            with self.pool.connection() as conn:
+                insert_many_metrics(conn, rows)
+        except Exception as e:
+            _log.critical(f'Could not write {len(rows)} metrics to the database: {e}')
+            self._count("failed_flushes")
+            return False
+
+        self.flush_latency.observe(time.perf_counter() - started)
+        with self._lock:
+            self._stats["written"] += len(rows)
+            self._stats["flushes"] += 1
+
+        return True
+
+    def _flush(self, rows: list) -> bool:
+        """Insert the rows at once. If that fails they are spilled (or dropped)."""
+        if self._insert(rows):
+            return True
+
+        if not self._spill(rows):
+            self._count("dropped", len(rows))
+
+        # Give the database some time before trying again
+        self._stopping.wait(self.flush_interval)
+        return False
+
+    @contextmanager
+    def _spill_locked(self):
+        """
+        Holds the spill file, for the threads of this process and for the other processes using the same one (every
+         worker started by serve.py shares --metrics-spill-file). Appends open and close the file while holding it,
+         so once it's renamed for a replay, nobody can still be writing to it under its old name.
+        """
+        with self._spill_lock, open(f'{self.spill_path}.lock', 'a') as lock_file:
+            if fcntl is not None:
+                # Released when the file is closed. Read more: https://docs.python.org/3/library/fcntl.html#fcntl.flock
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _spill(self, rows: list) -> bool:
+        """Append the rows to the spill file. Returns False if there is no spill file or it couldn't be written."""
+        if not self.spill_path:
+            return False
+
+        try:
+            with self._spill_locked():
+                with open(self.spill_path, 'a') as f:
+                    f.writelines(map(_spill_line, rows))
+        except OSError as e:
+            _log.critical(f'Could not spill metrics to {self.spill_path}: {e}')
+            return False
+
+        self._count("spilled", len(rows))
+        return True
+
+    def _replay_spill(self) -> None:
+        """
+        Insert the metrics in the spill file (and in the leftovers of processes that died while replaying)
+
+        A file being replayed is only deleted once all of its metrics are in the database. If the database fails
+         halfway, the file is rewritten with the metrics that are still missing. If TapAPI dies halfway, the metrics
+         already inserted from that file are inserted a second time.
+        """
+        # Move the spill file out of the way first, so metrics spilled while we replay go to a new one. If the last
+        #  replay of this process didn't finish, that one goes first (renaming onto it would overwrite it).
+        replaying = f'{self.spill_path}.{os.getpid()}.replaying'
+        try:
+            with self._spill_locked():
+                if not os.path.exists(replaying):
+                    os.rename(self.spill_path, replaying)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            _log.critical(f'Could not replay the spilled metrics in {self.spill_path}: {e}')
+
+        for path in glob.glob(f'{self.spill_path}.*.replaying'):
+            pid = path.split('.')[-2]
+            if not pid.isdigit() or (int(pid) != os.getpid() and is_running(int(pid))):
+                # Another worker is replaying this one
+                continue
+
+            try:
+                rows = _read_spill(path)
+            except OSError as e:
+                _log.critical(f'Could not read the spilled metrics in {path}: {e}')
+                continue
+
+            for start in range(0, len(rows), self.batch_size):
+                if not self._insert(rows[start:start + self.batch_size]):
+                    # The database is still having trouble, so keep what's left for later
+                    self._rewrite_spill(path, rows[start:])
+                    self._next_replay = time.monotonic() + 30
+                    return
+
+                self._count("replayed", len(rows[start:start + self.batch_size]))
+
+            os.remove(path)
+
+    def _rewrite_spill(self, path: str, rows: list) -> None:
+        """Replace the file with only these rows (a crash leaves either the old or the new file, never half of one)"""
+        temporary = path + ".tmp"
+        try:
+            with open(temporary, 'w') as f:
+                f.writelines(map(_spill_line, rows))
+            os.replace(temporary, path)
+        except OSError as e:
+            # The old file is still there, so its metrics that did make it to the database will be inserted again
+            _log.critical(f'Could not rewrite the spilled metrics in {path}: {e}')
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Write out every queued metric and stop the writer thread (ex. when shutting down)"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        """Returns the queue depth, the counters and how long flushes take (p50/p95/p99, in seconds)"""
+        snapshot = self.flush_latency.snapshot()
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self.max_queue,
+                **self._stats,
+                "flush_latency_p50": self.flush_latency.percentile(0.50, snapshot),
+                "flush_latency_p95": self.flush_latency.percentile(0.95, snapshot),
+                "flush_latency_p99": self.flush_latency.percentile(0.99, snapshot)
+            }
+
+
+def _spill_line(row: tuple) -> str:
+    event_name, metric_data, timestamp = row
+    return json.dumps([event_name, metric_data, timestamp.isoformat()]) + "\n"
+
+
+def _read_spill(path: str) -> list:
+    """The rows of a spill file, skipping lines that can't be read (ex. half written when TapAPI crashed)"""
+    rows = []
+    skipped = 0
+
+    with open(path) as f:
+        for line in f:
+            try:
+                event_name, metric_data, timestamp = json.loads(line)
+                rows.append((event_name, metric_data, datetime.fromisoformat(timestamp)))
+            except (ValueError, TypeError):
+                skipped += 1
+
+    if skipped:
+        _log.warning(f'Skipped {skipped} unreadable line(s) in the spilled metrics in {path}')
+
+    return rows
@@ -0,0 +1,245 @@
+import logging
+from typing import NamedTuple
+
+_log = logging.getLogger("main.logger")
+
+
+class Migration(NamedTuple):
+    """One numbered change to the database. Never edit a migration once it's released, add a new one instead."""
+    version: int
+    name: str
+    sql: str
+
+
+# Every change to TapAPI's tables, in order. A database is at version N once migrations 1 to N were applied to it.
+# The first migrations use "if not exists", so databases made before migrations existed (with extras/make_databases.py
+#  and the extras/add_*.py scripts) are picked up where they are instead of failing.
+MIGRATIONS = (
+    Migration(1, "core tables", """
+        create table if not exists public_keys (
+            uid varchar(11) primary key,
+            public_key text unique
+        );
+
+        create table if not exists test_key_pairs (
+            uid varchar(11) primary key,
+            private_key text,
+            public_key text
+        );
+
+        create table if not exists metrics (
+            metric_id serial primary key,
+            event_name text,
+            metric_data json,
+            timestamp timestamp
+        );
+    """),
+
+    # Cards can use ES256/EdDSA keys, every key made before that is an RS256 key
+    Migration(2, "key algorithm column", """
+        alter table public_keys add column if not exists algorithm text not null default 'RS256';
+        alter table test_key_pairs add column if not exists algorithm text not null default 'RS256';
+    """),
+
+    # Responses to events sent with an Idempotency-Key header (see utils/idempotency.py)
+    Migration(3, "idempotency keys", """
+        create table if not exists idempotency_keys (
+            uid varchar(11) not null,
+            key text not null,
+            event_name text not null,
+            response_code integer,
+            payload json,
+            created_at timestamp not null,
+            primary key (uid, key)
+        );
+    """),
+
+    # The tables of the plug-ins that come with TapAPI. book_ids comes first since books_borrowed references it.
+    Migration(4, "plug-in tables", """
+        create table if not exists book_ids (
+            book_id serial primary key,
+            book_name text
+        );
+
+        create table if not exists books_borrowed (
+            borrow_id serial primary key,
+            book_id int references book_ids(book_id) not null,
+            due_on date not null,
+            uid varchar(11)
+        );
+        -- library_utils looks borrows up by the card's UID
+        alter table books_borrowed add column if not exists uid varchar(11);
+
+        create table if not exists canteen_chits (
+            transaction_number serial primary key,
+            uid varchar(11),
+            balance integer
+        );
+
+        create table if not exists canteen_transactions (
+            transaction_id serial primary key,
+            timestamp timestamp,
+            uid varchar(11),
+            action integer,
+            new_bal integer,
+            amount integer
+        );
+
+        create table if not exists attendance (
+            id serial primary key,
+            name text,
+            uid varchar(11),
+            date timestamp
+        );
+    """),
+
+    # Google Sheets rows waiting to be sent by the books_library plug-in (see plugins/plugin_utils/sheets_outbox.py)
+    Migration(5, "sheets outbox", """
+        create table if not exists sheets_outbox (
+            outbox_id serial primary key,
+            row json not null,
+            attempts integer not null default 0,
+            next_attempt_at timestamptz not null default now()
+        );
+    """),
+
+    # Without an index, looking rows up by uid reads the whole table, so taps get slower as the tables grow
+    # Read more: https://www.postgresql.org/docs/current/indexes-intro.html
+    Migration(6, "indexes", """
+        -- Before canteen_utils registered cards safely, two first taps at the same time could give a card two rows,
+        --  and the unique index below can't be made until there's only one. Every balance update changed all of the
+        --  card's rows, so they hold the same balance: the oldest row is kept with the highest of them (adding them up
+        --  would double the card's balance).
+        with duplicated as (
+            select uid, min(transaction_number) as kept, max(balance) as balance
+            from canteen_chits
+            where uid is not null
+            group by uid
+            having count(*) > 1
+        ), removed as (
+            delete from canteen_chits
+            using duplicated
+            where canteen_chits.uid = duplicated.uid and canteen_chits.transaction_number <> duplicated.kept
+        )
+        update canteen_chits
+        set balance = duplicated.balance
+        from duplicated
+        where canteen_chits.transaction_number = duplicated.kept;
+
+        -- One balance per card. canteen_utils's "on conflict do nothing" relies on it to register a card only once.
+        create unique index if not exists canteen_chits_uid_key on canteen_chits (uid);
+        create index if not exists canteen_transactions_uid_idx on canteen_transactions (uid, timestamp);
+        create index if not exists books_borrowed_uid_idx on books_borrowed (uid);
+        create index if not exists attendance_uid_idx on attendance (uid, date);
+        -- IdempotencyStore deletes expired keys by created_at
+        create index if not exists idempotency_keys_created_at_idx on idempotency_keys (created_at);
+    """),
+)
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# The columns TapAPI and its plug-ins use, checked at startup by check_schema()
+EXPECTED_COLUMNS = {
+    "public_keys": {"uid", "public_key", "algorithm"},
+    "test_key_pairs": {"uid", "private_key", "public_key", "algorithm"},
+    "metrics": {"metric_id", "event_name", "metric_data", "timestamp"},
+    "idempotency_keys": {"uid", "key", "event_name", "response_code", "payload", "created_at"},
+    "book_ids": {"book_id", "book_name"},
+    "books_borrowed": {"borrow_id", "book_id", "due_on", "uid"},
+    "canteen_chits": {"transaction_number", "uid", "balance"},
+    "canteen_transactions": {"transaction_id", "timestamp", "uid", "action", "new_bal", "amount"},
+    "attendance": {"id", "name", "uid", "date"},
+    "sheets_outbox": {"outbox_id", "row", "attempts", "next_attempt_at"}
+}
+
+# Any number works, as long as nothing else in the database uses it for an advisory lock
+_MIGRATION_LOCK_ID = 7_274_001
+
+
+def migrate(conn, target: int = LATEST_VERSION) -> list:
+    """
+    Applies the migrations the database doesn't have yet, up to version target.
+
+    Everything happens in one transaction (in Postgres, even create table can be rolled back), so if a migration fails
+     the database stays exactly as it was. An advisory lock makes other TapAPI processes starting at the same time
+     wait, instead of applying the same migrations twice. Read more:
+     https://www.postgresql.org/docs/current/explicit-locking.html#ADVISORY-LOCKS
+
+    :param conn: The Psycopg2 connection object
+    :param target: The version to migrate to
+    :return: The migrations that were applied
+    """
+    applied = []
+
+    with conn:
+        with conn.cursor() as curs:
+            # Released by itself when the transaction ends
+            curs.execute("select pg_advisory_xact_lock(%s);", (_MIGRATION_LOCK_ID,))
+            curs.execute("""
+                create table if not exists schema_migrations (
+                    version integer primary key,
+                    name text not null,
+                    applied_at timestamptz not null default now()
+                );
+            """)
+
+            curs.execute("select version from schema_migrations;")
+            done = {version for version, in curs.fetchall()}
+
+            for migration in MIGRATIONS:
+                if migration.version in done or migration.version > target:
+                    continue
+
+                _log.warning(f'Applying database migration {migration.version} ({migration.name})')
+                curs.execute(migration.sql)
+                curs.execute("insert into schema_migrations (version, name) values (%s, %s);",
+                             (migration.version, migration.name))
+                applied.append(migration)
+
+    return applied
+
+
+def schema_version(curs) -> int:
+    """:return: The version the database is at, 0 if it was never migrated"""
+    # to_regclass() returns null instead of raising an error when the table doesn't exist
+    curs.execute("select to_regclass('schema_migrations') is not null;")
+    if not curs.fetchone()[0]:
+        return 0
+
+    curs.execute("select coalesce(max(version), 0) from schema_migrations;")
+    return curs.fetchone()[0]
+
+
+def check_schema(conn) -> list:
+    """
+    Checks that the database is at the latest version and has every table and column in EXPECTED_COLUMNS.
+
+    It only reads Postgres's catalog (where Postgres describes the tables), never the tables themselves, so it takes
+     the same time whether the tables have ten rows or ten million. Read more:
+     https://www.postgresql.org/docs/current/information-schema.html
+
+    :param conn: The Psycopg2 connection object
+    :return: What's wrong with the database, as messages (empty if nothing)
+    """
+    problems = []
+
+    with conn:
+        with conn.cursor() as curs:
+            version = schema_version(curs)
+            if version < LATEST_VERSION:
+                problems.append(f"The database is at version {version} out of {LATEST_VERSION}")
+
+            curs.execute("select table_name, column_name from information_schema.columns "
+                         "where table_schema = current_schema() and table_name = any(%s);", (list(EXPECTED_COLUMNS),))
+            found = {}
+            for table_name, column_name in curs.fetchall():
+                found.setdefault(table_name, set()).add(column_name)
+
+    for table_name, columns in EXPECTED_COLUMNS.items():
+        if table_name not in found:
+            problems.append(f"The {table_name} table is missing")
+        elif not columns <= found[table_name]:
+            missing = ", ".join(sorted(columns - found[table_name]))
+            problems.append(f"The {table_name} table is missing the column(s) {missing}")
+
+    return problems
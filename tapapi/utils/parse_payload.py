@@ -1,8 +1,12 @@
 from typing import Union
+from datetime import datetime
 
 
 class TapAPIRequestPayload:
-    def __init__(self, jwt: str, event_name: str, uid: str, event_data: dict):
+    # No per-object __dict__, since one of these is made for every event
+    __slots__ = ("jwt", "event_name", "uid", "event_data", "received_at")
+
+    def __init__(self, jwt: str, event_name: str, uid: str, event_data: dict, received_at: datetime = None):
         """
         Data wrapper class for easy Ground Module payload data access.
 
@@ -11,11 +15,14 @@ class TapAPIRequestPayload:
          error will be thrown.
         :param uid: The UID of the card (must be hex casted to string).
         :param event_data: The data associated with the event.
+        :param received_at: When TapAPI received the event. Only set for events saved to the event journal, which
+         reach the plug-in later (see utils/journal.py).
         """
         self.jwt = jwt
         self.event_name = event_name
         self.uid = uid
         self.event_data = event_data
+        self.received_at = received_at
 
 
 def parse_payload(payload: dict) -> Union[KeyError, TapAPIRequestPayload]:
@@ -25,5 +32,6 @@ def parse_payload(payload: dict) -> Union[KeyError, TapAPIRequestPayload]:
     if all(k in payload for k in ("jwt", "uid", "event_name", "event_data")):
         if type(payload["jwt"]) == str and len(payload["uid"]) == 11 and type(payload["event_data"]) == dict:
             return TapAPIRequestPayload(payload["jwt"], payload["event_name"], payload["uid"], payload["event_data"])
+        raise KeyError("Invalid payload")
     else:
         raise KeyError("Incomplete payload")
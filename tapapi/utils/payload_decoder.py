@@ -0,0 +1,253 @@
+import re
+import json
+import logging
+from collections.abc import Mapping
+from utils.parse_payload import TapAPIRequestPayload
+
+_log = logging.getLogger("main.logger")
+
+# Python types allowed for each JSON Schema type. bool is checked separately from int, since True is an int in Python.
+_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "object": (dict,),
+    "array": (list,),
+    "null": (type(None),)
+}
+
+# Every TapAPI payload looks like this. Plug-ins describe their own event_data (see event_data_schema in canteen.py)
+ENVELOPE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "jwt": {"type": "string", "minLength": 1},
+        # The card's UID, as 4 bytes in hex separated by spaces (like formatted_uid() in the Ground Module makes it)
+        "uid": {"type": "string", "pattern": "^[0-9A-Fa-f]{2}( [0-9A-Fa-f]{2}){3}$", "examples": ["AB CD EF 12"]},
+        "event_name": {"type": "string", "minLength": 1},
+        "event_data": {"type": "object"}
+    },
+    "required": ["jwt", "uid", "event_name", "event_data"]
+}
+
+
+def compile_pattern(pattern: str):
+    """
+    Compiles a JSON Schema pattern. In JSON Schema (like in JavaScript) $ only matches at the very end, but in Python
+     it also matches before a new line at the end, so "AB CD EF 12\\n" would pass as a UID. A $ at the end of the
+     pattern is turned into \\Z, which doesn't. Read more:
+     https://docs.python.org/3/library/re.html#regular-expression-syntax
+    """
+    if pattern.endswith("$") and not pattern.endswith("\\$"):
+        pattern = pattern[:-1] + "\\Z"
+    return re.compile(pattern)
+
+
+class PayloadError(ValueError):
+    """Raised when a payload doesn't follow the TapAPI format. The message says exactly what is wrong with it."""
+
+
+def compile_schema(schema: dict, path: str = "payload"):
+    """
+    Turns a JSON Schema into a function that checks a value against it, raising a PayloadError if it doesn't match.
+     Read more: https://json-schema.org/understanding-json-schema/
+
+    The schema is only read once, here, so checking a value is just a few function calls (instead of going through the
+     whole schema every time). Only the keywords TapAPI needs are supported: type, enum, minimum, maximum, minLength,
+     maxLength, pattern, properties, required, additionalProperties (true/false) and items.
+
+    :param path: Where the value is in the payload, used in the error messages (ex. event_data.bal)
+    :return: A function that takes the value to check
+    """
+    checks = []
+
+    if "type" in schema:
+        type_names = schema["type"] if type(schema["type"]) == list else [schema["type"]]
+        allowed = frozenset(python_type for name in type_names for python_type in _TYPES[name])
+        expected = " or ".join(type_names)
+
+        def check_type(value):
+            # type() instead of isinstance(), so True doesn't pass as an integer
+            if type(value) not in allowed:
+                raise PayloadError(f"{path} must be {'an' if expected[0] in 'aeiou' else 'a'} {expected}")
+        checks.append(check_type)
+
+    if "enum" in schema:
+        options = schema["enum"]
+
+        def check_enum(value):
+            if value not in options:
+                raise PayloadError(f"{path} must be one of {', '.join(json.dumps(option) for option in options)}")
+        checks.append(check_enum)
+
+    # The other keywords only apply to values of their type, like in JSON Schema
+    if "minimum" in schema or "maximum" in schema:
+        minimum, maximum = schema.get("minimum"), schema.get("maximum")
+
+        def check_range(value):
+            if type(value) not in (int, float):
+                return
+            if minimum is not None and value < minimum:
+                raise PayloadError(f"{path} must be at least {minimum}")
+            if maximum is not None and value > maximum:
+                raise PayloadError(f"{path} must be at most {maximum}")
+        checks.append(check_range)
+
+    if "minLength" in schema or "maxLength" in schema:
+        min_length, max_length = schema.get("minLength", 0), schema.get("maxLength")
+
+        def check_length(value):
+            if type(value) != str:
+                return
+            if len(value) < min_length:
+                raise PayloadError(f"{path} must be at least {min_length} characters long")
+            if max_length is not None and len(value) > max_length:
+                raise PayloadError(f"{path} must be at most {max_length} characters long")
+        checks.append(check_length)
+
+    if "pattern" in schema:
+        pattern = compile_pattern(schema["pattern"])
+        example = f" (ex. {schema['examples'][0]})" if schema.get("examples") else ""
+
+        def check_pattern(value):
+            if type(value) == str and not pattern.search(value):
+                raise PayloadError(f"{path} must match {schema['pattern']}{example}")
+        checks.append(check_pattern)
+
+    if "required" in schema:
+        required = schema["required"]
+
+        def check_required(value):
+            if type(value) != dict:
+                return
+            for name in required:
+                if name not in value:
+                    raise PayloadError(f"{path}.{name} is missing" if path != "payload" else f"{name} is missing")
+        checks.append(check_required)
+
+    if "properties" in schema:
+        properties = {
+            name: compile_schema(property_schema, f"{path}.{name}" if path != "payload" else name)
+            for name, property_schema in schema["properties"].items()
+        }
+
+        def check_properties(value):
+            if type(value) != dict:
+                return
+            for name, check in properties.items():
+                if name in value:
+                    check(value[name])
+        checks.append(check_properties)
+
+    if schema.get("additionalProperties") is False:
+        known = set(schema.get("properties", {}))
+
+        def check_additional(value):
+            if type(value) != dict:
+                return
+            for name in value:
+                if name not in known:
+                    raise PayloadError(f"{path}.{name} is not allowed" if path != "payload"
+                                       else f"{name} is not allowed")
+        checks.append(check_additional)
+
+    if "items" in schema:
+        check_item = compile_schema(schema["items"], f"{path}[]")
+
+        def check_items(value):
+            if type(value) != list:
+                return
+            for item in value:
+                check_item(item)
+        checks.append(check_items)
+
+    # Skip the loop when there's a single check, most properties only have a type
+    if len(checks) == 1:
+        return checks[0]
+
+    def check(value):
+        for single_check in checks:
+            single_check(value)
+
+    return check
+
+
+class PayloadDecoder:
+    def __init__(self, event_data_schemas: Mapping = None):
+        """
+        Turns the body of a request into a TapAPIRequestPayload, checking it on the way. Anything wrong with it raises a
+         PayloadError saying exactly what, so the Ground Module gets a useful 400 instead of a crash further down.
+
+        It's done in two steps, since the event_data is checked against the event_data_schema of the event's plug-in,
+         and getting that schema imports the plug-in (and runs its setup()). decode() only checks the envelope (jwt,
+         uid, event_name and event_data), and check_event_data() is called once the card is authenticated, so a
+         request with a made-up JWT can't make TapAPI import anything.
+
+        :param event_data_schemas: {event_name: JSON Schema of its event_data}, ex. the plug-in registry's
+         event_data_schemas. Each schema is compiled the first time an event of its plug-in is checked.
+        """
+        self.event_data_schemas = event_data_schemas if event_data_schemas is not None else {}
+        self._check_envelope = compile_schema(ENVELOPE_SCHEMA)
+        # {event_name: compiled check}. Events without a schema aren't kept, so made-up event_names can't fill it up
+        self._compiled = {}
+
+    def _event_data_check(self, event_name: str):
+        check = self._compiled.get(event_name)
+        if check is not None:
+            return check
+
+        schema = self.event_data_schemas.get(event_name)
+        if schema is None:
+            return None
+
+        try:
+            check = compile_schema(schema, "event_data")
+        except (KeyError, TypeError, re.error) as e:
+            _log.critical(f'The event_data_schema of "{event_name}" is invalid ({e!r}), its event_data won\'t be '
+                          f'checked.')
+            # Accept anything instead of trying (and logging) again on every event
+            check = compile_schema({})
+
+        self._compiled[event_name] = check
+        return check
+
+    def decode(self, body: bytes) -> TapAPIRequestPayload:
+        """Decode the raw body of a request (JSON bytes) and check its envelope"""
+        try:
+            payload = json.loads(body)
+        except (ValueError, UnicodeDecodeError):
+            # JSONDecodeError is a ValueError too
+            raise PayloadError("the body is not valid JSON")
+
+        return self.validate(payload)
+
+    def validate(self, payload) -> TapAPIRequestPayload:
+        """Check the envelope of a payload that was already decoded from JSON (ex. one of the events of a batch)"""
+        # Almost every payload is valid, and checking one in a single function is quicker than going through every
+        #  compiled check. The compiled checks only run when it fails, to say what exactly is wrong.
+        if not _is_valid_envelope(payload):
+            self._check_envelope(payload)
+
+        return TapAPIRequestPayload(payload["jwt"], payload["event_name"], payload["uid"], payload["event_data"])
+
+    def check_event_data(self, payload_data: TapAPIRequestPayload) -> None:
+        """
+        Check the event_data against the event_data_schema of the event's plug-in (if it has one). Only call this
+         once the card is authenticated, since it imports the plug-in.
+        """
+        event_data_check = self._event_data_check(payload_data.event_name)
+        if event_data_check is not None:
+            event_data_check(payload_data.event_data)
+
+
+_UID_PATTERN = compile_pattern(ENVELOPE_SCHEMA["properties"]["uid"]["pattern"])
+
+
+def _is_valid_envelope(payload) -> bool:
+    """Whether the payload follows ENVELOPE_SCHEMA, without saying why not (see PayloadDecoder.validate())"""
+    if type(payload) != dict:
+        return False
+
+    jwt, uid, event_name = payload.get("jwt"), payload.get("uid"), payload.get("event_name")
+    return (type(jwt) == str and jwt != "" and type(uid) == str and _UID_PATTERN.match(uid) is not None
+            and type(event_name) == str and event_name != "" and type(payload.get("event_data")) == dict)
@@ -0,0 +1,272 @@
+import os
+import time
+import logging
+import importlib
+import threading
+from collections.abc import Mapping
+
+_log = logging.getLogger("main.logger")
+
+# When a plug-in listed in config.json is imported
+#  startup: while TapAPI starts (plug-ins listed as a plain string are always loaded this way)
+#  lazy: on the first event that needs it
+#  background: by a background thread right after TapAPI starts (or on the first event, if that comes first)
+LOAD_MODES = ("startup", "lazy", "background")
+
+# A plug-in that failed to load (ex. Google couldn't be reached during its setup()) is tried again on a later event, but
+#  no sooner than this many seconds after failing, doubling after every failure in a row
+RETRY_MIN_SECONDS = 5
+RETRY_MAX_SECONDS = 300
+
+
+class _Plugin:
+    def __init__(self, module_name: str, event_name: str = None, load: str = "lazy"):
+        self.module_name = module_name
+        self.event_name = event_name
+        self.load = load
+
+        # The plug-in's entry in config.json (ex. its bulkhead limits), empty for plug-ins listed as a plain string
+        self.options = {}
+
+        self.module = None
+        self.load_seconds = None
+        self.lock = threading.Lock()
+
+        # Failed loads in a row, and when (time.monotonic()) loading it can be tried again
+        self.failures = 0
+        self.retry_at = 0.0
+
+    @property
+    def failed(self) -> bool:
+        return self.module is None and self.failures > 0
+
+    def waiting_to_retry(self) -> bool:
+        return self.failed and time.monotonic() < self.retry_at
+
+    def fail(self) -> None:
+        self.failures += 1
+        delay = min(RETRY_MIN_SECONDS * 2 ** (self.failures - 1), RETRY_MAX_SECONDS)
+        self.retry_at = time.monotonic() + delay
+        _log.warning(f'Trying to load plug-in {self.module_name} again in {delay}s (failure #{self.failures})')
+
+
+class PluginRegistry:
+    def __init__(self, entries: list, args=None):
+        """
+        Keeps track of the plug-ins in config.json, importing each one only when it's first needed.
+
+        Importing a plug-in can be slow (ex. books_library imports the whole Google API client and logs into Google),
+         so instead of importing everything on startup, config.json can list a plug-in's event_name next to its module.
+         TapAPI then knows the plug-in exists without importing it:
+
+            "plugins": [
+                "plugins.example",
+                {"module": "plugins.books_library", "event_name": "borrow_book", "load": "background"}
+            ]
+
+        Once a plug-in is imported, its optional setup(args, options) function is called with its entry in config.json
+         as options. That's where plug-ins should create their clients for external services (ex. log into Google), so
+         that also only happens when needed. Plug-ins can also have a stats() function, shown on /stats.
+
+        :param entries: The "plugins" list of config.json
+        :param args: TapAPI's command-line arguments, passed to the plug-ins' setup()
+        """
+        self.args = args
+
+        # {event_name: _Plugin}
+        self._plugins = {}
+        self._background = None
+
+        for entry in entries:
+            if type(entry) == str:
+                # Without a manifest the event_name is only known once the plug-in is imported
+                plugin = _Plugin(entry, load="startup")
+            else:
+                plugin = _Plugin(entry["module"], entry.get("event_name"), entry.get("load", "lazy"))
+                plugin.options = entry
+
+            if plugin.load not in LOAD_MODES:
+                _log.critical(f'Unknown load mode "{plugin.load}" for plug-in {plugin.module_name}, loading it on its '
+                              f'first event. Use one of: {", ".join(LOAD_MODES)}.')
+                plugin.load = "lazy"
+
+            if plugin.load == "startup" or plugin.event_name is None:
+                plugin.load = "startup"
+                self._load(plugin)
+                if plugin.module is None:
+                    continue
+                plugin.event_name = plugin.module.event_name
+
+            self._plugins[plugin.event_name] = plugin
+
+        # Read-only {event_name: function} dictionaries that import the plug-in when one of its functions is looked up
+        self.run_funcs = _FunctionView(self, lambda module: module.run)
+        # Plug-ins can optionally handle many events in one go (see /events/batch)
+        self.batch_funcs = _FunctionView(self, lambda module: getattr(module, "run_batch", None))
+        # Deferrable plug-ins can be answered before their event reaches the database (see utils/journal.py)
+        self.ack_funcs = _FunctionView(self, _acknowledge_func)
+        # Plug-ins can optionally describe their event_data with a JSON Schema (see utils/payload_decoder.py)
+        self.event_data_schemas = _FunctionView(self, lambda module: getattr(module, "event_data_schema", None))
+
+        # Threads don't survive a fork, and a lock held by one of them would stay locked forever in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._background = None
+        for plugin in self._plugins.values():
+            plugin.lock = threading.Lock()
+
+    def __contains__(self, event_name) -> bool:
+        """Whether config.json has a plug-in for this event_name (doesn't import it)"""
+        return event_name in self._plugins
+
+    def event_names(self) -> list:
+        """The event_name of every plug-in (doesn't import them)"""
+        return list(self._plugins)
+
+    def options(self, event_name: str) -> dict:
+        """The plug-in's entry in config.json (doesn't import it)"""
+        return self._plugins[event_name].options
+
+    def module(self, event_name: str):
+        """
+        :return: The plug-in's module (imported now if it wasn't yet), or None if there is no such plug-in or it
+         couldn't be loaded (it's tried again once RETRY_MIN_SECONDS or more have passed, see _Plugin.fail())
+        """
+        plugin = self._plugins.get(event_name)
+        if plugin is None:
+            return None
+
+        if plugin.module is None and not plugin.waiting_to_retry():
+            self._load(plugin)
+
+        return plugin.module
+
+    def _load(self, plugin: _Plugin) -> None:
+        # Two events of a plug-in that isn't loaded yet could arrive together, only one of them imports it
+        with plugin.lock:
+            if plugin.module is not None or plugin.waiting_to_retry():
+                return
+
+            started = time.perf_counter()
+            try:
+                module = importlib.import_module(plugin.module_name)
+
+                if plugin.event_name is not None and module.event_name != plugin.event_name:
+                    raise AttributeError(f'config.json says the event_name of {plugin.module_name} is '
+                                         f'"{plugin.event_name}", but the plug-in says "{module.event_name}"')
+
+                if not hasattr(module, "run"):
+                    raise AttributeError(f'Plug-in {plugin.module_name} has no run() function')
+
+                if getattr(module, "deferrable", False) and not hasattr(module, "run_batch"):
+                    # Their events are written to the database with run_batch(), so they need one
+                    _log.critical(f'Deferrable plug-in "{module.event_name}" has no run_batch() function, its events '
+                                  f'will not be deferred.')
+
+                if hasattr(module, "setup"):
+                    module.setup(self.args, plugin.options)
+            except ModuleNotFoundError as e:
+                _log.critical(f'{e}. Recheck your config.json setup or is the plug-in in the /plugins directory?')
+                plugin.fail()
+                return
+            except AttributeError as e:
+                _log.critical(f'{e}. Recheck your plug-in setup, make sure it meets the requirements in the wiki.')
+                plugin.fail()
+                return
+            except Exception:
+                _log.exception(f'Plug-in {plugin.module_name} raised an error while loading')
+                plugin.fail()
+                return
+
+            plugin.load_seconds = time.perf_counter() - started
+            plugin.module = module
+            plugin.failures = 0
+            _log.info(f'Successfully loaded plugin "{module.event_name}" in {plugin.load_seconds * 1000:.1f}ms '
+                      f'({plugin.load})')
+
+    def start_background(self) -> None:
+        """Start importing the plug-ins with "load": "background" in a background thread"""
+        waiting = [plugin for plugin in self._plugins.values() if plugin.load == "background"]
+        if not waiting:
+            return
+
+        def load_all():
+            for plugin in waiting:
+                self._load(plugin)
+
+        self._background = threading.Thread(target=load_all, name="tapapi-plugin-loader", daemon=True)
+        self._background.start()
+
+    def join_background(self, timeout: float = None) -> bool:
+        """
+        Wait for the background thread to finish importing plug-ins
+
+        :return: False if it was still importing when the timeout ran out
+        """
+        if self._background is None:
+            return True
+        self._background.join(timeout)
+        return not self._background.is_alive()
+
+    def report(self) -> str:
+        """A table of every plug-in and how long it took to load, to log on startup"""
+        lines = [f'{"event_name":<20} {"module":<28} {"load":<10} import time']
+
+        for event_name, plugin in self._plugins.items():
+            if plugin.failed:
+                status = "failed to load"
+            elif plugin.module is None:
+                status = "not loaded yet"
+            else:
+                status = f'{plugin.load_seconds * 1000:.1f}ms'
+            lines.append(f'{event_name:<20} {plugin.module_name:<28} {plugin.load:<10} {status}')
+
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        """Returns how every plug-in was loaded, along with what the plug-ins' own stats() functions return"""
+        result = {}
+
+        for event_name, plugin in self._plugins.items():
+            result[event_name] = {
+                "module": plugin.module_name,
+                "load": plugin.load,
+                "loaded": plugin.module is not None,
+                "failed": plugin.failed,
+                "failures": plugin.failures,
+                "load_seconds": plugin.load_seconds
+            }
+
+            if plugin.module is not None and hasattr(plugin.module, "stats"):
+                result[event_name].update(plugin.module.stats())
+
+        return result
+
+
+def _acknowledge_func(module):
+    if getattr(module, "deferrable", False) and hasattr(module, "run_batch"):
+        return module.acknowledge
+    return None
+
+
+class _FunctionView(Mapping):
+    def __init__(self, registry: PluginRegistry, getter):
+        """One function of every plug-in, as a read-only dictionary keyed by event_name"""
+        self._registry = registry
+        self._getter = getter
+
+    def __getitem__(self, event_name):
+        module = self._registry.module(event_name)
+        func = self._getter(module) if module is not None else None
+
+        if func is None:
+            raise KeyError(event_name)
+        return func
+
+    def __iter__(self):
+        # Looping over every plug-in imports all of them
+        return (event_name for event_name in list(self._registry._plugins) if event_name in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -0,0 +1,13 @@
+import os
+
+
+def is_running(pid: int) -> bool:
+    """Whether a process with this PID exists (ex. to know if a TapAPI worker that left files behind died)"""
+    try:
+        # Signal 0 doesn't do anything, it only checks if the process exists
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
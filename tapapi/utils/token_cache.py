@@ -0,0 +1,50 @@
+import time
+import hashlib
+from utils.ttl_cache import TTLCache
+
+
+def _digest(json_web_token: str) -> bytes:
+    return hashlib.sha256(bytes(json_web_token, 'utf-8')).digest()
+
+
+class VerifiedTokenCache(TTLCache):
+    """
+    Remembers the decoded claims of JWTs that were already verified, keyed by card UID.
+
+    A card's JWT never changes between taps, so once its signature checks out we can skip the (slow) signature check
+     the next time the exact same JWT comes in from the same UID. A card only ever holds one JWT, so each UID stores
+     a single (digest, claims) pair, where the digest is the SHA-256 hash of the JWT. A JWT only counts as a hit if
+     its hash matches the stored one, so any change to the JWT is verified again.
+
+    Link it to the PublicKeyCache (see its dependents parameter) so a UID's entry is purged when its key is rotated.
+    """
+
+    def get_claims(self, uid: str, json_web_token: str):
+        """
+        Get the claims of an already verified JWT
+
+        :return: A copy of the decoded JWT (safe to modify), or None if this JWT wasn't verified recently
+        """
+        digest = _digest(json_web_token)
+        entry = self.get(uid, validate=lambda stored: stored[0] == digest)
+
+        if entry is None:
+            return None
+
+        return dict(entry[1])
+
+    def put_claims(self, uid: str, json_web_token: str, jwt_decoded: dict) -> None:
+        """Remember that a JWT was verified successfully. Never call this for a JWT that failed verification!"""
+        ttl = self.ttl
+
+        # Don't remember a JWT past its expiry date, and don't remember one that isn't valid yet at all
+        if "nbf" in jwt_decoded and jwt_decoded["nbf"] > time.time():
+            return
+
+        if "exp" in jwt_decoded:
+            remaining = jwt_decoded["exp"] - time.time()
+            if remaining <= 0:
+                return
+            ttl = remaining if ttl <= 0 else min(ttl, remaining)
+
+        self.put(uid, (_digest(json_web_token), dict(jwt_decoded)), ttl=ttl)
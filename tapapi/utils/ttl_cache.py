@@ -0,0 +1,111 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, max_size: int = 4096, ttl: float = 3600.0):
+        """
+        A thread-safe dictionary that forgets things.
+
+        It forgets the least recently used (LRU) item once it holds more than max_size items, and it forgets any item
+        that is older than ttl (time to live) seconds. Read more: https://en.wikipedia.org/wiki/Cache_replacement_policies
+
+        :param max_size: Maximum number of items stored at once
+        :param ttl: Seconds an item stays valid after being stored (0 or less to never expire)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # An OrderedDict remembers insertion order, so the first item is always the least recently used one
+        #  as long as we move_to_end() every item we touch
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # A lock held by another thread while the process forks would stay locked forever in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, validate=None):
+        """
+        Get an item, or default if it isn't stored or it expired
+
+        :param validate: Optional function that takes the stored value and returns False if it shouldn't be used
+         (it then counts as a miss)
+        """
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            if validate is not None and not validate(value):
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl: float = None) -> None:
+        """
+        Store an item, evicting the least recently used item if the cache is full
+
+        :param ttl: Overrides the cache's default ttl for this item only
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl > 0 else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key) -> bool:
+        """Forget an item. Returns True if it was stored."""
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def items(self) -> list:
+        """Returns a list of every (key, value) pair that hasn't expired yet"""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expires_at) in self._data.items()
+                    if expires_at is None or expires_at > now]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Returns the cache's counters, including the hit ratio (hits / lookups)"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
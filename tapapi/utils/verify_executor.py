@@ -0,0 +1,168 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from utils.key_cache import PublicKey, load_public_key
+from utils.authentication import verify_jwt_with_public_key
+
+# Parsed public keys that live inside each worker process, keyed by UID
+# (loaded key objects can't be sent between processes, so every worker keeps its own copy)
+# Once there are more than _WORKER_KEYS_MAX_SIZE, the least recently used one is forgotten: every verification moves
+#  its key to the end, so the first key is always the one that went the longest without a tap
+_worker_keys = OrderedDict()
+_WORKER_KEYS_MAX_SIZE = 8192
+
+
+def _init_worker(preloaded: dict) -> None:
+    """Runs once in every worker process when it starts, parsing the keys we already know about"""
+    for uid, (pem, algorithm) in preloaded.items():
+        try:
+            _worker_keys[uid] = load_public_key(pem, algorithm)
+        except ValueError:
+            continue
+
+
+def _verify_in_worker(uid: str, pem: str, algorithm: str, json_web_token: str) -> dict:
+    """Runs in a worker process. Verifies the JWT, only parsing the PEM if this worker hasn't seen it yet."""
+    public_key = _worker_keys.get(uid)
+
+    # The UID's key might have been rotated since this worker parsed it, so compare the PEMs too
+    if public_key is None or public_key.pem != pem or public_key.algorithm != algorithm:
+        public_key = load_public_key(pem, algorithm)
+        _worker_keys[uid] = public_key
+
+        if len(_worker_keys) > _WORKER_KEYS_MAX_SIZE:
+            _worker_keys.popitem(last=False)
+
+    _worker_keys.move_to_end(uid)
+
+    return verify_jwt_with_public_key(json_web_token=json_web_token, public_key=public_key)
+
+
+class VerifyExecutorError(Exception):
+    """Base class for errors caused by the verification executor itself (and not by the JWT being verified)"""
+
+
+class VerifyOverloadedError(VerifyExecutorError):
+    """Raised when too many verifications are already waiting for a worker process"""
+
+
+class VerifyTimeoutError(VerifyExecutorError):
+    """Raised when a verification didn't finish in time"""
+
+
+class VerifyExecutor:
+    def __init__(self, workers: int = None, max_pending: int = 64, timeout: float = 2.0, preloaded: dict = None):
+        """
+        Verifies JWT signatures in a pool of worker processes instead of the request thread.
+
+        Python threads can't run Python code at the same time (look up the "GIL"), so a threaded server checks
+         signatures one at a time no matter how many CPU cores there are. Worker processes each get their own core.
+
+        :param workers: Number of worker processes (defaults to the number of CPU cores)
+        :param max_pending: Maximum number of verifications allowed to be queued or running at once. Any more are
+         rejected right away with a VerifyOverloadedError instead of piling up (this is called backpressure).
+        :param timeout: Seconds to wait for a verification before raising a VerifyTimeoutError
+        :param preloaded: {uid: (public_key_pem, algorithm)} of keys each worker should parse when it starts
+        """
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.workers = workers
+        self._preloaded = preloaded or {}
+
+        # The worker processes are only started on the first verification, so a process that forks before then
+        #  (see serve.py) doesn't have to start them just to throw them away
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+        self._pending = 0
+        self._stats = {
+            "verified": 0,
+            "rejected_overloaded": 0,
+            "timeouts": 0
+        }
+
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        """Runs in a freshly forked child process, the worker processes belong to the parent"""
+        self._executor = None
+        self._pending = 0
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self._preloaded,)
+                )
+            return self._executor
+
+    def _release(self, _future) -> None:
+        # A slot is only freed once the worker is actually done, even if the caller already gave up waiting
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def verify(self, uid: str, public_key: PublicKey, json_web_token: str) -> dict:
+        """
+        Verify a JWT in a worker process
+
+        :param uid: The UID of the card (used by the workers to remember its parsed key)
+        :param public_key: The card's PublicKey
+        :param json_web_token: The JSON Web Token
+        :return: Decoded JWT if successful, jwt.exceptions.InvalidSignatureError if not
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["rejected_overloaded"] += 1
+            raise VerifyOverloadedError(f"More than {self.max_pending} verifications pending")
+
+        with self._lock:
+            self._pending += 1
+
+        try:
+            future = self._get_executor().submit(_verify_in_worker, uid, public_key.pem, public_key.algorithm,
+                                                 json_web_token)
+        except Exception:
+            self._release(None)
+            raise
+
+        future.add_done_callback(self._release)
+
+        try:
+            jwt_decoded = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise VerifyTimeoutError(f"Verification took longer than {self.timeout} seconds")
+
+        with self._lock:
+            self._stats["verified"] += 1
+
+        return jwt_decoded
+
+    def shutdown(self, wait: bool = False) -> None:
+        """
+        Stop the worker processes
+
+        :param wait: Wait for the processes to actually exit (ex. before forking, see serve.py)
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                **self._stats
+            }